@@ -0,0 +1,142 @@
+# albert_assets.py  —— 起動時に 1 回だけ読む素材（既定ポリシー・フォームの選択肢・プロンプト）
+"""
+リポジトリ直下の次のファイルを読み、検証して不変の Assets にまとめる。
+  albert_policy.json   新しい組織に入れる既定の学校ポリシー
+  albert_form.json     相談フォームの選択肢・価値観のグループ・フィードバックの理由
+  albert_prompts.toml  システムプロンプトの出力例・理論候補・作り直しの指示（albert_prompt.load_prompts）
+アプリは AssetStore をプロセスで 1 つ持ち（st.cache_resource）、再実行のたびに作り直さない。
+get() は check_every 秒ごとにファイルの更新時刻だけを見て、変わっていれば読み直す（再起動不要）。
+読み直しに失敗したときは記録して前の素材を使い続ける。起動時の失敗はそのまま例外にする。
+トピック・センシティブの検知ルールは albert_scan が import 時に 1 回だけコンパイルしている。
+
+使い方（編集後の検証）: python albert_assets.py [DIR]
+"""
+import hashlib, json, logging, os, sys, threading, time
+from dataclasses import dataclass
+from typing import Callable
+
+from albert_prompt import PromptAssets, load_prompts
+
+log = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FILES = {"policy": "albert_policy.json", "form": "albert_form.json", "prompts": "albert_prompts.toml"}
+POLICY_FIELDS = {"tone": dict, "must_include": list, "avoid_phrases": list, "phrasebook": dict, "value_mapping": dict}
+REQUIRED_SELECTS = ("grades", "scales", "scenes", "frequencies", "urgencies", "emotions")  # 先頭は未選択の ""
+OPTIONAL_SELECTS = ("subjects", "timeboxes", "specificities")                             # 先頭が既定値
+
+@dataclass(frozen=True)
+class Assets:
+    version: str       # 3 ファイルの内容の指紋
+    policy: dict
+    form: dict         # 選択肢はタプル、value_groups はグループ名 -> タプル
+    prompts: PromptAssets
+
+def _read_json(path:str)->dict:
+    with open(path, encoding="utf-8") as f:
+        d = json.load(f)
+    if not isinstance(d, dict):
+        raise ValueError(f"{os.path.basename(path)}: オブジェクトではありません")
+    return d
+
+def _strings(name:str, key:str, xs)->tuple:
+    if not isinstance(xs, list) or not xs or not all(isinstance(x, str) for x in xs):
+        raise ValueError(f"{name}: {key} は空でない文字列のリストにしてください")
+    if len(set(xs)) != len(xs):
+        raise ValueError(f"{name}: {key} に重複があります")
+    return tuple(xs)
+
+def _check_policy(p:dict)->dict:
+    name = FILES["policy"]
+    for k, typ in POLICY_FIELDS.items():
+        if not isinstance(p.get(k), typ):
+            raise ValueError(f"{name}: {k} がないか、型が違います")
+    return p
+
+def _check_form(d:dict, policy:dict)->dict:
+    name = FILES["form"]
+    form = {k: _strings(name, k, d.get(k)) for k in REQUIRED_SELECTS + OPTIONAL_SELECTS + ("reasons",)}
+    for k in REQUIRED_SELECTS:
+        if form[k][0] != "":
+            raise ValueError(f"{name}: {k} の先頭は未選択を表す \"\" にしてください")
+    groups = d.get("value_groups")
+    if not isinstance(groups, dict) or not groups:
+        raise ValueError(f"{name}: value_groups がありません")
+    form["value_groups"] = {g: _strings(name, f"value_groups.{g}", vs) for g, vs in groups.items()}
+    # 既定ポリシーで価値観タグが付かない選択肢は出さない
+    unmapped = [v for vs in form["value_groups"].values() for v in vs if v not in policy["value_mapping"]]
+    if unmapped:
+        raise ValueError(f"{name}: {FILES['policy']} の value_mapping にない価値観です: {', '.join(unmapped)}")
+    return form
+
+def load_assets(root:str=ROOT)->Assets:
+    """素材を読み込んで検証する。不備はファイル名付きの ValueError にする"""
+    paths = {k: os.path.join(root, f) for k, f in FILES.items()}
+    h = hashlib.sha1()
+    for p in paths.values():
+        with open(p, "rb") as f:
+            h.update(f.read())
+    policy = _check_policy(_read_json(paths["policy"]))
+    return Assets(version=h.hexdigest()[:12], policy=policy,
+                  form=_check_form(_read_json(paths["form"]), policy), prompts=load_prompts(paths["prompts"]))
+
+# ================== 読み直し ==================
+class AssetStore:
+    """Assets をプロセスで共有し、ファイルが変わったら読み直す。
+    on_reload(assets) は読み直しに成功したときだけ、get() を呼んだスレッドで呼ばれる"""
+
+    def __init__(self, root:str=ROOT, check_every:float=2.0, on_reload:Callable[[Assets], None]|None=None):
+        self.root = root
+        self.check_every = check_every
+        self.on_reload = on_reload
+        self._lock = threading.Lock()
+        self._stamp = self._stat()
+        self.assets = load_assets(root)
+        self._checked = time.monotonic()
+
+    def _stat(self)->tuple:
+        out = []
+        for f in FILES.values():
+            try:
+                s = os.stat(os.path.join(self.root, f))
+                out.append((s.st_mtime_ns, s.st_size))
+            except OSError:
+                out.append(None)
+        return tuple(out)
+
+    def get(self)->Assets:
+        if time.monotonic() - self._checked < self.check_every:
+            return self.assets
+        with self._lock:
+            if time.monotonic() - self._checked < self.check_every:
+                return self.assets
+            self._checked = time.monotonic()
+            stamp = self._stat()
+            if stamp == self._stamp:
+                return self.assets
+            self._stamp = stamp
+            try:
+                new = load_assets(self.root)
+            except (OSError, ValueError) as e:
+                log.warning("素材の読み直しに失敗しました（前の素材を使い続けます）: %s", e)
+                return self.assets
+            if new.version == self.assets.version:  # 更新時刻だけが変わった
+                return self.assets
+            self.assets = new
+        log.info("素材を読み直しました: %s", new.version)
+        if self.on_reload:
+            self.on_reload(new)
+        return new
+
+def main(argv=None):
+    root = (argv if argv is not None else sys.argv[1:] or [ROOT])[0]
+    try:
+        a = load_assets(root)
+    except (OSError, ValueError) as e:
+        sys.exit(f"NG: {e}")
+    n_values = sum(len(vs) for vs in a.form["value_groups"].values())
+    print(f"OK: version={a.version}  価値観 {n_values} 件 / {len(a.form['value_groups'])} グループ"
+          f"  避け語 {len(a.policy['avoid_phrases'])} 件")
+
+if __name__ == "__main__":
+    main()
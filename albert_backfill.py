@@ -0,0 +1,46 @@
+# albert_backfill.py  —— answers の派生値（避け語/NG ヒット・文字数）の一括再計算
+"""
+学校ポリシーの避け語や NG 表現を変えたときに、既存の answers を少しずつ読み直して
+avoid_hits / ng_hits / output_chars / facts_version を更新する。
+facts_version が現在のルールの指紋と同じ行は書き込まない。ロールアップはトリガーが差分だけ直す。
+
+使い方:
+  SUPABASE_URL=... SUPABASE_SERVICE_ROLE_KEY=... python albert_backfill.py [--org ORG_ID] [--chunk 500]
+"""
+import argparse, os, sys, time
+
+from supabase import create_client
+
+from albert_data import iter_pages, list_policies
+from albert_scan import answer_facts, rules_fingerprint
+
+def backfill_org(cli, org_id, avoid_phrases:list[str], chunk:int=500)->tuple[int, int]:
+    """1 組織分を (created_at, id) のキーセットで chunk 件ずつ処理し、(走査件数, 更新件数) を返す"""
+    fp = rules_fingerprint(avoid_phrases)
+    scanned = updated = 0
+    for rows in iter_pages(cli, "answers", ("text", "facts_version"), org_id=org_id, page=chunk):
+        scanned += len(rows)
+        todo = [{"id": r["id"], **answer_facts(r["text"], avoid_phrases)}
+                for r in rows if r.get("facts_version") != fp]
+        if todo:
+            updated += cli.rpc("update_answer_facts", {"p_rows": todo}).execute().data or 0
+    return scanned, updated
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="answers の派生値を現在のルールで再計算する")
+    ap.add_argument("--org", help="対象の org_id（省略時は全組織）")
+    ap.add_argument("--chunk", type=int, default=500, help="1 回に読む件数")
+    args = ap.parse_args(argv)
+
+    url, key = os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+    if not (url and key):
+        sys.exit("SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY を環境変数に設定してください。")
+    cli = create_client(url, key)
+
+    for pol in list_policies(cli, org_id=args.org):
+        t0 = time.perf_counter()
+        scanned, updated = backfill_org(cli, pol["org_id"], pol["avoid_phrases"] or [], args.chunk)
+        print(f"{pol['org_id']}: scanned={scanned} updated={updated} ({time.perf_counter()-t0:.1f}s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+# albert_batch.py  —— 相談の一括生成（Streamlit を使わないバッチ実行）
+"""
+紙で集めた相談をまとめて生成したり、ポリシーやモデルを変えたあとで過去の相談を再生成したりする。
+プロンプト組み立て（build_messages）・安全チェック（answer_scanner / 作り直し）・派生値（answer_facts）は
+画面と同じものを使い、生成は LLMCaller と GenerationScheduler を通して同時実行数とレート制限を守る。
+モデル・トークン上限・温度は画面と同じく Router が相談ごとに選び、answers.route に残す。
+
+- 入力: JSONL（1 行 1 相談、consultations の列名）または consultations テーブル
+- 保存: --batch 件ごとにまとめて upsert。ID は実行名と入力から決まるので、やり直しても重複しない。
+        失敗したら指数バックオフで再試行し、保存できるまで結果は手元に残す
+- 再開: 保存できた入力のキーをチェックポイントに追記し、次回はそれを飛ばす
+- 最後に処理量とレイテンシ（p50/p95/p99）を表示する
+
+使い方:
+  SUPABASE_URL=... SUPABASE_SERVICE_ROLE_KEY=... OPENAI_API_KEY=... \
+    python albert_batch.py --jsonl paper.jsonl --org ORG_ID --user USER_ID [--workers 4] [--routes routes.toml]
+  python albert_batch.py --from-db --org ORG_ID --since 2026-04-01 [--until 2026-10-01] [--run rerun-2026-10]
+--routes の TOML は secrets の OPENAI_ROUTES と同じ形（[routes.<名前>] と [[rules]]）。
+"""
+import argparse, hashlib, json, os, sys, time, tomllib, uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from openai import OpenAI
+from supabase import create_client
+
+from albert_data import iter_rows
+from albert_scan import SENSITIVE_SCANNER, answer_facts, classify_topics
+from albert_prompt import PolicyCache, build_messages
+from albert_llm import KEY_FIELDS, GenerationScheduler, LLMCaller
+from albert_route import Route, Router
+from albert_store import retryable, utcnow_iso
+
+ID_NAMESPACE = uuid.UUID("6f3b6a52-6c3e-4d8e-9a51-4a6c1e0b7a10")
+
+def stable_id(*parts)->str:
+    """実行名と入力から決まる UUID（再実行しても同じ行になる）"""
+    return str(uuid.uuid5(ID_NAMESPACE, "\x1f".join(map(str, parts))))
+
+# ================== 入力 ==================
+def read_jsonl(path:str, org_id=None, user_id=None):
+    """(キー, 相談, 新規か) を返す。id が無ければ行の内容から決める"""
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            c = json.loads(line)
+            c.setdefault("org_id", org_id)
+            c.setdefault("user_id", user_id)
+            if not (c.get("org_id") and c.get("user_id") and c.get("message")):
+                raise ValueError(f"{path}:{n}: org_id / user_id / message が必要です")
+            c.setdefault("sensitive_flag", SENSITIVE_SCANNER.search(c["message"]))
+            c.setdefault("id", stable_id("jsonl", hashlib.sha1(line.encode()).hexdigest()))
+            yield c["id"], c, True
+
+def read_table(cli, org_id, since:str|None=None, until:str|None=None, chunk:int=500):
+    """consultations を (created_at, id) のキーセットで読み、(キー, 相談, 新規か) を返す"""
+    cols = ("id", "org_id", "user_id", "created_at", "specificity") + KEY_FIELDS
+    for r in iter_rows(cli, "consultations", cols, org_id=org_id, since=since, until=until, page=chunk):
+        yield r["id"], r, False
+
+# ================== 生成 ==================
+def generate(caller:LLMCaller, cp, c:dict, route:Route)->dict:
+    """画面の非ストリーミング経路と同じ手順で、route のモデル・上限・温度で 1 件生成する（違反を検知したら作り直す）"""
+    check = cp.output_scanner(SENSITIVE_SCANNER.search(c.get("message") or ""))
+    usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    def call(messages, temperature):
+        model, r = caller.complete(messages, temperature=temperature, max_tokens=route.max_tokens)
+        if r.usage:
+            usage["prompt_tokens"] += r.usage.prompt_tokens or 0
+            usage["completion_tokens"] += r.usage.completion_tokens or 0
+        return model, r.choices[0].message.content or ""
+    model, text = call(build_messages(cp, c, max_tokens=route.max_tokens), route.temperature)
+    repaired = check.search(text)
+    if repaired:
+        model, text = call(build_messages(cp, c, repair=True, max_tokens=route.max_tokens), route.repair_temperature)
+    return {"model": model, "text": text, "repaired": repaired, **usage}
+
+class BatchRunner:
+    """入力を workers 件まで並行に生成し、batch 件ごとにまとめて保存してチェックポイントを進める。
+    client は OpenAI クライアントで、ルートのモデルごとに LLMCaller を作って使い回す"""
+
+    def __init__(self, cli, client, sched:GenerationScheduler, router:Router, run:str, *,
+                 workers:int=4, batch:int=50, checkpoint:str|None=None,
+                 retries:int=5, base_delay:float=0.5, max_delay:float=30.0):
+        self.cli = cli
+        self.client = client
+        self.sched = sched
+        self.router = router
+        self._callers: dict[tuple, LLMCaller] = {}
+        self.run = run
+        self.workers = workers
+        self.batch = batch
+        self.checkpoint = checkpoint
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.policies = PolicyCache()
+        self.done = self._load_checkpoint()
+        self.latencies: list[float] = []
+        self.stats = {"ok": 0, "failed": 0, "skipped": 0, "repaired": 0,
+                      "prompt_tokens": 0, "completion_tokens": 0}
+        self._rows: list[tuple[str, dict|None, dict]] = []
+
+    def caller(self, route:Route)->LLMCaller:
+        """ルートのモデルの LLMCaller（サーキットブレーカーとヘッジの実績をモデルごとに持つ）。呼ぶのは run_all のスレッドだけ"""
+        k = (route.model, route.fallback_model)
+        if k not in self._callers:
+            self._callers[k] = LLMCaller(self.client, route.model, route.fallback_model, on_headers=self.sched.observe)
+        return self._callers[k]
+
+    def _load_checkpoint(self)->set:
+        if not (self.checkpoint and os.path.exists(self.checkpoint)):
+            return set()
+        with open(self.checkpoint, encoding="utf-8") as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def process(self, key:str, c:dict, new:bool, route:Route, caller:LLMCaller)->tuple[str, dict|None, dict]:
+        cp = self.policies.get(self.cli, c["org_id"])
+        if cp is None:
+            raise LookupError(f"org_policies がありません: {c['org_id']}")
+        est = sum(len(m["content"]) for m in build_messages(cp, c, max_tokens=route.max_tokens)) + route.max_tokens
+        t0 = time.perf_counter()
+        with self.sched.acquire(c["org_id"], est):
+            out = generate(caller, cp, c, route)
+        latency_ms = int((time.perf_counter() - t0) * 1000)
+        consultation = None
+        if new:
+            consultation = {k: c.get(k) for k in ("id", "org_id", "user_id", "specificity") + KEY_FIELDS}
+            consultation.update(created_at=c.get("created_at") or utcnow_iso(),
+                                topics=classify_topics(c.get("message") or ""))
+        answer = {
+            "id": stable_id(self.run, c["id"]), "consultation_id": c["id"], "created_at": utcnow_iso(),
+            "model": out["model"], "route": route.name, "safety_mode": bool(c.get("sensitive_flag")), "text": out["text"],
+            "repaired": out["repaired"], "latency_ms": latency_ms, "cache_hit": False,
+            "prompt_tokens": out["prompt_tokens"], "completion_tokens": out["completion_tokens"],
+            **answer_facts(out["text"], cp.avoid_phrases),
+        }
+        return key, consultation, answer
+
+    def _upsert(self, table:str, rows:list):
+        """WriteBehind と同じく、再試行で通らないエラー以外は指数バックオフで再試行する（ID 指定なので重複しない）"""
+        for attempt in range(self.retries + 1):
+            try:
+                return self.cli.table(table).upsert(rows, on_conflict="id", ignore_duplicates=True).execute()
+            except Exception as e:
+                if attempt == self.retries or not retryable(e):
+                    raise
+                print(f"保存を再試行します {table}: {e!r}", file=sys.stderr)
+                time.sleep(min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def flush(self):
+        """溜まった結果をまとめて保存し、保存できたキーをチェックポイントに書く。
+        両方の保存が済むまで結果は self._rows に残す（失敗したら例外を送出し、次の flush でやり直す）"""
+        rows = self._rows
+        if not rows:
+            return
+        cons = [c for _, c, _ in rows if c]
+        if cons:
+            self._upsert("consultations", cons)
+        self._upsert("answers", [a for _, _, a in rows])
+        self._rows = []
+        if self.checkpoint:
+            with open(self.checkpoint, "a", encoding="utf-8") as f:
+                f.writelines(k + "\n" for k, _, _ in rows)
+        self.done.update(k for k, _, _ in rows)
+
+    def _collect(self, futs:dict):
+        done, _ = wait(futs, return_when=FIRST_COMPLETED)
+        for f in done:
+            key = futs.pop(f)
+            try:
+                row = f.result()
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"失敗 {key}: {e!r}", file=sys.stderr)
+                continue
+            a = row[2]
+            self.stats["ok"] += 1
+            self.stats["repaired"] += a["repaired"]
+            self.stats["prompt_tokens"] += a["prompt_tokens"]
+            self.stats["completion_tokens"] += a["completion_tokens"]
+            self.latencies.append(a["latency_ms"])
+            self._rows.append(row)
+            if len(self._rows) >= self.batch:
+                try:
+                    self.flush()
+                except Exception as e:  # 結果は残っているので、次の flush（最後にも 1 回）でやり直す
+                    print(f"保存に失敗しました（{len(self._rows)} 件を保持）: {e!r}", file=sys.stderr)
+
+    def run_all(self, items)->dict:
+        """items（(キー, 相談, 新規か) の列）を処理し、集計を返す。読み込みは先読み workers*2 件まで"""
+        t0 = time.perf_counter()
+        futs: dict = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="albert-batch") as pool:
+            for key, c, new in items:
+                if key in self.done:
+                    self.stats["skipped"] += 1
+                    continue
+                route = self.router.choose(c)
+                futs[pool.submit(self.process, key, c, new, route, self.caller(route))] = key
+                while len(futs) >= self.workers * 2:
+                    self._collect(futs)
+            while futs:
+                self._collect(futs)
+        self.flush()
+        return self.report(time.perf_counter() - t0)
+
+    def report(self, elapsed:float)->dict:
+        xs = sorted(self.latencies)
+        pct = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))] if xs else None
+        return {**self.stats, "elapsed_s": round(elapsed, 1),
+                "per_min": round(self.stats["ok"] / elapsed * 60, 1) if elapsed else 0.0,
+                "latency_ms": {"p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99)}}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="相談をまとめて生成して保存する")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--jsonl", help="入力 JSONL（1 行 1 相談）")
+    src.add_argument("--from-db", action="store_true", help="consultations テーブルの相談を再生成する")
+    ap.add_argument("--org", help="対象の org_id（--from-db では必須）")
+    ap.add_argument("--user", help="JSONL に user_id が無いときの相談者")
+    ap.add_argument("--since", help="--from-db: この日時以降（ISO 8601）")
+    ap.add_argument("--until", help="--from-db: この日時より前（ISO 8601）")
+    ap.add_argument("--run", help="実行名（回答 ID とチェックポイント名に使う。既定は入力から決める）")
+    ap.add_argument("--checkpoint", help="チェックポイントのファイル（既定 .albert_batch_<run>.ckpt）")
+    ap.add_argument("--workers", type=int, default=4, help="同時に生成する件数")
+    ap.add_argument("--batch", type=int, default=50, help="まとめて保存する件数")
+    ap.add_argument("--routes", help="生成ルートの上書き（TOML。secrets の OPENAI_ROUTES と同じ形）")
+    ap.add_argument("--report", help="集計を JSON で書き出すファイル")
+    args = ap.parse_args(argv)
+    if args.from_db and not args.org:
+        ap.error("--from-db には --org が必要です")
+
+    url, key = os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+    oa_key = os.environ.get("OPENAI_API_KEY")
+    if not (url and key and oa_key):
+        sys.exit("SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY / OPENAI_API_KEY を環境変数に設定してください。")
+    cli = create_client(url, key)
+    sched = GenerationScheduler(args.workers, float(os.environ.get("OPENAI_RPM", 500)),
+                                float(os.environ.get("OPENAI_TPM", 200_000)))
+    routes = None
+    if args.routes:
+        with open(args.routes, "rb") as f:
+            routes = tomllib.load(f)
+    router = Router.from_config(routes, os.environ.get("OPENAI_MODEL", "gpt-4o-mini"),
+                                os.environ.get("OPENAI_FAST_MODEL"), os.environ.get("OPENAI_FALLBACK_MODEL"), stream=False)
+
+    run = args.run or stable_id(args.jsonl or "db", args.org, args.since, args.until)[:8]
+    runner = BatchRunner(cli, OpenAI(api_key=oa_key, max_retries=0), sched, router, run,
+                         workers=args.workers, batch=args.batch, checkpoint=args.checkpoint or f".albert_batch_{run}.ckpt")
+    items = (read_jsonl(args.jsonl, args.org, args.user) if args.jsonl
+             else read_table(cli, args.org, args.since, args.until))
+    rep = runner.run_all(items)
+    lat = rep["latency_ms"]
+    print(f"run={run} ok={rep['ok']} failed={rep['failed']} skipped={rep['skipped']} repaired={rep['repaired']}")
+    print(f"{rep['elapsed_s']}s  {rep['per_min']} 件/分  p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms"
+          f"  tokens={rep['prompt_tokens']}+{rep['completion_tokens']}")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"run": run, **rep}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
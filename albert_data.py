@@ -0,0 +1,108 @@
+# albert_data.py  —— 読み取り系のデータアクセス（列の明示・組織スコープ・キーセットページング）
+"""
+テーブルの読み取りはここを通す。select("*") は使わず、テーブルごとに読める列を COLUMNS で決めておき、
+呼び出し側は必要な列だけを指定する。件数が増え続けるテーブル（consultations / answers / feedbacks）は
+(created_at, id) のキーセットで page 件ずつ読み、iter_rows / iter_pages のイテレータで返すので、
+集計やエクスポートでも使うメモリはページ 1 枚分で済む。
+
+answers は org_id を持たないので、consultations を内部結合して組織で絞る。
+"""
+from typing import Iterable, Iterator
+
+# テーブルごとに読める列（スキーマに合わせて増やす）
+COLUMNS = {
+    "consultations": ("id", "org_id", "user_id", "created_at", "grade", "scale", "scene", "frequency",
+                      "urgency", "emotion", "subject", "timebox", "specificity", "message", "attempts",
+                      "values", "sensitive_flag", "safety_answers", "topics"),
+    "answers": ("id", "consultation_id", "created_at", "model", "safety_mode", "text", "repaired",
+                "latency_ms", "cache_hit", "prompt_tokens", "completion_tokens", "avoid_hits", "ng_hits",
+                "output_chars", "facts_version"),
+    "feedbacks": ("id", "answer_id", "org_id", "user_id", "created_at", "rating", "reasons", "note"),
+    "org_policies": ("id", "org_id", "tone", "must_include", "avoid_phrases", "phrasebook",
+                     "value_mapping", "updated_at", "updated_by"),
+    "memberships": ("org_id", "user_id", "role"),
+}
+# 組織で絞る方法（answers は consultations を内部結合して絞る）
+ORG_SCOPE = {
+    "consultations": ("org_id", None),
+    "feedbacks": ("org_id", None),
+    "answers": ("consultations.org_id", "consultations!inner(org_id)"),
+    "org_policies": ("org_id", None),
+}
+POLICY_COLUMNS = ("id", "org_id", "tone", "must_include", "avoid_phrases", "phrasebook", "value_mapping", "updated_at")
+
+def project(table:str, cols:Iterable[str])->str:
+    """select に渡す列リスト。COLUMNS に無い列は指定ミスとして弾く"""
+    cols = tuple(cols)
+    unknown = [c for c in cols if c not in COLUMNS[table]]
+    if unknown:
+        raise ValueError(f"{table} に無い列です: {', '.join(unknown)}")
+    return ", ".join(cols)
+
+def _scoped(cli, table:str, cols:tuple, org_id):
+    col, embed = ORG_SCOPE[table]
+    sel = project(table, cols)
+    if org_id is not None and embed:
+        sel += ", " + embed
+    q = cli.table(table).select(sel)
+    return q.eq(col, org_id) if org_id is not None else q
+
+# ================== キーセットページング ==================
+def iter_pages(cli, table:str, cols:Iterable[str], *, org_id=None, since:str|None=None, until:str|None=None,
+               filters:Iterable[tuple]=(), page:int=500)->Iterator[list[dict]]:
+    """(created_at, id) 昇順に page 件ずつのリストを返す。
+    since 以上・until 未満で絞り、filters は (列, 値) の eq 条件。org_id=None は全組織（サービスロール用）"""
+    cols = tuple(dict.fromkeys(("id", "created_at") + tuple(cols)))  # キーの列は必ず読む
+    embed_key = ORG_SCOPE.get(table, (None, None))[1]
+    embed_key = embed_key.split("!")[0] if embed_key and org_id is not None else None
+    last = None
+    while True:
+        q = _scoped(cli, table, cols, org_id)
+        for col, val in filters:
+            q = q.eq(col, val)
+        if since:
+            q = q.gte("created_at", since)
+        if until:
+            q = q.lt("created_at", until)
+        if last:
+            q = q.or_(f'created_at.gt."{last[0]}",and(created_at.eq."{last[0]}",id.gt.{last[1]})')
+        rows = q.order("created_at").order("id").limit(page).execute().data or []
+        if embed_key:
+            for r in rows:
+                r.pop(embed_key, None)  # 絞り込みのための結合なので返さない
+        if rows:
+            yield rows
+        if len(rows) < page:
+            return
+        last = (rows[-1]["created_at"], rows[-1]["id"])
+
+def iter_rows(cli, table:str, cols:Iterable[str], **kw)->Iterator[dict]:
+    """iter_pages を 1 行ずつにしたもの"""
+    for rows in iter_pages(cli, table, cols, **kw):
+        yield from rows
+
+# ================== 小さな参照 ==================
+def get_policy(cli, org_id, cols:Iterable[str]=POLICY_COLUMNS)->dict|None:
+    rows = _scoped(cli, "org_policies", tuple(cols), org_id).limit(1).execute().data
+    return rows[0] if rows else None
+
+def policy_version(cli, org_id)->str|None:
+    """ポリシーの版（updated_at）だけを読む。行が無ければ None"""
+    row = get_policy(cli, org_id, ("updated_at",))
+    return row["updated_at"] if row else None
+
+def list_policies(cli, cols:Iterable[str]=("org_id", "avoid_phrases"), org_id=None)->list[dict]:
+    """組織ごとのポリシー（組織数ぶんしか無いのでページングしない）"""
+    return _scoped(cli, "org_policies", tuple(cols), org_id).execute().data or []
+
+def memberships(cli, user_id)->list[dict]:
+    """ユーザーの所属と組織名"""
+    sel = project("memberships", ("org_id", "role")) + ", orgs(name)"
+    return cli.table("memberships").select(sel).eq("user_id", user_id).execute().data or []
+
+def get_many(cli, table:str, cols:Iterable[str], ids:Iterable, *, key:str="id", chunk:int=200)->Iterator[dict]:
+    """key の値の一覧で行を引く（URL が長くなりすぎないよう chunk 件ずつ）"""
+    ids = list(dict.fromkeys(ids))
+    sel = project(table, tuple(dict.fromkeys((key,) + tuple(cols))))
+    for i in range(0, len(ids), chunk):
+        yield from cli.table(table).select(sel).in_(key, ids[i:i + chunk]).execute().data or []
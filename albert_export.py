@@ -0,0 +1,178 @@
+# albert_export.py  —— 相談・回答・フィードバックの一括エクスポート（CSV / Parquet / Arrow IPC）
+"""
+consultations を組織・期間で (created_at, id) のキーセットで page 件ずつ読み、その page の answers と
+feedbacks だけを引いて 1 回答 1 行に結合し、出力先（Sink）へ順に書き足す。メモリに持つのは 1 ページ分だけ。
+行の順番は相談の (created_at, id)、同じ相談の中では回答の (created_at, id)（一括生成の再実行で
+回答が複数ある相談は回答の数だけ行になる）。回答のない相談は回答の列が空の 1 行にする。
+フィードバックは回答ごとに件数・評価別の件数・理由・メモをまとめる。
+
+redact=True のときは、センシティブの印が付いた相談と、相談文が検知ルール（detect_sensitive と同じ
+SENSITIVE_SCANNER）に当たる相談について、自由記述（相談内容・既試行策・回答・メモ）を伏せる。
+
+使い方（画面を通さない大きな出力）:
+  SUPABASE_URL=... SUPABASE_SERVICE_ROLE_KEY=... python albert_export.py --org ORG_ID --out export.parquet \\
+      [--since 2026-04-01] [--until 2026-07-01] [--redact]
+"""
+import argparse, csv, os, sys, time
+from typing import Callable, Iterator
+
+from albert_data import get_many, iter_pages
+from albert_scan import SENSITIVE_SCANNER
+
+CONSULTATION_FIELDS = ("user_id", "grade", "scale", "scene", "frequency", "urgency", "emotion", "subject",
+                       "timebox", "specificity", "message", "attempts", "values", "sensitive_flag", "topics")
+ANSWER_FIELDS = ("id", "consultation_id", "created_at", "model", "text", "repaired", "latency_ms", "cache_hit")
+FEEDBACK_FIELDS = ("answer_id", "rating", "reasons", "note")
+# 出力の列（順番どおり）と Arrow の型
+COLUMNS = (
+    ("consultation_id", "string"), ("created_at", "timestamp"), ("user_id", "string"),
+    ("grade", "string"), ("scale", "string"), ("scene", "string"), ("frequency", "string"),
+    ("urgency", "string"), ("emotion", "string"), ("subject", "string"), ("timebox", "string"),
+    ("specificity", "string"), ("message", "string"), ("attempts", "string"), ("values", "string"),
+    ("sensitive_flag", "bool"), ("topics", "string"),
+    ("answer_id", "string"), ("answered_at", "timestamp"), ("model", "string"), ("answer", "string"), ("repaired", "bool"),
+    ("latency_ms", "int64"), ("cache_hit", "bool"),
+    ("feedbacks", "int64"), ("good", "int64"), ("ok", "int64"), ("bad", "int64"),
+    ("reasons", "string"), ("notes", "string"), ("redacted", "bool"),
+)
+REDACTED = "［センシティブのため非表示］"
+SEP = " | "  # 配列の列（価値観・トピック・理由・メモ）はこの区切りで 1 セルにする
+
+def _join(xs)->str:
+    return SEP.join(str(x) for x in xs or [] if x)
+
+# ================== 行の組み立て ==================
+def export_pages(cli, org_id, since:str|None=None, until:str|None=None, *, redact:bool=False,
+                 detect:Callable[[str], bool]=SENSITIVE_SCANNER.search, page:int=500)->Iterator[list[dict]]:
+    """1 ページ分ずつ、COLUMNS の列を持つ行のリストを返す"""
+    for cons in iter_pages(cli, "consultations", CONSULTATION_FIELDS, org_id=org_id, since=since, until=until, page=page):
+        answers: dict = {}
+        for a in get_many(cli, "answers", ANSWER_FIELDS, [c["id"] for c in cons], key="consultation_id"):
+            answers.setdefault(a["consultation_id"], []).append(a)
+        fbs: dict = {}
+        ids = [a["id"] for xs in answers.values() for a in xs]
+        for f in get_many(cli, "feedbacks", FEEDBACK_FIELDS, ids, key="answer_id"):
+            fbs.setdefault(f["answer_id"], []).append(f)
+        rows = []
+        for c in cons:
+            hide = redact and (bool(c.get("sensitive_flag")) or detect(c.get("message") or ""))
+            base = {
+                "consultation_id": c["id"], "created_at": c["created_at"],
+                **{k: c.get(k) for k in CONSULTATION_FIELDS if k not in ("values", "topics")},
+                "values": _join(c.get("values")), "topics": _join(c.get("topics")), "redacted": hide,
+            }
+            for a in sorted(answers.get(c["id"], []), key=lambda a: (a["created_at"], a["id"])) or [{}]:
+                fb = fbs.get(a.get("id"), [])
+                rows.append({
+                    **base,
+                    "answer_id": a.get("id"), "answered_at": a.get("created_at"), "model": a.get("model"),
+                    "answer": a.get("text"), "repaired": a.get("repaired"), "latency_ms": a.get("latency_ms"),
+                    "cache_hit": a.get("cache_hit"),
+                    "feedbacks": len(fb), **{r: sum(f.get("rating") == r for f in fb) for r in ("good", "ok", "bad")},
+                    "reasons": _join(r for f in fb for r in f.get("reasons") or []),
+                    "notes": _join(f.get("note") for f in fb),
+                })
+                if hide:
+                    rows[-1].update(message=REDACTED, attempts=REDACTED, answer=REDACTED, notes=REDACTED)
+        yield rows
+
+# ================== 出力先 ==================
+class CsvSink:
+    """Excel でそのまま開けるよう BOM 付き UTF-8 で書く"""
+
+    def __init__(self, path:str):
+        self._f = open(path, "w", encoding="utf-8-sig", newline="")
+        self._w = csv.DictWriter(self._f, [c for c, _ in COLUMNS])
+        self._w.writeheader()
+
+    def write(self, rows:list[dict]):
+        self._w.writerows(rows)
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+class ArrowSink:
+    """Parquet（fmt="parquet"）または Arrow IPC ファイル（fmt="arrow"）に 1 ページ 1 バッチで書く。どちらも zstd 圧縮"""
+
+    def __init__(self, path:str, fmt:str="parquet"):
+        import pyarrow as pa  # streamlit の依存として入っている。CSV だけなら不要
+        types = {"string": pa.string(), "bool": pa.bool_(), "int64": pa.int64(),
+                 "timestamp": pa.timestamp("us", tz="UTC")}
+        self._pa = pa
+        self.schema = pa.schema([(c, types[t]) for c, t in COLUMNS])
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            self._w = pq.ParquetWriter(path, self.schema, compression="zstd")
+        elif fmt == "arrow":
+            self._w = pa.ipc.new_file(path, self.schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+        else:
+            raise ValueError(f"未対応の形式です: {fmt}")
+
+    def write(self, rows:list[dict]):
+        pa = self._pa
+        cols = []
+        for field in self.schema:
+            vals = [r.get(field.name) for r in rows]
+            if pa.types.is_timestamp(field.type):  # PostgREST の ISO 8601 文字列（時差付き）を UTC に
+                cols.append(pa.array(vals, pa.string()).cast(field.type))
+            else:
+                cols.append(pa.array(vals, field.type))
+        self._w.write_batch(pa.RecordBatch.from_arrays(cols, schema=self.schema))
+
+    def close(self):
+        self._w.close()
+
+FORMATS = {"csv": ("text/csv", CsvSink), "parquet": ("application/vnd.apache.parquet", ArrowSink),
+           "arrow": ("application/vnd.apache.arrow.file", ArrowSink)}
+
+def open_sink(path:str, fmt:str):
+    _, cls = FORMATS[fmt]
+    return cls(path) if cls is CsvSink else cls(path, fmt)
+
+def export(cli, org_id, sinks:list, since:str|None=None, until:str|None=None, *, redact:bool=False,
+           detect:Callable[[str], bool]=SENSITIVE_SCANNER.search, page:int=500,
+           progress:Callable[[int], None]|None=None)->int:
+    """ページごとにすべての sink へ書き、書いた行数（回答の数。回答のない相談は 1 行）を返す。sink は最後に閉じる"""
+    n = 0
+    try:
+        for rows in export_pages(cli, org_id, since, until, redact=redact, detect=detect, page=page):
+            for s in sinks:
+                s.write(rows)
+            n += len(rows)
+            if progress:
+                progress(n)
+    finally:
+        for s in sinks:
+            s.close()
+    return n
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="相談・回答・フィードバックを結合して書き出す")
+    ap.add_argument("--org", required=True, help="対象の org_id")
+    ap.add_argument("--out", required=True, action="append", help="出力先（拡張子 .csv / .parquet / .arrow で形式を決める。複数可）")
+    ap.add_argument("--since", help="この日時以降（ISO 8601）")
+    ap.add_argument("--until", help="この日時より前（ISO 8601）")
+    ap.add_argument("--redact", action="store_true", help="センシティブな相談の自由記述を伏せる")
+    ap.add_argument("--page", type=int, default=500, help="1 回に読む相談の件数")
+    args = ap.parse_args(argv)
+
+    url, key = os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+    if not (url and key):
+        sys.exit("SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY を環境変数に設定してください。")
+    sinks = []
+    for path in args.out:
+        fmt = os.path.splitext(path)[1].lstrip(".").lower()
+        if fmt not in FORMATS:
+            sys.exit(f"{path}: 拡張子は .csv / .parquet / .arrow のいずれかにしてください。")
+        sinks.append(open_sink(path, fmt))
+    from supabase import create_client
+    cli = create_client(url, key)
+
+    t0 = time.perf_counter()
+    n = export(cli, args.org, sinks, args.since, args.until, redact=args.redact, page=args.page,
+               progress=lambda n: print(f"\r{n} 件", end="", file=sys.stderr))
+    print(f"\n{n} 件を書き出しました（{time.perf_counter()-t0:.1f}s）", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
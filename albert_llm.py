@@ -0,0 +1,538 @@
+# albert_llm.py  —— 生成呼び出しの周辺（応答キャッシュ・スケジューラ）
+"""
+同じ組織で同じ内容の相談が繰り返されたときは、LLM を呼ばずに前回の回答を返す。
+キーは正規化した入力・学校ポリシーの版・モデル・具体度から作る内容アドレス。
+
+GenerationScheduler はプロセス内のすべてのセッションの生成呼び出しに順番を付ける。
+同時実行数の上限、組織ごとのラウンドロビン、レスポンスヘッダで補正するトークンバケット、
+同一内容の実行中リクエストの相乗り（single-flight）を受け持つ。
+
+LLMCaller は 1 回の生成呼び出しを壊れにくくする。試行ごとの期限、再試行可能なエラーの
+指数バックオフ、最初のトークンが p95 を過ぎても来ないときの予備モデルへのヘッジ、
+障害時に即座に失敗させるサーキットブレーカーを持つ。
+"""
+import contextvars, functools, hashlib, itertools, json, logging, math, random, threading, time, unicodedata
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import openai
+
+from albert_trace import LatencyWindow
+
+log = logging.getLogger(__name__)
+
+# キーに含める相談の項目（consultations の列名）
+KEY_FIELDS = ("grade", "scale", "scene", "frequency", "urgency", "emotion", "subject",
+              "timebox", "message", "attempts", "values", "sensitive_flag", "safety_answers")
+
+def _norm(v):
+    if isinstance(v, str):
+        return "".join(unicodedata.normalize("NFKC", v).split())  # 日本語では空白の有無は意味を変えない
+    if isinstance(v, (list, tuple)):
+        return sorted(_norm(x) for x in v)
+    if isinstance(v, dict):
+        return {k: _norm(x) for k, x in sorted(v.items())}
+    return v
+
+def consultation_key(c:dict, org_id, policy_version, model:str, specificity:str, assets_version:str="")->str:
+    """入力の表記ゆれ（全角/半角・空白・価値観の順序）を吸収した内容アドレス。
+    assets_version（albert_assets の版）を含めるので、プロンプトを読み直すと前の回答は当たらなくなる"""
+    body = {f: _norm(c.get(f)) for f in KEY_FIELDS}
+    raw = json.dumps([str(org_id), policy_version, model, specificity, body, assets_version],
+                     ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+class ResponseCache:
+    """TTL 付き LRU。件数と合計文字数の両方で上限を設ける"""
+
+    def __init__(self, ttl:float=24*3600, max_entries:int=1000, max_chars:int=4_000_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "skipped": 0}
+        self._data: OrderedDict = OrderedDict()  # key -> (保存時刻, 値)
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def get(self, key:str)->dict|None:
+        with self._lock:
+            hit = self._data.get(key)
+            if hit and time.monotonic() - hit[0] < self.ttl:
+                self._data.move_to_end(key)
+                self.stats["hits"] += 1
+                return hit[1]
+            if hit:
+                self._drop(key)
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key:str, value:dict):
+        size = len(value.get("text") or "")
+        if size > self.max_chars:
+            return
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (time.monotonic(), value)
+            self._chars += size
+            while len(self._data) > self.max_entries or self._chars > self.max_chars:
+                self._drop(next(iter(self._data)))
+                self.stats["evictions"] += 1
+
+    def skip(self):
+        """キャッシュ対象外（センシティブ等）として素通しした回数を数える"""
+        with self._lock:
+            self.stats["skipped"] += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def _drop(self, key:str):
+        _, value = self._data.pop(key)
+        self._chars -= len(value.get("text") or "")
+
+# ================== スケジューラ ==================
+class TokenBucket:
+    """1 分あたり limit の速度で補充されるバケット。ヘッダの残量で実際の値に寄せる"""
+
+    def __init__(self, limit_per_min:float):
+        self.capacity = float(limit_per_min)
+        self.level = float(limit_per_min)
+        self._t = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._t) * self.capacity / 60.0)
+        self._t = now
+
+    def can_take(self, n:float)->bool:
+        self._refill()
+        return self.level >= min(n, self.capacity)
+
+    def take(self, n:float):
+        self._refill()
+        self.level -= n
+
+    def observe(self, limit, remaining):
+        """x-ratelimit-limit-* / x-ratelimit-remaining-* の値を反映する"""
+        self._refill()
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+
+    def wait_time(self, n:float)->float:
+        self._refill()
+        short = min(n, self.capacity) - self.level
+        return max(0.0, short * 60.0 / self.capacity) if self.capacity else 0.0
+
+class Slot:
+    """スケジューラの順番待ちの 1 件。granted になったら呼び出してよい"""
+
+    def __init__(self, sched:"GenerationScheduler", org_id, tokens:int, calls:int=1):
+        self.sched = sched
+        self.org_id = org_id
+        self.tokens = tokens
+        self.calls = calls  # API 呼び出しの数（リクエスト数のバケットをこの分使う）
+        self.width = max(1, min(calls, sched.max_concurrency))  # 同時実行数の枠
+        self.granted = False  # False: 待ち / True: 実行中 / None: 解放済み
+        self.throttled = False
+        self.started = None
+
+    def wait(self, timeout:float|None=None)->bool:
+        return self.sched._wait(self, timeout)
+
+    def position(self)->int:
+        """自分より先に実行される見込みの件数"""
+        return self.sched._position(self)
+
+    def eta(self)->float:
+        """実行開始までの見込み秒数"""
+        return self.sched._eta(self)
+
+    def release(self):
+        self.sched._release(self)
+
+    def __enter__(self):
+        self.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class GenerationScheduler:
+    def __init__(self, max_concurrency:int=4, rpm:float=500, tpm:float=200_000):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.stats = {"granted": 0, "coalesced": 0, "rate_limited": 0}
+        self._queues: OrderedDict = OrderedDict()  # org_id -> deque[Slot]（先頭が次に回る組織）
+        self._active = 0
+        self._service = 20.0  # 1 件あたりの所要秒数（指数移動平均）
+        self._inflight: dict = {}  # single-flight: key -> Future
+        self._cv = threading.Condition()
+
+    # ---- 順番待ち ----
+    def acquire(self, org_id, tokens:int, calls:int=1)->Slot:
+        """順番待ちに並ぶ。実行してよいかは Slot.wait() で確認する。
+        calls 件を並行して呼ぶ場合（分割生成）は同時実行数の枠を min(calls, max_concurrency) 使う"""
+        slot = Slot(self, org_id, tokens, max(1, calls))
+        with self._cv:
+            self._queues.setdefault(org_id, deque()).append(slot)
+            self._dispatch()
+        return slot
+
+    def _dispatch(self):
+        # ロック保持中に呼ぶ。空きと残量がある限り、組織を順に回して 1 件ずつ許可する
+        while self._queues and self._active < self.max_concurrency:
+            org_id, q = next(iter(self._queues.items()))
+            slot = q[0]
+            if self._active + slot.width > self.max_concurrency:
+                break  # 幅の広い呼び出しは枠がまとめて空くまで待つ（後ろが追い越すと飢える）
+            if not (self.requests.can_take(slot.calls) and self.tokens.can_take(slot.tokens)):
+                if not slot.throttled:
+                    slot.throttled = True
+                    self.stats["rate_limited"] += 1
+                break
+            q.popleft()
+            self._queues.pop(org_id)
+            if q:
+                self._queues[org_id] = q  # 末尾に回す
+            self.requests.take(slot.calls)
+            self.tokens.take(slot.tokens)
+            slot.granted = True
+            slot.started = time.monotonic()
+            self._active += slot.width
+            self.stats["granted"] += 1
+        self._cv.notify_all()
+
+    def charge(self, tokens:int, calls:int=1):
+        """枠を取った後で増えた呼び出し（安全チェックでの作り直しなど）をバケットに積む。
+        残量が負になれば、後ろの順番待ちがその分だけ待たされる"""
+        with self._cv:
+            self.requests.take(calls)
+            self.tokens.take(tokens)
+
+    def _wait(self, slot:Slot, timeout:float|None)->bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cv:
+            while not slot.granted:
+                self._dispatch()
+                if slot.granted:
+                    break
+                left = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+                if left <= 0:
+                    return False
+                self._cv.wait(left)  # バケットの補充は時間経過なので定期的に見直す
+        return True
+
+    def _release(self, slot:Slot):
+        with self._cv:
+            if slot.granted:
+                self._active -= slot.width
+                self._service = 0.8 * self._service + 0.2 * (time.monotonic() - slot.started)
+                slot.granted = None  # 二重解放を防ぐ
+            else:
+                q = self._queues.get(slot.org_id)
+                if q and slot in q:
+                    q.remove(slot)
+                    if not q:
+                        self._queues.pop(slot.org_id)
+            self._dispatch()
+
+    def _position(self, slot:Slot)->int:
+        with self._cv:
+            if slot.granted is not False:
+                return 0
+            mine = self._queues.get(slot.org_id) or deque()
+            i = mine.index(slot) if slot in mine else 0
+            ahead, before = i, True
+            for org_id, q in self._queues.items():
+                if org_id == slot.org_id:
+                    before = False
+                    continue
+                ahead += min(len(q), i + 1 if before else i)
+            return ahead
+
+    def _eta(self, slot:Slot)->float:
+        pos = self._position(slot)
+        with self._cv:
+            if slot.granted is not False:
+                return 0.0
+            rounds = math.floor(pos / self.max_concurrency) + (1 if self._active >= self.max_concurrency else 0)
+            wait = rounds * self._service
+            return max(wait, self.requests.wait_time(slot.calls), self.tokens.wait_time(slot.tokens))
+
+    def observe(self, headers):
+        """API のレスポンスヘッダでレート制限の残量を補正する"""
+        def num(name):
+            v = headers.get(name) if headers else None
+            try:
+                return float(v) if v is not None else None
+            except ValueError:
+                return None
+        with self._cv:
+            self.requests.observe(num("x-ratelimit-limit-requests"), num("x-ratelimit-remaining-requests"))
+            self.tokens.observe(num("x-ratelimit-limit-tokens"), num("x-ratelimit-remaining-tokens"))
+
+    # ---- 相乗り（single-flight） ----
+    def join(self, key:str)->tuple[bool, Future]:
+        """同じ key の実行中リクエストがあれば (False, その Future)、無ければ (True, 新しい Future)"""
+        with self._cv:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.stats["coalesced"] += 1
+                return False, fut
+            fut = self._inflight[key] = Future()
+            return True, fut
+
+    def finish(self, key:str, result=None, error:BaseException|None=None):
+        """join() で先頭になった呼び出し側が結果を配る"""
+        with self._cv:
+            fut = self._inflight.pop(key, None)
+        if fut is None:
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+    def snapshot(self)->dict:
+        with self._cv:
+            return {"active": self._active, "queued": sum(len(q) for q in self._queues.values()),
+                    "orgs_waiting": len(self._queues), "avg_service_s": round(self._service, 1), **self.stats}
+
+# ================== 壊れにくい呼び出し ==================
+RETRYABLE = (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+class CircuitOpenError(RuntimeError):
+    """サーキットブレーカーが開いていて呼び出しを行わなかった"""
+
+class CircuitBreaker:
+    """連続 threshold 回失敗したら cooldown 秒は呼び出しを止め、その後 1 件だけ試す（half-open）"""
+
+    def __init__(self, threshold:int=5, cooldown:float=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self)->str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self)->bool:
+        with self._lock:
+            st = self.state
+            if st == "closed":
+                return True
+            if st == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def cancel(self):
+        """allow() で得た試行枠を使わなかったときに返す"""
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        with self._lock:
+            self.failures, self.opened_at, self._trial = 0, None, False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+class CallStream:
+    """ストリーミング応答。最初の本文チャンクまでは読み済みで、残りをそのまま流す"""
+
+    def __init__(self, model:str, resp, head:list, rest):
+        self.model = model
+        self._resp = resp
+        self._it = itertools.chain(head, rest)
+
+    def __iter__(self):
+        return self._it
+
+    def close(self):
+        self._resp.close()
+
+class LLMCaller:
+    """OpenAI のチャット呼び出しを包む。試行ごとに attempt_timeout 秒で打ち切り、
+    再試行可能なエラーは retries 回まで指数バックオフで再試行する。
+    fallback_model があれば、最初のトークンが hedge_after() 秒を過ぎても来ないときに並行して呼ぶ。"""
+
+    def __init__(self, client, model:str, fallback_model:str|None=None, *, attempt_timeout:float=60.0,
+                 retries:int=2, base_delay:float=1.0, hedge:bool=True, hedge_min:float=2.0,
+                 hedge_default:float=8.0, on_headers=None, tracer=None):
+        self.client = client
+        self.model = model
+        self.fallback_model = fallback_model if fallback_model and fallback_model != model else None
+        self.attempt_timeout = attempt_timeout
+        self.retries = retries
+        self.base_delay = base_delay
+        self.hedge = hedge
+        self.hedge_min = hedge_min
+        self.hedge_default = hedge_default
+        self.on_headers = on_headers
+        self.tracer = tracer  # albert_trace.Tracer（任意）
+        self.ttft = LatencyWindow()      # ストリーミング：最初のトークンまで
+        self.complete_s = LatencyWindow()  # 非ストリーミング：応答全体まで（分布が違うので分けて持つ）
+        self.breakers = {m: CircuitBreaker() for m in filter(None, [model, self.fallback_model])}
+        self.stats = {"calls": 0, "retries": 0, "hedged": 0, "hedge_wins": 0, "failfast": 0}
+        self._pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="albert-llm")
+
+    def hedge_after(self, window:LatencyWindow|None=None)->float:
+        """ヘッジを出すまでの待ち時間。十分な実績があれば window（既定は最初のトークンまで）の p95"""
+        window = self.ttft if window is None else window
+        p95 = window.percentile(0.95) if len(window) >= 20 else None
+        return self.hedge_default if p95 is None else max(self.hedge_min, p95)
+
+    # ---- 1 回の試行 ----
+    def _create(self, **kw):
+        raw = self.client.chat.completions.with_raw_response.create(timeout=self.attempt_timeout, **kw)
+        if self.on_headers:
+            self.on_headers(raw.headers)
+        return raw.parse()
+
+    def _span(self, op:str, **attrs):
+        return self.tracer.span(op, **attrs) if self.tracer else nullcontext()
+
+    def _open_stream(self, model:str, kw:dict)->CallStream:
+        t0 = time.monotonic()
+        with self._span("openai.attempt", model=model, stream=True):  # 最初のトークンまで
+            resp = self._create(model=model, stream=True, **kw)
+            it = iter(resp)
+            head = []
+            try:
+                for chunk in it:
+                    head.append(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        break
+            except BaseException:
+                resp.close()
+                raise
+        self.ttft.add(time.monotonic() - t0)
+        return CallStream(model, resp, head, it)
+
+    def _complete(self, model:str, kw:dict):
+        t0 = time.monotonic()
+        with self._span("openai.attempt", model=model, stream=False):
+            r = self._create(model=model, **kw)
+        self.complete_s.add(time.monotonic() - t0)
+        return model, r
+
+    # ---- 再試行・ヘッジ・ブレーカー ----
+    def _models(self)->list[str]:
+        """ブレーカーが通す順に (主, 予備)。どちらも開いていれば即座に失敗"""
+        ms = [m for m in [self.model, self.fallback_model] if m and self.breakers[m].allow()]
+        if not ms:
+            self.stats["failfast"] += 1
+            raise CircuitOpenError("AI サービスへの呼び出しを一時停止しています")
+        return ms
+
+    def _race(self, fn, kw:dict):
+        """主モデルで呼び出し、hedge_after 秒以内に最初の応答が無ければ予備モデルも並行して呼ぶ。
+        主モデルが先に失敗した場合もすぐ予備モデルに切り替える。先に成功した方を返し、負けた方は閉じる"""
+        models = self._models()
+        spare = models[1] if len(models) > 1 else None  # まだ出していない予備
+        limit = self.hedge_after(self.ttft if fn == self._open_stream else self.complete_s)
+        t0 = time.monotonic()
+        submit = lambda m: self._pool.submit(contextvars.copy_context().run, fn, m, kw)  # 試行のスパンを呼び出し元の子にする
+        futs = {submit(models[0]): models[0]}
+        error = None
+        try:
+            while futs:
+                timeout = max(0.0, limit - (time.monotonic() - t0)) if (spare and self.hedge) else None
+                done, _ = wait(futs, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    futs[submit(spare)] = spare
+                    self.stats["hedged"] += 1
+                    spare = None
+                    continue
+                for f in done:
+                    model = futs.pop(f)
+                    self._settle(model, f)
+                    try:
+                        result = f.result()
+                    except Exception as e:
+                        error = error or e
+                        if spare and not futs:
+                            futs[submit(spare)] = spare
+                            spare = None
+                        continue
+                    if model != models[0]:
+                        self.stats["hedge_wins"] += 1
+                    for other in futs:  # 負けた方は結果が出しだい閉じる
+                        other.add_done_callback(_close_result)
+                    return result
+            raise error
+        finally:
+            for f, m in futs.items():  # 結果を見ずに抜けた試行（負けた方・中断）は終わりしだい決着させる
+                f.add_done_callback(functools.partial(self._settle, m))
+            if spare:
+                self.breakers[spare].cancel()  # 使わなかった half-open の試行枠を返す
+
+    def _settle(self, model:str, fut:Future):
+        """試行の結果をブレーカーに伝える。再試行しても通らないエラー（400 など）や中断は
+        障害として数えないが、half-open の試行枠は必ず返す"""
+        b = self.breakers[model]
+        e = None if fut.cancelled() else fut.exception()
+        if fut.cancelled() or (e is not None and not isinstance(e, RETRYABLE)):
+            b.cancel()
+        elif e is None:
+            b.success()
+        else:
+            b.failure()
+
+    def _with_retry(self, op:str, fn, kw:dict):
+        self.stats["calls"] += 1
+        with self._span(op, model=self.model) as span:
+            for attempt in range(self.retries + 1):
+                try:
+                    result = self._race(fn, kw)
+                except RETRYABLE as e:
+                    if span:
+                        span.set(retries=attempt)
+                    if attempt == self.retries:
+                        raise
+                    self.stats["retries"] += 1
+                    delay = self.base_delay * 2 ** attempt * (0.5 + random.random() / 2)  # ジッターで同時再試行を散らす
+                    if isinstance(e, openai.RateLimitError):
+                        delay = max(delay, _retry_after(e))
+                    log.warning("LLM call failed (%r); retry %d in %.1fs", e, attempt + 1, delay)
+                    time.sleep(delay)
+                    continue
+                if span:
+                    span.set(retries=attempt, model=result.model if isinstance(result, CallStream) else result[0])
+                return result
+
+    def stream(self, messages:list, **kw)->CallStream:
+        """最初のトークンまでを再試行・ヘッジ付きで待ち、残りを流す CallStream を返す"""
+        kw = dict(kw, messages=messages, stream_options={"include_usage": True})
+        return self._with_retry("openai.stream", self._open_stream, kw)
+
+    def complete(self, messages:list, **kw):
+        """(使ったモデル, レスポンス) を返す"""
+        return self._with_retry("openai.complete", self._complete, dict(kw, messages=messages))
+
+def _close_result(fut:Future):
+    if not fut.cancelled() and fut.exception() is None:
+        r = fut.result()
+        if isinstance(r, CallStream):
+            r.close()
+
+def _retry_after(e)->float:
+    try:
+        return float(e.response.headers.get("retry-after", 0))
+    except Exception:
+        return 0.0
@@ -0,0 +1,240 @@
+# albert_prompt.py  —— 学校ポリシーのキャッシュとプロンプト組み立て
+"""
+org_policies は組織ごとにプロセス内でキャッシュし、updated_at を版として扱う。
+保存時は invalidate() で明示的に破棄する。キャッシュには結合済みの必須/避け語、
+価値観タグの対応表、組織ごとに固定のシステムプロンプト（静的プレフィックス）も持たせ、
+生成のたびに DB を読まず、プロバイダ側のプレフィックスキャッシュも効くようにする。
+"""
+import os, threading, time, tomllib
+from dataclasses import dataclass, fields
+from functools import lru_cache
+
+from albert_data import get_policy, policy_version
+from albert_scan import Scanner, answer_scanner
+
+PROMPTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "albert_prompts.toml")
+EXAMPLE_CHARS = 600  # 参考例の回答はこの長さで切る
+DEFAULT_MAX_TOKENS = 1200
+
+def length_range(max_tokens:int)->tuple[int, int]:
+    """max_tokens で途中で切れない字数の目安 (下限, 上限)。日本語は 1 字 1 トークン前後なので上限に 15% の余裕を残す"""
+    hi = int(max_tokens * 0.85) // 50 * 50
+    return int(hi * 0.75) // 50 * 50, hi
+
+# ================== プロンプトの素材 ==================
+@dataclass(frozen=True)
+class PromptAssets:
+    """albert_prompts.toml の中身（前後の空白は除いたもの）"""
+    fewshot: str
+    theory_catalog: str
+    repair_fix: str
+
+def load_prompts(path:str=PROMPTS_PATH)->PromptAssets:
+    with open(path, "rb") as f:
+        d = tomllib.load(f)
+    keys = [f.name for f in fields(PromptAssets)]
+    missing = [k for k in keys if not isinstance(d.get(k), str) or not d[k].strip()]
+    if missing:
+        raise ValueError(f"{os.path.basename(path)}: {', '.join(missing)} がありません")
+    return PromptAssets(**{k: d[k].strip() for k in keys})
+
+@lru_cache(maxsize=1)
+def default_prompts()->PromptAssets:
+    """プロセスで 1 回だけ読む既定の素材（アプリは albert_assets の読み直しに追従させる）"""
+    return load_prompts()
+
+# ================== コンパイル済みポリシー ==================
+@dataclass(frozen=True)
+class CompiledPolicy:
+    org_id: object
+    version: str | None
+    row: dict
+    must_include: str
+    avoid_words: str
+    value_mapping: dict
+    system_prefix: str  # 組織・版ごとにバイト単位で不変
+    repair_fix: str
+
+    @property
+    def avoid_phrases(self)->list[str]:
+        return self.row.get("avoid_phrases") or []
+
+    def value_tags(self, values:list[str])->str:
+        tags = set()
+        for v in values or []:
+            tags.update(self.value_mapping.get(v, []))
+        return "｜".join(sorted(tags)) if tags else "（無し）"
+
+    def output_scanner(self, ng:bool)->Scanner:
+        """生成文チェック用の Scanner（同じ避け語の組なら共有される）"""
+        return answer_scanner(self.avoid_phrases, ng=ng)
+
+def compile_policy(row:dict, prompts:PromptAssets|None=None)->CompiledPolicy:
+    prompts = prompts or default_prompts()
+    must_include = "・".join(row.get("must_include") or [])
+    avoid_words = "・".join(row.get("avoid_phrases") or [])
+    phrase = row.get("phrasebook") or {}
+    prefix = "\n" + prompts.fewshot + "\n\n" + f"""
+あなたは教育支援AI「Albert」。先生を支え、子どもの成長と保護者の安心を後押しし、学校の価値観に合う提案だけを返します。
+出力は「ねぎらい→具体策→言い換え（保護者/生徒）→観察→注意」。
+
+【学校ポリシー（要反映）】
+- 必須: {must_include}
+- 避ける言い回し: {avoid_words}
+- フレーズ集: 先生冒頭「{phrase.get('teacher_open','')}」/ 保護者冒頭「{phrase.get('parent_open','')}」
+
+【理論候補】
+{prompts.theory_catalog}
+
+【出力形式（順番厳守 / 分量は与件の指定に従う）】
+0) 先生へのひと言（30〜60字）
+① 背景の見立て（理論タグ1つ）【根拠: 理論名/研究者】
+② 明日ためせる行動レシピ ×3
+  必須: 目的 / 適用条件（学年・場面・所要・準備物）/ 手順（3〜5）/ 声かけ例 / 代替案 / 失敗時の一手 / 観察指標 / 【根拠】 / 価値観タグ
+③ 保護者への伝え方（1行要約＋丁寧文＋家庭での観察1つ）
+④ 子どもへの声かけ（低学年/中高生の2パターン）
+⑤ 成功の観察指標（2つ）
+⑥ 注意とフォロー（安全最優先）
+
+【厳守ルール】
+- 与件の時間制約の範囲で実施可能。抽象で終わらず、数値・固有名詞・具体動作を入れる。
+- 学校ポリシーに反する提案はしない（避け語は出力に含めない）。
+- 思考過程は出さない。最終出力のみ。
+"""
+    return CompiledPolicy(
+        org_id=row.get("org_id"), version=row.get("updated_at"), row=row,
+        must_include=must_include, avoid_words=avoid_words,
+        value_mapping=row.get("value_mapping") or {}, system_prefix=prefix, repair_fix=prompts.repair_fix,
+    )
+
+# ================== プロンプト ==================
+def examples_block(examples)->str:
+    """この組織で good 評価だった似た相談と回答（albert_retrieval の検索結果）"""
+    if not examples:
+        return ""
+    body = "\n".join(f"相談: {e['query']}\n回答:\n{e['answer'][:EXAMPLE_CHARS]}" for e in examples)
+    return f"\n【参考：この学校で好評だった似た相談への回答（写さず、今回の与件に合わせる）】\n{body}\n"
+
+def build_messages(cp:CompiledPolicy, c:dict, repair:bool=False, examples=(),
+                   max_tokens:int|None=DEFAULT_MAX_TOKENS)->list[dict]:
+    """相談 c（consultations の列名と同じキー）から messages を組み立てる。
+    静的なシステムプロンプトを先頭に置き、相談ごとに変わる部分（参考例・生成ルートの分量）はユーザーメッセージに回す。
+    max_tokens=None のときは全体の分量を書かない（分割生成は部分ごとに指定する）"""
+    values = c.get("values") or []
+    value_text = "\n".join([f"- {v}" for v in values]) if values else "（特に指定なし）"
+    safety_block = ""
+    if c.get("sensitive_flag"):
+        sa = c.get("safety_answers") or {}
+        safety_block = f"""
+【安全ガード】
+- 被害側の曝露を避け、分離/見守り/記録/報告を優先。AIは独断で判断しない。
+- “仲直り/その場での謝罪/即対面/被害者の同席強制/一斉の活動強制”は行わない。
+- 具体行動は「誰が・どこで・何を・何分で・想定リスク・代替案」を明記。
+- 安全確認: Q1={sa.get('q1','')} / Q2={sa.get('q2','')} / Q3={sa.get('q3','')}
+"""
+    timebox = c.get("timebox") or "未指定"
+    user = f"""{examples_block(examples)}{safety_block}
+【与件】
+- 価値観：
+{value_text}
+（価値観タグ）{cp.value_tags(values)}
+- 対象：{c.get('grade','')} / 教科：{c.get('subject') or '未指定'} / 規模・場面：{c.get('scene','')} / 頻度：{c.get('frequency','')} / 緊急度：{c.get('urgency','')}
+- 教師の感情：{c.get('emotion','')}
+- 既試行策：{c.get('attempts') or "（未記入）"}
+- 相談内容：「{c.get('message','')}」
+- 時間制約目安：{timebox}
+- {timebox} の範囲で実施可能な提案にする。
+"""
+    if max_tokens is not None:
+        lo, hi = length_range(max_tokens)
+        user += f"- 分量：全体で {lo:,}〜{hi:,}字（⑥ まで書き切る）\n"
+    if c.get("specificity") == "高め（超具体）":
+        user += "\n【追加制約】各レシピは60〜120字で具体化。固有名詞・数値・具体動作を必ず含める。\n"
+    if repair:
+        user += "\n" + cp.repair_fix
+    return [{"role":"system","content": cp.system_prefix}, {"role":"user","content": user}]
+
+# ================== 分割生成 ==================
+@dataclass(frozen=True)
+class Section:
+    key: str
+    heading: str       # 結合時に付ける見出し（同じ見出しが続くときは最初の 1 回だけ）
+    instruction: str
+    max_tokens: int
+    chars: tuple[int, int]  # この部分の字数（max_tokens で切れない範囲）
+
+RECIPE_RULE = "必須: 目的 / 適用条件（学年・場面・所要・準備物）/ 手順（3〜5）/ 声かけ例 / 代替案 / 失敗時の一手 / 観察指標 / 【根拠】 / 価値観タグ"
+SECTIONS = [
+    Section("0", "0) 先生へのひと言", "先生へのひと言を1つ。", 120, (30, 60)),
+    Section("1", "① 背景の見立て", "背景の見立てを理論タグ1つで2〜3文。末尾に【根拠: 理論名/研究者】。", 250, (100, 200)),
+    Section("2a", "② 明日ためせる行動レシピ", f"行動レシピを1つ。観点は「環境・仕組みの調整」。{RECIPE_RULE}", 400, (200, 320)),
+    Section("2b", "② 明日ためせる行動レシピ", f"行動レシピを1つ。観点は「先生の関わり方・声かけ」。{RECIPE_RULE}", 400, (200, 320)),
+    Section("2c", "② 明日ためせる行動レシピ", f"行動レシピを1つ。観点は「役割・仲間との関係づくり」。{RECIPE_RULE}", 400, (200, 320)),
+    Section("3", "③ 保護者への伝え方", "保護者への伝え方（1行要約＋丁寧文＋家庭での観察1つ）。", 300, (150, 250)),
+    Section("4", "④ 子どもへの声かけ", "子どもへの声かけを低学年/中高生の2パターンで。", 200, (80, 160)),
+    Section("5", "⑤ 成功の観察指標", "成功の観察指標を2つ、数えられる形で。", 150, (50, 120)),
+    Section("6", "⑥ 注意とフォロー", "注意とフォロー（安全最優先）を2〜3点。", 200, (80, 160)),
+]
+
+def build_section_messages(cp:CompiledPolicy, c:dict, section:Section, repair:bool=False, examples=())->list[dict]:
+    """build_messages と同じ前半（システム＋与件。全体の分量は書かない）の後ろに、担当部分だけの指示と字数を足す。
+    前半がすべての部分で同じなので、プロバイダ側のプレフィックスキャッシュが共有される。"""
+    lo, hi = section.chars
+    return build_messages(cp, c, repair, examples, max_tokens=None) + [{"role": "user", "content":
+        f"【今回の出力】出力形式のうち次の部分だけを書く。見出しは書かず本文のみ。\n{section.instruction}\n- 分量：{lo}〜{hi}字"}]
+
+def merge_sections(parts:dict)->str:
+    """SECTIONS の順に見出しを付けて結合する（未完了の部分は飛ばす）"""
+    lines, last = [], None
+    for sec in SECTIONS:
+        body = parts.get(sec.key)
+        if body is None:
+            continue
+        if sec.heading != last:
+            lines.append(sec.heading)
+            last = sec.heading
+        lines.append(body.strip())
+    return "\n".join(lines)
+
+# ================== ポリシーキャッシュ ==================
+class PolicyCache:
+    """org_id ごとの CompiledPolicy をプロセス内で共有する。
+    ttl 秒を過ぎたら updated_at だけを問い合わせ、版が変わっていれば取り直す。"""
+
+    def __init__(self, ttl:float=300.0, prompts:PromptAssets|None=None):
+        self.ttl = ttl
+        self.prompts = prompts
+        self._entries: dict = {}  # org_id -> (CompiledPolicy, 確認時刻)
+        self._lock = threading.Lock()
+
+    def get(self, cli, org_id)->CompiledPolicy|None:
+        with self._lock:
+            hit = self._entries.get(org_id)
+        if hit and time.monotonic() - hit[1] < self.ttl:
+            return hit[0]
+        if hit:
+            if policy_version(cli, org_id) == hit[0].version:
+                with self._lock:
+                    self._entries[org_id] = (hit[0], time.monotonic())
+                return hit[0]
+        row = get_policy(cli, org_id)
+        if not row:
+            return None
+        cp = compile_policy(row, self.prompts)
+        with self._lock:
+            self._entries[org_id] = (cp, time.monotonic())
+        return cp
+
+    def invalidate(self, org_id=None):
+        """保存時に呼ぶ。org_id 省略時はすべて破棄"""
+        with self._lock:
+            if org_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(org_id, None)
+
+    def set_prompts(self, prompts:PromptAssets):
+        """プロンプトの素材が変わったら呼ぶ。コンパイル済みのポリシーはすべて作り直す"""
+        with self._lock:
+            self.prompts = prompts
+            self._entries.clear()
@@ -0,0 +1,297 @@
+# albert_retrieval.py  —— 好評だった過去の相談の類似検索（生成時の参考例）
+"""
+組織ごとに、フィードバックで good と評価された回答を、その相談文の文字 n-gram（2・3 文字）の
+TF-IDF で索引し、新しい相談に近いものを上位 k 件返す。返した回答は参考例としてプロンプトに入れる。
+
+索引は転置リスト（語 → 行と重み）を NumPy の配列で持つ。配列は .npy に保存して mmap で読むので、
+再起動しても作り直さず、検索ではクエリの語の転置リストだけを読む。新しい評価は add() でメモリ上の
+差分に足し、差分が merge_every 件を超えたら本体に併合する。重みは索引した時点の IDF で固定し、
+件数が前回の作り直しの 2 倍になったら全体を作り直す（作り直しの費用は 1 件あたり定数に収まる）。
+本文は同じディレクトリの SQLite に持つ。ネットワークを使うのは DB から取り込む sync() だけ。
+書き込むプロセスは 1 ディレクトリにつき 1 つの想定。
+
+使い方（初回の一括作成・作り直し）:
+  SUPABASE_URL=... SUPABASE_SERVICE_ROLE_KEY=... python albert_retrieval.py --root DIR [--org ORG_ID] [--rebuild]
+"""
+import argparse, json, logging, os, re, sqlite3, sys, threading, time, unicodedata, zlib
+
+import numpy as np
+
+from albert_data import get_many, iter_rows, list_policies
+
+log = logging.getLogger(__name__)
+
+DIM = 1 << 20          # n-gram をこの数の語 ID に畳む
+NGRAMS = (2, 3)
+MAX_CHARS = 1000       # 索引・検索に使う相談文の長さの上限
+QUERY_TERMS = 64       # クエリは重みの大きい語だけで引く
+POSTING_BUDGET = 200_000  # 1 回の検索で読む転置リストの合計の上限（重みの大きい語から読む）
+EXAMPLE_FIELDS = ("grade", "scene", "subject", "message", "attempts")
+_SPACE = re.compile(r"\s+")
+
+def consultation_text(c:dict)->str:
+    """相談のうち類似度に使う部分（学年・場面・教科・相談内容・既試行策）"""
+    return " ".join(str(c.get(k) or "") for k in EXAMPLE_FIELDS)
+
+def terms(text:str)->tuple[np.ndarray, np.ndarray]:
+    """正規化した文字列の 2・3 文字 n-gram を (語 ID, 出現回数) にする"""
+    s = _SPACE.sub("", unicodedata.normalize("NFKC", text or "").lower())[:MAX_CHARS]
+    ids = [zlib.crc32(s[i:i + n].encode()) & (DIM - 1) for n in NGRAMS for i in range(len(s) - n + 1)]
+    if not ids:
+        return np.empty(0, np.int32), np.empty(0, np.int32)
+    t, tf = np.unique(np.asarray(ids, np.int32), return_counts=True)
+    return t, tf.astype(np.int32)
+
+# ================== 組織ごとの索引 ==================
+class OrgIndex:
+    """1 組織分の索引。本体（mmap の転置リスト）＋差分（dict）で持つ"""
+
+    FILES = ("terms", "indptr", "rows", "weights")
+
+    def __init__(self, path:str, merge_every:int=500):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.merge_every = merge_every
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(path, "docs.sqlite"), timeout=10, check_same_thread=False)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.execute("create table if not exists docs (row integer primary key, answer_id text unique, query text, answer text)")
+        self._db.execute("create table if not exists meta (key text primary key, value text)")
+        self._db.commit()
+        self._load()
+
+    def _file(self, name:str)->str:
+        return os.path.join(self.path, name + ".npy")
+
+    def _load(self):
+        meta_path = os.path.join(self.path, "meta.json")
+        meta = json.load(open(meta_path)) if os.path.exists(meta_path) else {"rows": 0, "built": 0}
+        if meta["rows"]:
+            self.terms, self.indptr, self.rows, self.weights = (np.load(self._file(f), mmap_mode="r") for f in self.FILES)
+            self.df = np.array(np.load(self._file("df")))  # 差分の追加で書き換えるのでメモリに載せる
+        else:
+            self.terms, self.indptr = np.empty(0, np.int32), np.zeros(1, np.int64)
+            self.rows, self.weights = np.empty(0, np.int32), np.empty(0, np.float32)
+            self.df = np.zeros(DIM, np.int32)
+        self.base, self.built, self.n = meta["rows"], meta["built"], meta["rows"]
+        self.delta: dict = {}  # 語 ID -> ([行], [重み])
+        # 本体に併合していない行は本文から差分を作り直す
+        for row, query in self._db.execute("select row, query from docs where row >= ? order by row", (self.base,)):
+            self._add_delta(row, query)
+
+    def __len__(self)->int:
+        return self.n
+
+    def _weights(self, t:np.ndarray, tf:np.ndarray)->np.ndarray:
+        idf = np.log((1 + self.n) / (1 + self.df[t])) + 1
+        w = (1 + np.log(tf)) * idf
+        return (w / (np.linalg.norm(w) or 1)).astype(np.float32)
+
+    def _add_delta(self, row:int, query:str):
+        t, tf = terms(query)
+        self.df[t] += 1
+        self.n = row + 1
+        for term, w in zip(t.tolist(), self._weights(t, tf).tolist()):
+            d = self.delta.setdefault(term, ([], []))
+            d[0].append(row)
+            d[1].append(w)
+
+    def add(self, docs:list[tuple[str, str, str]])->int:
+        """(answer_id, 相談文, 回答) をまとめて追加し、追加した件数を返す（索引済みの回答は飛ばす）"""
+        added = 0
+        with self._lock:
+            for answer_id, query, answer in docs:
+                cur = self._db.execute("insert or ignore into docs values (?,?,?,?)", (self.n, answer_id, query, answer))
+                if cur.rowcount:
+                    self._add_delta(self.n, query)
+                    added += 1
+            self._db.commit()
+            if self.n - self.base >= self.merge_every:
+                self.merge()
+        return added
+
+    def search(self, query:str, k:int=3, min_score:float=0.1)->list[dict]:
+        """相談文に近い順に最大 k 件 {score, query, answer} を返す"""
+        t, tf = terms(query)
+        if not self._lock.acquire(timeout=0.05):  # 併合・作り直しの最中は参考例なしで進める
+            return []
+        try:
+            if not self.n or not len(t):
+                return []
+            w = self._weights(t, tf)
+            if len(t) > QUERY_TERMS:
+                top = np.argpartition(-w, QUERY_TERMS)[:QUERY_TERMS]
+                t, w = t[top], w[top]
+            scores = np.zeros(self.n, np.float32)
+            if len(self.terms):
+                pos = np.searchsorted(self.terms, t)
+                hit = self.terms[np.minimum(pos, len(self.terms) - 1)] == t
+                budget = POSTING_BUDGET
+                for p, qw in sorted(zip(pos[hit].tolist(), w[hit].tolist()), key=lambda x: -x[1]):
+                    a, b = int(self.indptr[p]), int(self.indptr[p + 1])
+                    if b - a > budget:  # 長すぎる転置リスト（どの相談にも出る語）は読まない
+                        continue
+                    budget -= b - a
+                    scores[self.rows[a:b]] += qw * self.weights[a:b]
+            for term, qw in zip(t.tolist(), w.tolist()):
+                d = self.delta.get(term)
+                if d:
+                    scores[d[0]] += qw * np.asarray(d[1], np.float32)
+            k = min(k, self.n)
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = [int(r) for r in best[np.argsort(-scores[best])] if scores[r] >= min_score]
+            if not best:
+                return []
+            docs = dict((r, (q, a)) for r, q, a in self._db.execute(
+                f"select row, query, answer from docs where row in ({','.join('?' * len(best))})", best))
+        finally:
+            self._lock.release()
+        return [{"score": float(scores[r]), "query": docs[r][0], "answer": docs[r][1]} for r in best]
+
+    # ---------- 併合・作り直し ----------
+    def merge(self):
+        """差分を本体に併合する。前回の作り直しから件数が倍になっていれば IDF ごと作り直す"""
+        with self._lock:
+            if self.n >= 2 * max(self.built, 1):
+                return self.rebuild()
+            if not self.delta:
+                return
+            dt = np.concatenate([np.full(len(r), t, np.int32) for t, (r, _) in self.delta.items()])
+            dr = np.concatenate([np.asarray(r, np.int32) for r, _ in self.delta.values()])
+            dw = np.concatenate([np.asarray(w, np.float32) for _, w in self.delta.values()])
+            bt = np.repeat(self.terms, np.diff(self.indptr))
+            self._save(np.concatenate([bt, dt]), np.concatenate([self.rows, dr]),
+                       np.concatenate([self.weights, dw]), self.built)
+
+    def rebuild(self):
+        """全件を現在の IDF で重み付けし直す"""
+        with self._lock:
+            docs = [terms(q) for (q,) in self._db.execute("select query from docs order by row")]
+            self.n = len(docs)
+            self.df = np.zeros(DIM, np.int32)
+            for t, _ in docs:
+                self.df[t] += 1
+            ws = [self._weights(t, tf) for t, tf in docs]
+            self._save(np.concatenate([t for t, _ in docs] or [np.empty(0, np.int32)]),
+                       np.repeat(np.arange(self.n, dtype=np.int32), [len(t) for t, _ in docs]),
+                       np.concatenate(ws or [np.empty(0, np.float32)]), self.n)
+
+    def _save(self, t:np.ndarray, r:np.ndarray, w:np.ndarray, built:int):
+        order = np.lexsort((r, t))
+        t, r, w = t[order], r[order], w[order]
+        uniq, start = np.unique(t, return_index=True)
+        arrays = {"terms": uniq.astype(np.int32), "indptr": np.append(start, len(t)).astype(np.int64),
+                  "rows": r.astype(np.int32), "weights": w.astype(np.float32), "df": self.df}
+        for name, a in arrays.items():  # 書き終えてから置き換える（読み込み中の mmap は古いファイルを見続ける）
+            tmp = self._file(name) + ".tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, a)
+            os.replace(tmp, self._file(name))
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"rows": self.n, "built": built}, f)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+        self._load()
+
+    # ---------- 取り込みの位置 ----------
+    def get_meta(self, key:str)->str|None:
+        with self._lock:
+            row = self._db.execute("select value from meta where key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key:str, value:str):
+        with self._lock:
+            self._db.execute("insert or replace into meta values (?, ?)", (key, value))
+            self._db.commit()
+
+# ================== 組織をまとめる ==================
+class RetrievalIndex:
+    """org_id ごとの OrgIndex をプロセス内で共有する。
+    sync() は good 評価のフィードバックを前回の位置から取り込み、search() は sync_ttl 秒おきに裏で sync を走らせる"""
+
+    def __init__(self, root:str, merge_every:int=500, sync_ttl:float=300.0):
+        self.root = root
+        self.merge_every = merge_every
+        self.sync_ttl = sync_ttl
+        self._orgs: dict = {}
+        self._synced: dict = {}  # org_id -> 最後に sync を始めた時刻
+        self._lock = threading.Lock()
+
+    def org(self, org_id)->OrgIndex:
+        with self._lock:
+            idx = self._orgs.get(org_id)
+            if idx is None:
+                idx = self._orgs[org_id] = OrgIndex(os.path.join(self.root, str(org_id)), self.merge_every)
+            return idx
+
+    def add(self, org_id, items:list[tuple[str, dict, str]])->int:
+        """good 評価が付いた (answer_id, 相談, 回答) を索引に足す（センシティブな相談は参考例にしない）"""
+        docs = [(str(aid), consultation_text(c), text) for aid, c, text in items
+                if text and not c.get("sensitive_flag")]
+        return self.org(org_id).add(docs) if docs else 0
+
+    def search(self, org_id, consultation:dict, k:int=2, cli=None)->list[dict]:
+        if cli is not None:
+            self.sync_later(cli, org_id)
+        return self.org(org_id).search(consultation_text(consultation), k)
+
+    def sync_later(self, cli, org_id):
+        """前回から sync_ttl 秒たっていれば、裏のスレッドで sync する（検索は待たない）"""
+        with self._lock:
+            if time.monotonic() - self._synced.get(org_id, -self.sync_ttl) < self.sync_ttl:
+                return
+            self._synced[org_id] = time.monotonic()
+        def run():
+            try:
+                self.sync(cli, org_id)
+            except Exception as e:
+                log.warning("retrieval sync failed for %s: %r", org_id, e)
+        threading.Thread(target=run, name="albert-retrieval-sync", daemon=True).start()
+
+    def sync(self, cli, org_id, page:int=500)->int:
+        """good 評価のフィードバックを前回の位置から読み、未索引の回答を足す。足した件数を返す"""
+        idx = self.org(org_id)
+        added = 0
+        for fbs in _pages(iter_rows(cli, "feedbacks", ("answer_id",), org_id=org_id,
+                                    since=idx.get_meta("feedback_since"), filters=[("rating", "good")], page=page), page):
+            answers = {a["id"]: a for a in get_many(cli, "answers", ("consultation_id", "text"), [f["answer_id"] for f in fbs])}
+            cons = {c["id"]: c for c in get_many(cli, "consultations", EXAMPLE_FIELDS + ("sensitive_flag",),
+                                                 [a["consultation_id"] for a in answers.values()])}
+            added += self.add(org_id, [(a["id"], cons[a["consultation_id"]], a["text"])
+                                       for a in answers.values() if a["consultation_id"] in cons])
+            idx.set_meta("feedback_since", fbs[-1]["created_at"])
+        return added
+
+def _pages(rows, size:int):
+    buf = []
+    for r in rows:
+        buf.append(r)
+        if len(buf) == size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="good 評価の回答から類似検索の索引を作る")
+    ap.add_argument("--root", required=True, help="索引のディレクトリ（アプリの RETRIEVAL_DIR と同じ）")
+    ap.add_argument("--org", help="対象の org_id（省略時は全組織）")
+    ap.add_argument("--rebuild", action="store_true", help="取り込み後に IDF ごと作り直す")
+    args = ap.parse_args(argv)
+
+    url, key = os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+    if not (url and key):
+        sys.exit("SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY を環境変数に設定してください。")
+    from supabase import create_client
+    cli = create_client(url, key)
+
+    index = RetrievalIndex(args.root)
+    for pol in list_policies(cli, ("org_id",), org_id=args.org):
+        t0 = time.perf_counter()
+        added = index.sync(cli, pol["org_id"])
+        idx = index.org(pol["org_id"])
+        idx.rebuild() if args.rebuild else idx.merge()
+        print(f"{pol['org_id']}: added={added} docs={len(idx)} ({time.perf_counter()-t0:.1f}s)")
+
+if __name__ == "__main__":
+    main()
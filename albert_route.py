@@ -0,0 +1,101 @@
+# albert_route.py  —— 相談の内容に応じた生成ルート（モデル・トークン上限・温度・ストリーミング）の選択
+"""
+フォームの urgency / specificity / sensitive_flag / timebox を見て、生成に使うルートを選ぶ。
+ルールは上から順に照合し、最初に一致したルートを使う（一致しなければ default）。
+センシティブな相談と緊急度の高い相談は主モデル（OPENAI_MODEL）、ふだんの相談は速くて安いモデル
+（OPENAI_FAST_MODEL、未設定なら主モデル）に回す。
+
+secrets の OPENAI_ROUTES で既定を上書きできる:
+  [OPENAI_ROUTES.routes.standard]
+  model = "gpt-4o-mini"
+  max_tokens = 900
+  [[OPENAI_ROUTES.rules]]
+  route = "urgent"
+  urgency = ["中", "高"]
+rules を書いた場合は既定のルールを置き換える。max_tokens に合わせてプロンプトで求める字数も変わる
+（albert_prompt.length_range）。ルートの所要時間と評価は answers.route に残し、
+route_stats RPC（supabase/migrations）で集計する。
+"""
+from dataclasses import dataclass, field, fields, replace
+
+MATCH_FIELDS = ("urgency", "specificity", "sensitive_flag", "timebox")
+
+@dataclass(frozen=True)
+class Route:
+    name: str
+    model: str
+    fallback_model: str | None = None
+    max_tokens: int = 1200
+    temperature: float = 0.45
+    stream: bool = True
+
+    @property
+    def repair_temperature(self)->float:
+        """作り直しは少し低めの温度で"""
+        return min(self.temperature, 0.4)
+
+@dataclass(frozen=True)
+class Rule:
+    route: str
+    when: dict = field(default_factory=dict)  # 列 -> 値 または 値のリスト（すべて満たせば一致）
+
+    def matches(self, c:dict)->bool:
+        for k, want in self.when.items():
+            v = bool(c.get(k)) if k == "sensitive_flag" else c.get(k)
+            if v not in (want if isinstance(want, (list, tuple)) else [want]):
+                return False
+        return True
+
+DEFAULT_RULES = [
+    Rule("sensitive", {"sensitive_flag": True}),
+    Rule("urgent", {"urgency": "高"}),
+    Rule("detailed", {"specificity": "高め（超具体）"}),
+    Rule("quick", {"timebox": ["~5分", "~10分"]}),
+]
+
+def default_routes(model:str, fast_model:str|None=None, fallback_model:str|None=None, stream:bool=True)->dict:
+    fast = fast_model or model
+    return {r.name: r for r in [
+        Route("sensitive", model, fallback_model, 1400, 0.3, stream),   # 安全最優先：主モデル・低温度
+        Route("urgent", model, fallback_model, 1200, 0.45, stream),
+        Route("detailed", model, fallback_model, 1400, 0.45, stream),
+        Route("quick", fast, fallback_model, 900, 0.45, stream),        # 短時間で実施できる提案は短めに
+        Route("standard", fast, fallback_model, 1100, 0.45, stream),
+    ]}
+
+class Router:
+    def __init__(self, routes:dict, rules:list[Rule], default:str="standard"):
+        unknown = {r.route for r in rules if r.route not in routes} | ({default} - set(routes))
+        if unknown:
+            raise ValueError(f"未定義のルートです: {', '.join(sorted(unknown))}")
+        for r in rules:
+            bad = set(r.when) - set(MATCH_FIELDS)
+            if bad:
+                raise ValueError(f"ルール {r.route} の条件に使えない列です: {', '.join(sorted(bad))}")
+        self.routes = routes
+        self.rules = rules
+        self.default = default
+
+    @classmethod
+    def from_config(cls, cfg:dict|None, model:str, fast_model:str|None=None, fallback_model:str|None=None,
+                    stream:bool=True)->"Router":
+        """既定のルートとルールに cfg（OPENAI_ROUTES）を重ねる"""
+        cfg = dict(cfg or {})
+        routes = default_routes(model, fast_model, fallback_model, stream)
+        settable = {f.name for f in fields(Route)} - {"name"}
+        for name, over in dict(cfg.get("routes") or {}).items():
+            bad = set(dict(over)) - settable
+            if bad:
+                raise ValueError(f"ルート {name} に使えない項目です: {', '.join(sorted(bad))}")
+            base = routes.get(name) or Route(name, model, fallback_model, stream=stream)
+            routes[name] = replace(base, **dict(over))
+        rules = DEFAULT_RULES
+        if "rules" in cfg:
+            rules = [Rule(r["route"], {k: v for k, v in dict(r).items() if k != "route"}) for r in cfg["rules"]]
+        return cls(routes, rules, cfg.get("default", "standard"))
+
+    def choose(self, c:dict)->Route:
+        for rule in self.rules:
+            if rule.matches(c):
+                return self.routes[rule.route]
+        return self.routes[self.default]
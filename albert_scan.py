@@ -0,0 +1,166 @@
+# albert_scan.py  —— 安全/NG/トピック/ポリシー判定のためのテキスト走査エンジン
+"""
+パターン集合を一度だけ 1 本の正規表現（選択）にコンパイルし、
+大半を占める「何もヒットしない文章」は C 実装の 1 回の走査で判定する。
+全ヒットの列挙も 1 回の走査で行う。各パターンの先頭リテラルの 1 文字目を文字クラスにまとめて
+候補位置を C 実装で拾い、その位置で先頭が合うパターンだけを照合する（Aho-Corasick の代わり）。
+"""
+import hashlib, json, re
+from functools import lru_cache
+from typing import Iterable, NamedTuple
+
+# ================== ルール ==================
+SENSITIVE_KEYS = [
+    "いじめ","いじ(め|り)","暴力","殴","蹴","排除","無視","仲間はずれ","脅",
+    "金(を|の)要求","晒し","SNS","ネットいじめ","自傷","自殺","死にたい",
+    "ハラスメント","性(的|被害)","体罰","恐喝","集団で","標的","陰口"
+]
+NG_PHRASES = [
+    "その場で(謝|和解)させる","仲直りさせる","両者をすぐ対面させる",
+    "被害者.*同席させる","全員で.*活動させる","我慢させる","許させる","被害者.*配慮なく"
+]
+TOPIC_RULES = [
+    (r"いじめ|暴力|脅|自傷|自殺|安全|被害", "安全/人間関係"),
+    (r"保護者|家庭|連絡|面談", "保護者対応"),
+    (r"提出|宿題|課題|忘れ|未提出", "課題・提出"),
+    (r"遅刻|欠席|不登校|登校しぶり", "出欠"),
+    (r"集中|立ち歩き|私語|規律|荒れ", "授業規律"),
+    (r"評価|テスト|成績|アセスメント", "評価"),
+    (r"友だち|仲間|グループ|孤立", "関係性"),
+]
+
+# ================== エンジン ==================
+class Hit(NamedTuple):
+    category: str
+    pattern: str
+    start: int
+    end: int
+
+_META = set(".^$*+?{}[]\\|()")
+
+def _split_top(pattern:str)->list[str]:
+    """トップレベルの | で分割する（括弧・文字クラス・エスケープの内側は分割しない）"""
+    parts, buf, depth, in_class, i = [], [], 0, False, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\" and i + 1 < len(pattern):
+            buf.append(pattern[i:i+2]); i += 2; continue
+        if in_class:
+            in_class = ch != "]"
+        elif ch == "[":
+            in_class = True
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "|" and depth == 0:
+            parts.append("".join(buf)); buf = []; i += 1; continue
+        buf.append(ch); i += 1
+    parts.append("".join(buf))
+    return parts
+
+def _head_literal(alt:str)->str:
+    """選択肢を含まないパターンが一致するとき必ず先頭に現れるリテラル（無ければ空文字）"""
+    head, i = "", 0
+    while i < len(alt):
+        ch = alt[i]
+        if ch == "\\" and i + 1 < len(alt) and not alt[i+1].isalnum():
+            ch, step = alt[i+1], 2
+        elif ch in _META:
+            break
+        else:
+            step = 1
+        if alt[i+step:i+step+1] in ("*", "?", "{"):  # 数量子が付く文字は必須ではない
+            break
+        head += ch; i += step
+    return head
+
+class Scanner:
+    """(カテゴリ, パターン) の集合を一度だけコンパイルして使い回す走査器"""
+
+    def __init__(self, patterns:Iterable[tuple[str, str]]):
+        self.patterns = [(cat, pat) for cat, pat in patterns if pat]
+        self._any = re.compile("|".join(f"(?:{pat})" for _, pat in self.patterns)) if self.patterns else None
+        by_cat = {}
+        for cat, pat in self.patterns:
+            by_cat.setdefault(cat, []).append(f"(?:{pat})")
+        self._by_cat = [(cat, re.compile("|".join(pats))) for cat, pats in by_cat.items()]
+        # 先頭文字 -> [(先頭リテラル, 番号, コンパイル済み)]。先頭が決まらないパターンは個別に finditer する
+        self._heads, self._rest = {}, []
+        for i, (cat, pat) in enumerate(self.patterns):
+            rx = re.compile(pat)
+            heads = [_head_literal(a) for a in _split_top(pat)]
+            if all(heads):
+                for h in set(heads):
+                    self._heads.setdefault(h[0], []).append((h, i, rx))
+            else:
+                self._rest.append((i, rx))
+        self._cand = re.compile("[" + "".join(re.escape(c) for c in self._heads) + "]") if self._heads else None
+
+    def search(self, text:str)->bool:
+        """いずれかのパターンに一致するか（1 回の走査）"""
+        return bool(text and self._any and self._any.search(text))
+
+    def scan(self, text:str)->list[Hit]:
+        """全ヒットを (カテゴリ, パターン, 開始, 終了) で返す。重なるヒットもすべて含む
+        （同じパターンのヒットどうしは re.finditer と同じく重ならない）"""
+        first = self._any.search(text) if text and self._any else None
+        if first is None:
+            return []
+        hits, ends = [], [0] * len(self.patterns)
+        if self._cand:
+            for c in self._cand.finditer(text, first.start()):
+                pos = c.start()
+                for head, i, rx in self._heads[c.group()]:
+                    if pos >= ends[i] and text.startswith(head, pos) and (m := rx.match(text, pos)):
+                        hits.append(Hit(*self.patterns[i], pos, m.end()))
+                        ends[i] = m.end()
+        for i, rx in self._rest:
+            hits.extend(Hit(*self.patterns[i], m.start(), m.end()) for m in rx.finditer(text, first.start()))
+        hits.sort(key=lambda h: (h.start, h.end))
+        return hits
+
+    def categories(self, text:str)->list[str]:
+        """ヒットしたカテゴリを定義順に返す（位置は求めず、カテゴリごとに最初の一致で打ち切る）"""
+        if not self.search(text):
+            return []
+        return [cat for cat, rx in self._by_cat if rx.search(text)]
+
+@lru_cache(maxsize=256)
+def compile_scanner(patterns:tuple[tuple[str, str], ...])->Scanner:
+    """同じパターン集合の Scanner はプロセス内で共有する"""
+    return Scanner(patterns)
+
+MESSAGE_SCANNER = compile_scanner(
+    tuple(("sensitive", p) for p in SENSITIVE_KEYS) + tuple((tag, p) for p, tag in TOPIC_RULES)
+)
+SENSITIVE_SCANNER = compile_scanner(tuple(("sensitive", p) for p in SENSITIVE_KEYS))
+NG_SCANNER = compile_scanner(tuple(("ng", p) for p in NG_PHRASES))
+
+def answer_scanner(avoid_phrases:Iterable[str], ng:bool=True)->Scanner:
+    """生成文チェック用：NG 表現（ng=True の場合）と学校ポリシーの避け語をまとめた Scanner"""
+    pats = tuple(("ng", p) for p in NG_PHRASES) if ng else ()
+    pats += tuple(("avoid", re.escape(p)) for p in (avoid_phrases or []) if p)
+    return compile_scanner(pats)
+
+def classify_topics(message:str)->list[str]:
+    """相談内容のトピックタグ（該当なしは「未分類」）"""
+    topics = [cat for cat in MESSAGE_SCANNER.categories(message) if cat != "sensitive"]
+    return topics or ["未分類"]
+
+def rules_fingerprint(avoid_phrases:Iterable[str])->str:
+    """NG 表現と避け語の組の指紋。answers.facts_version と比べて再計算が必要か判定する"""
+    key = json.dumps([NG_PHRASES, sorted(p for p in (avoid_phrases or []) if p)], ensure_ascii=False)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+def answer_facts(text:str, avoid_phrases:Iterable[str])->dict:
+    """生成文から保存用の派生値（answers の列）を求める"""
+    avoid = [p for p in (avoid_phrases or []) if p]
+    original = {re.escape(p): p for p in avoid}
+    hits = answer_scanner(avoid).scan(text or "")
+    return {
+        "avoid_hits": list(dict.fromkeys(original[h.pattern] for h in hits if h.category == "avoid")),
+        "ng_hits": list(dict.fromkeys(h.pattern for h in hits if h.category == "ng")),
+        "output_chars": len(text or ""),
+        "facts_version": rules_fingerprint(avoid),
+    }
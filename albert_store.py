@@ -0,0 +1,107 @@
+# albert_store.py  —— Supabase への書き込み（1 往復の保存と write-behind キュー）
+"""
+相談と回答は save_consultation RPC で 1 回の往復・1 トランザクションで保存する。
+ID はクライアント側で採番するので、保存の完了を待たずにフィードバックから参照でき、
+再試行しても二重に書き込まれない。書き込みは WriteBehind のワーカースレッドが、同じセッションの分は順番に実行する。
+"""
+import collections, logging, queue, threading, time, uuid
+from concurrent.futures import Future
+from datetime import datetime, timezone
+
+log = logging.getLogger(__name__)
+
+def new_id()->str:
+    return str(uuid.uuid4())
+
+def utcnow_iso()->str:
+    return datetime.now(timezone.utc).isoformat()
+
+# ================== 書き込み ==================
+def save_consultation(cli, consultation:dict, answer:dict)->dict:
+    """consultations と answers を 1 回の RPC で保存し {consultation_id, answer_id} を返す"""
+    return cli.rpc("save_consultation", {"p_consultation": consultation, "p_answer": answer}).execute().data
+
+def save_feedback(cli, feedback:dict):
+    """feedbacks を保存する（id 指定なので再試行しても重複しない）"""
+    return cli.table("feedbacks").upsert(feedback, on_conflict="id", ignore_duplicates=True).execute()
+
+# ================== write-behind キュー ==================
+def retryable(e:Exception)->bool:
+    """データ不正・制約違反・権限エラー（SQLSTATE 22/23/42 系）は再試行しても通らない"""
+    code = getattr(e, "code", None)
+    return not (isinstance(code, str) and code[:2] in ("22", "23", "42"))
+
+class WriteBehind:
+    """書き込みを描画から切り離して workers 本のワーカーで実行する。
+    同じ key（セッションなど）の書き込みは投入順に 1 件ずつ、別の key どうしは並行に実行するので、
+    再試行中の書き込みが他のセッションを待たせない。key を省くと順序は問わない。
+    失敗時は指数バックオフで再試行し、結果は submit() が返す Future で確認できる。"""
+
+    def __init__(self, workers:int=4, retries:int=5, base_delay:float=0.5, max_delay:float=30.0):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"done": 0, "retried": 0, "failed": 0}
+        self._lock = threading.Condition()
+        self._lanes: dict = {}            # key -> 投入順の書き込み（先頭が実行中または実行待ち）
+        self._ready: queue.Queue = queue.Queue()  # 先頭を実行できる key
+        self._unfinished = 0
+        self._threads = [threading.Thread(target=self._run, name=f"albert-write-behind-{i}", daemon=True)
+                         for i in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, label:str, fn, *args, key=None, **kwargs)->Future:
+        fut = Future()
+        key = object() if key is None else key
+        with self._lock:
+            self._unfinished += 1
+            lane = self._lanes.get(key)
+            if lane is None:
+                self._lanes[key] = collections.deque([(label, fn, args, kwargs, fut)])
+                self._ready.put(key)
+            else:
+                lane.append((label, fn, args, kwargs, fut))
+        return fut
+
+    def pending(self)->int:
+        return self._unfinished
+
+    def flush(self, timeout:float|None=None)->bool:
+        """キューが空になるまで待つ（バッチ処理や終了時用）。時間内に空になれば True"""
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._unfinished, timeout)
+
+    def _count(self, name:str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                label, fn, args, kwargs, fut = self._lanes[key][0]
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        fut.set_result(fn(*args, **kwargs))
+                        self._count("done")
+                        break
+                    except Exception as e:
+                        if attempt == self.retries or not retryable(e):
+                            self._count("failed")
+                            log.error("write-behind: %s failed after %d attempt(s): %r", label, attempt + 1, e)
+                            fut.set_exception(e)
+                            break
+                        self._count("retried")
+                        time.sleep(min(self.max_delay, self.base_delay * 2 ** attempt))
+            finally:
+                with self._lock:
+                    lane = self._lanes[key]
+                    lane.popleft()
+                    if lane:
+                        self._ready.put(key)  # 同じ key の次の書き込み
+                    else:
+                        del self._lanes[key]
+                    self._unfinished -= 1
+                    self._lock.notify_all()
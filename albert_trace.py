@@ -0,0 +1,290 @@
+# albert_trace.py  —— 再実行・外部呼び出しごとの計測（スパン）と集計
+"""
+Tracer.span() で囲んだ区間をスパンとして記録する。スパンは呼び出し元のスパンを親に持ち、
+org / user 属性を親から引き継ぐ。終わったスパンはキューに積み、書き出しスレッドが
+ローカルの SQLite（MetricsStore）と、指定があれば Prometheus テキスト / OTLP JSON 行ファイルに書く。
+画面側の処理はキューに積むところまでしか待たない。
+
+Prometheus テキストは node_exporter の textfile collector などから読む想定で、interval 秒ごとに
+丸ごと書き直す。OTLP ファイルは 1 行 1 スパンの OTLP/JSON（resourceSpans）で追記する。
+"""
+import contextvars, json, logging, os, queue, sqlite3, threading, time, uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+INHERIT = ("org", "user")  # 子スパンが親から引き継ぐ属性
+COLUMNS = ("model", "prompt_tokens", "completion_tokens", "cache_hit", "retries")  # 集計用に列で持つ属性
+
+class LatencyWindow:
+    """直近 size 件の所要時間からパーセンタイルを求める"""
+
+    def __init__(self, size:int=200):
+        self._xs = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, x:float):
+        with self._lock:
+            self._xs.append(x)
+
+    def __len__(self):
+        return len(self._xs)
+
+    def percentile(self, q:float)->float|None:
+        with self._lock:
+            xs = sorted(self._xs)
+        if not xs:
+            return None
+        return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "op", "start", "duration_ms", "attrs", "error")
+
+    def __init__(self, op:str, parent:"Span|None", attrs:dict):
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.op = op
+        self.start = time.time()
+        self.duration_ms = 0.0
+        self.attrs = {k: parent.attrs[k] for k in INHERIT if parent and k in parent.attrs}
+        self.attrs.update(attrs)
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+_current: contextvars.ContextVar = contextvars.ContextVar("albert_span", default=None)
+
+class Tracer:
+    """スパンの記録と書き出し。集計（分位点・トークン数）はプロセス内でも持ち、Prometheus テキストに出す"""
+
+    def __init__(self, store:"MetricsStore|None"=None, prom_file:str|None=None, otlp_file:str|None=None,
+                 interval:float=15.0, service:str="albert"):
+        self.store = store
+        self.prom_file = prom_file
+        self.otlp_file = otlp_file
+        self.interval = interval
+        self.service = service
+        self.windows: dict = defaultdict(LatencyWindow)     # op -> 直近の所要時間（ミリ秒）
+        self.counts: dict = defaultdict(lambda: [0, 0.0, 0])  # op -> [件数, 合計ミリ秒, エラー数]
+        self.tokens: dict = defaultdict(int)                  # (org, model, kind) -> トークン数
+        self._lock = threading.Lock()
+        self._q: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="albert-trace", daemon=True)
+        self._thread.start()
+
+    def current(self)->Span|None:
+        return _current.get()
+
+    @contextmanager
+    def span(self, op:str, **attrs):
+        s = Span(op, _current.get(), attrs)
+        token = _current.set(s)
+        t0 = time.perf_counter()
+        try:
+            yield s
+        except Exception as e:  # st.stop() / st.rerun() は BaseException なのでエラーに数えない
+            s.error = type(e).__name__
+            raise
+        finally:
+            s.duration_ms = (time.perf_counter() - t0) * 1000
+            _current.reset(token)
+            self.finish(s)
+
+    def record(self, op:str, duration_ms:float, error:str|None=None, **attrs):
+        """計り終わった区間を現在のスパンの子として記録する（HTTP フックなど用）"""
+        s = Span(op, _current.get(), attrs)
+        s.start -= duration_ms / 1000
+        s.duration_ms = duration_ms
+        s.error = error
+        self.finish(s)
+
+    def finish(self, s:Span):
+        with self._lock:
+            self.windows[s.op].add(s.duration_ms)
+            c = self.counts[s.op]
+            c[0] += 1
+            c[1] += s.duration_ms
+            c[2] += s.error is not None
+            for kind in ("prompt_tokens", "completion_tokens"):
+                if s.attrs.get(kind):
+                    self.tokens[(s.attrs.get("org"), s.attrs.get("model"), kind)] += s.attrs[kind]
+        self._q.put(s)
+
+    def flush(self, timeout:float=5.0):
+        """キューに積んだスパンを書き出し終えるまで待つ"""
+        deadline = time.monotonic() + timeout
+        while self._q.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    # ---- 書き出し ----
+    def _run(self):
+        last_prom = last_prune = 0.0
+        while True:
+            batch = []
+            try:
+                batch.append(self._q.get(timeout=self.interval))
+                while len(batch) < 500:
+                    batch.append(self._q.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                if batch and self.store:
+                    self.store.insert(batch)
+                if batch and self.otlp_file:
+                    self._write_otlp(batch)
+                if self.prom_file and time.monotonic() - last_prom >= self.interval:
+                    self._write_prom()
+                    last_prom = time.monotonic()
+                if self.store and time.monotonic() - last_prune >= self.store.prune_every:
+                    last_prune = time.monotonic()  # 失敗しても次の周期まで試さない
+                    self.store.prune()
+            except Exception as e:
+                log.warning("trace export failed: %r", e)
+            finally:
+                for _ in batch:
+                    self._q.task_done()
+
+    def _write_otlp(self, spans:list[Span]):
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+        out = [{
+            "traceId": s.trace_id, "spanId": s.span_id, "parentSpanId": s.parent_id or "", "name": s.op,
+            "startTimeUnixNano": str(int(s.start * 1e9)),
+            "endTimeUnixNano": str(int((s.start + s.duration_ms / 1000) * 1e9)),
+            "attributes": [{"key": k, "value": value(v)} for k, v in s.attrs.items() if v is not None],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+        } for s in spans]
+        doc = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service}}]},
+            "scopeSpans": [{"scope": {"name": "albert_trace"}, "spans": out}],
+        }]}
+        with open(self.otlp_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+
+    def prometheus_text(self)->str:
+        with self._lock:
+            ops = {op: (list(c), self.windows[op]) for op, c in self.counts.items()}
+            tokens = dict(self.tokens)
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"')
+        lines = ["# HELP albert_op_duration_seconds 操作ごとの所要時間（直近の窓の分位点）",
+                 "# TYPE albert_op_duration_seconds summary"]
+        for op, ((n, total, _), w) in sorted(ops.items()):
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f'albert_op_duration_seconds{{op="{esc(op)}",quantile="{q}"}} {w.percentile(q) / 1000:.6f}')
+            lines.append(f'albert_op_duration_seconds_sum{{op="{esc(op)}"}} {total / 1000:.6f}')
+            lines.append(f'albert_op_duration_seconds_count{{op="{esc(op)}"}} {n}')
+        lines += ["# HELP albert_op_errors_total 操作ごとのエラー数", "# TYPE albert_op_errors_total counter"]
+        for op, ((_, _, err), _) in sorted(ops.items()):
+            lines.append(f'albert_op_errors_total{{op="{esc(op)}"}} {err}')
+        lines += ["# HELP albert_tokens_total 組織・モデルごとのトークン数", "# TYPE albert_tokens_total counter"]
+        for (org, model, kind), n in sorted(tokens.items(), key=lambda kv: tuple(map(str, kv[0]))):
+            lines.append(f'albert_tokens_total{{org="{esc(org)}",model="{esc(model)}",kind="{kind}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def _write_prom(self):
+        tmp = self.prom_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, self.prom_file)  # 読み手に書きかけを見せない
+
+# ================== ローカルの集計ストア ==================
+class MetricsStore:
+    """スパンを SQLite に保存し、管理画面向けに操作ごとの分位点と組織ごとのトークン数を返す。
+    keep_days より古いスパンは、開いたときと Tracer の書き出しスレッドから prune_every 秒ごとに消す"""
+
+    def __init__(self, path:str, keep_days:float=14, prune_every:float=3600):
+        self.path = path
+        self.keep_days = keep_days
+        self.prune_every = prune_every
+        with self._connect() as db:
+            db.execute("""create table if not exists spans (
+                ts real, trace_id text, span_id text, parent_id text, op text, duration_ms real,
+                org text, user_id text, model text, prompt_tokens integer, completion_tokens integer,
+                cache_hit integer, retries integer, error text, attrs text)""")
+            db.execute("create index if not exists spans_op_ts on spans (op, ts)")
+            db.execute("create index if not exists spans_ts on spans (ts)")
+        self.prune()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute("pragma journal_mode=wal")
+        return db
+
+    def prune(self)->int:
+        """保存期間を過ぎたスパンを消し、消した件数を返す"""
+        with self._connect() as db:
+            return db.execute("delete from spans where ts < ?", (time.time() - self.keep_days * 86400,)).rowcount
+
+    def insert(self, spans:list[Span]):
+        rows = [(s.start, s.trace_id, s.span_id, s.parent_id, s.op, s.duration_ms,
+                 _str(s.attrs.get("org")), _str(s.attrs.get("user")),
+                 *(s.attrs.get(k) for k in COLUMNS), s.error,
+                 json.dumps({k: v for k, v in s.attrs.items() if k not in COLUMNS + INHERIT},
+                            ensure_ascii=False, default=str))
+                for s in spans]
+        with self._connect() as db:
+            db.executemany("insert into spans values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+
+    def latency(self, since:float, org:str|None=None)->list[dict]:
+        """操作ごとの件数・エラー数・p50/p95/p99（ミリ秒）。org を渡すとその組織のスパンだけで求める"""
+        by_op = defaultdict(list)
+        errors = defaultdict(int)
+        sql, args = "select op, duration_ms, error from spans where ts >= ?", (since,)
+        if org is not None:
+            sql, args = sql + " and org = ?", args + (org,)
+        with self._connect() as db:
+            for op, ms, err in db.execute(sql, args):
+                by_op[op].append(ms)
+                errors[op] += err is not None
+        out = []
+        for op, xs in sorted(by_op.items()):
+            xs.sort()
+            pct = lambda q: round(xs[min(len(xs) - 1, int(q * len(xs)))], 1)
+            out.append({"op": op, "count": len(xs), "errors": errors[op],
+                        "p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99)})
+        return out
+
+    def token_spend(self, since:float)->list[dict]:
+        """組織・モデルごとのトークン数"""
+        with self._connect() as db:
+            rows = db.execute("""select org, model, count(*), coalesce(sum(prompt_tokens), 0), coalesce(sum(completion_tokens), 0),
+                                        coalesce(sum(cache_hit), 0)
+                                 from spans where ts >= ? and (prompt_tokens > 0 or completion_tokens > 0 or cache_hit)
+                                 group by org, model order by sum(prompt_tokens) + sum(completion_tokens) desc""",
+                              (since,)).fetchall()
+        keys = ("org", "model", "calls", "prompt_tokens", "completion_tokens", "cache_hits")
+        return [dict(zip(keys, r)) for r in rows]
+
+def _str(v):
+    return None if v is None else str(v)
+
+# ================== HTTP クライアントの計測 ==================
+def instrument_httpx(client, tracer:Tracer, prefix:str):
+    """httpx.Client のイベントフックで 1 リクエストごとにスパンを記録する（同じクライアントには 1 回だけ）。
+    操作名は URL の末尾（テーブル名、RPC なら rpc/関数名）。応答ヘッダを受け取るまでの時間を計る"""
+    if client is None or getattr(client, "_albert_traced", False):
+        return
+    def on_request(request):
+        request.extensions["albert_t0"] = time.perf_counter()
+    def on_response(response):
+        req = response.request
+        t0 = req.extensions.get("albert_t0")
+        if t0 is None:
+            return
+        parts = req.url.path.rstrip("/").split("/")
+        name = "/".join(parts[-2:]) if len(parts) >= 2 and parts[-2] == "rpc" else parts[-1]
+        tracer.record(f"{prefix}.{name}", (time.perf_counter() - t0) * 1000,
+                      error=f"HTTP {response.status_code}" if response.status_code >= 400 else None,
+                      method=req.method, status=response.status_code)
+    client.event_hooks["request"].append(on_request)
+    client.event_hooks["response"].append(on_response)
+    client._albert_traced = True
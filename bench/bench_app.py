@@ -0,0 +1,283 @@
+# bench/bench_app.py  —— streamlit_app.py のオフライン・ベンチマーク / 負荷試験
+"""
+使い方: python bench/bench_app.py [--iters 10] [--sessions 8] [--ttft 0.3] [--db-latency 0.005] [--out bench_output.txt]
+
+streamlit_app.py を AppTest でヘッドレス実行し、bench/fake_services.py のローカル Supabase と
+OpenAI 互換サーバーに向けて次を測る（秘密情報もネットワークも不要）。
+- 新しいプロセスでのログイン画面の初回表示（コールドスタート）とログイン、重い依存の読み込みの有無
+- メニューごとの再実行レイテンシと DB 往復数
+- 生成の所要時間（LLM 呼び出し・応答キャッシュのヒット時）と 1 回の送信あたりの DB 往復数
+- フィードバック保存の所要時間と DB 往復数
+- エラー注入（500 / 429）時の成功率とレイテンシ
+- N セッション同時の処理量
+結果は標準出力と --out（既定はリポジトリ直下の bench_output.txt）に書く。
+"""
+import argparse, json, os, statistics, subprocess, sys, tempfile, time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+APP = os.path.join(ROOT, "streamlit_app.py")
+sys.path[:0] = [ROOT, BENCH]
+
+from streamlit.testing.v1 import AppTest
+
+from fake_services import JWT_SECRET, FakeOpenAI, FakeSupabase
+
+FIELDS = [(0, "小3-4"), (1, "個別"), (2, "授業中"), (3, "時々"), (4, "中"), (5, "困惑")]
+TOPICS = ["授業中に立ち歩く", "宿題の未提出が続く", "休み時間に一人で過ごす", "テスト前に欠席が増える",
+          "グループ活動に参加しない", "提出物を出し忘れる", "発言が少ない", "友だちとのトラブルが多い"]
+
+def pct(xs:list[float], q:float)->float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else float("nan")
+
+class Env:
+    """フェイクサーバーと、アプリに渡す secrets"""
+
+    def __init__(self, args):
+        with open(os.path.join(ROOT, "albert_policy.json"), encoding="utf-8") as f:
+            pol = json.load(f)
+        policy = {k: pol[k] for k in ("tone", "must_include", "avoid_phrases", "phrasebook", "value_mapping")}
+        self.sb = FakeSupabase(latency=args.db_latency)
+        self.oa = FakeOpenAI(ttft=args.ttft, chunk_delay=args.chunk_delay)
+        self.org_id, self.users = self.sb.seed_org(policy, n_users=max(1, args.sessions))
+        os.environ["OPENAI_BASE_URL"] = self.oa.base_url + "/v1"
+        self.secrets = {
+            "SUPABASE_URL": self.sb.base_url, "SUPABASE_ANON_KEY": self.sb.anon_key,
+            "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": self.oa.base_url + "/v1",
+            "SUPABASE_JWT_SECRET": JWT_SECRET,
+            "OPENAI_MAX_CONCURRENCY": args.concurrency,
+            "TELEMETRY_DB": os.path.join(tempfile.mkdtemp(prefix="albert-bench-"), "metrics.sqlite"),
+        }
+
+    def db_calls(self)->int:
+        return self.sb.total()
+
+    def llm_calls(self)->int:
+        return self.oa.total()
+
+    def settle(self, timeout:float=5.0):
+        """バックグラウンドの書き込みが落ち着くまで待つ（DB の呼び出し数が 0.2 秒変わらなくなるまで）"""
+        deadline = time.monotonic() + timeout
+        last = self.db_calls()
+        while time.monotonic() < deadline:
+            time.sleep(0.2)
+            now = self.db_calls()
+            if now == last:
+                return
+            last = now
+
+class Session:
+    """1 人の利用者（AppTest 1 つ）"""
+
+    def __init__(self, env:Env, email:str):
+        self.env = env
+        self.email = email
+        self.at = AppTest.from_file(APP, default_timeout=120)
+        self.at.secrets.update(env.secrets)
+
+    def run(self):
+        self.at.run()
+        if self.at.exception:
+            raise RuntimeError(self.at.exception[0].message)
+
+    def login(self):
+        self.run()
+        self.at.text_input(key="login_email").input(self.email)
+        self.at.text_input(key="login_pw").input("pw")
+        self.at.button[0].click()
+        self.run()
+
+    def tab(self, name:str):
+        self.at.sidebar.radio[0].set_value(name)
+        self.run()
+
+    def submit(self, message:str)->bool:
+        """相談を送信し、エラー表示が出なければ True"""
+        for i, v in FIELDS:
+            self.at.selectbox[i].set_value(v)
+        self.at.text_area[0].input(message)
+        next(b for b in self.at.button if b.label == "提案を生成").click()
+        self.run()
+        return not any("失敗" in e.value or "応答していません" in e.value for e in self.at.error)
+
+    def feedback(self):
+        next(r for r in self.at.radio if r.label == "役立ち度").set_value("good")
+        next(b for b in self.at.button if b.label == "フィードバックを保存").click()
+        self.run()
+
+def measure(env:Env, fn, settle:bool=False)->tuple[float, int, int]:
+    """(ミリ秒, DB 往復数, LLM 呼び出し数)。settle なら裏の書き込みも数える"""
+    db0, llm0 = env.db_calls(), env.llm_calls()
+    t0 = time.perf_counter()
+    fn()
+    ms = (time.perf_counter() - t0) * 1000
+    if settle:
+        env.settle()
+    return ms, env.db_calls() - db0, env.llm_calls() - llm0
+
+class Report:
+    def __init__(self):
+        self.lines: list[str] = []
+
+    def __call__(self, line:str=""):
+        print(line, flush=True)
+        self.lines.append(line)
+
+    def row(self, name:str, ms:list[float], db:list[int], llm:list[int]|None=None):
+        extra = f"  llm/回 {statistics.mean(llm):5.1f}" if llm else ""
+        self(f"{name:<28} n={len(ms):<3} p50 {pct(ms, .5):8.1f}ms  p95 {pct(ms, .95):8.1f}ms"
+             f"  db/回 {statistics.mean(db):5.1f}{extra}")
+
+def _cold_worker(secrets:dict, email:str)->dict:
+    """新しいプロセスでログイン画面を 1 回描き、続けてログインする。所要時間と読み込み済みの依存を返す"""
+    env = type("ColdEnv", (), {"secrets": secrets})()
+    s = Session(env, email)
+    t0 = time.perf_counter()
+    s.run()
+    first = (time.perf_counter() - t0) * 1000
+    heavy = [m for m in ("openai", "supabase", "numpy") if m in sys.modules]
+    t0 = time.perf_counter()
+    s.login()
+    return {"first": first, "login": (time.perf_counter() - t0) * 1000, "heavy": heavy}
+
+def bench_cold(env:Env, rep:Report, iters:int):
+    rep("## コールドスタート（1 回ごとに新しいプロセス）")
+    res = []
+    for _ in range(iters):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--cold", json.dumps(
+                                 {"secrets": env.secrets, "email": env.users[0]["email"]})],
+                             capture_output=True, text=True).stdout
+        res.append(json.loads(out.strip().splitlines()[-1]))
+    rep(f"{'ログイン画面の初回表示':<28} n={iters:<3} p50 {pct([r['first'] for r in res], .5):8.1f}ms"
+        f"  読み込み済み: {', '.join(res[0]['heavy']) or '（なし）'}")
+    rep(f"{'続けてログイン':<28} n={iters:<3} p50 {pct([r['login'] for r in res], .5):8.1f}ms")
+
+def bench_tabs(env:Env, rep:Report, iters:int):
+    rep("## メニューごとの再実行（ログイン済み・全体の再実行）")
+    s = Session(env, env.users[0]["email"])
+    ms, db, _ = measure(env, s.login)
+    env.login_db = db
+    rep(f"{'ログイン':<28} {ms:8.1f}ms  db {db}")
+    for tab in ["相談", "ダッシュボード", "設定", "運用"]:
+        s.tab(tab)
+        xs = [measure(env, s.run) for _ in range(iters)]
+        rep.row(tab, [x[0] for x in xs], [x[1] for x in xs])
+
+def bench_generate(env:Env, rep:Report, iters:int):
+    rep("## 生成（送信 → 回答表示。db/回は裏の保存を含む）")
+    s = Session(env, env.users[0]["email"])
+    s.login()
+    xs = [measure(env, lambda i=i: s.submit(f"{TOPICS[i % len(TOPICS)]}（{time.time_ns()}）"), settle=True)
+          for i in range(iters)]
+    rep.row("生成（LLM）", [x[0] for x in xs], [x[1] for x in xs], [x[2] for x in xs])
+    msg = f"{TOPICS[0]}（キャッシュ確認）"
+    s.submit(msg)
+    env.settle()
+    xs = [measure(env, lambda: s.submit(msg), settle=True) for _ in range(iters)]
+    rep.row("生成（応答キャッシュ）", [x[0] for x in xs], [x[1] for x in xs], [x[2] for x in xs])
+    xs = [measure(env, s.feedback, settle=True) for _ in range(iters)]
+    rep.row("フィードバック保存", [x[0] for x in xs], [x[1] for x in xs])
+
+def bench_errors(env:Env, rep:Report, iters:int):
+    rep("## エラー注入（500: 20% / 429: 10%）")
+    env.oa.error_rate, env.oa.rate_limit_rate = 0.2, 0.1
+    try:
+        s = Session(env, env.users[0]["email"])
+        s.login()
+        ok, xs = 0, []
+        for i in range(iters):
+            res = {}
+            xs.append(measure(env, lambda: res.update(ok=s.submit(f"{TOPICS[i % len(TOPICS)]}（err {time.time_ns()}）")), settle=True))
+            ok += res["ok"]
+        rep.row("生成（エラー注入）", [x[0] for x in xs], [x[1] for x in xs], [x[2] for x in xs])
+        rep(f"{'成功率':<28} {ok}/{iters}")
+    finally:
+        env.oa.error_rate, env.oa.rate_limit_rate = 0.0, 0.0
+
+def _session_worker(secrets:dict, email:str, n:int, per_session:int, start_at:float)->tuple[list[float], list[str]]:
+    """別プロセスで 1 セッションを動かし、(生成ごとのミリ秒, 失敗) を返す"""
+    env = type("SessionEnv", (), {"secrets": secrets})()
+    s = Session(env, email)
+    s.login()
+    time.sleep(max(0.0, start_at - time.time()))  # 全セッションで開始をそろえる
+    lat, errors = [], []
+    for i in range(per_session):
+        t0 = time.perf_counter()
+        try:
+            s.submit(f"{TOPICS[(n + i) % len(TOPICS)]}（s{n}-{i} {time.time_ns()}）")
+            lat.append((time.perf_counter() - t0) * 1000)
+        except Exception as e:
+            errors.append(repr(e))
+    return lat, errors
+
+def bench_sessions(env:Env, rep:Report, sessions:int, per_session:int):
+    # AppTest は 1 プロセスに 1 つしか同時に動かせないので、セッションごとに子プロセス（--worker）を起動する。
+    # プロセス内共有のキャッシュ・スケジューラはセッション間で共有されない（レプリカを並べた状態に近い）
+    rep(f"## 同時 {sessions} セッション（各 {per_session} 回生成・1 セッション 1 プロセス）")
+    start_at = time.time() + 10 + sessions  # ログインが済むまでの余裕
+    db0, llm0 = env.db_calls(), env.llm_calls()
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(
+                 {"secrets": env.secrets, "email": u["email"], "n": n, "per_session": per_session, "start_at": start_at})],
+                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+             for n, u in enumerate(env.users[:sessions])]
+    results = []
+    for p in procs:
+        out, _ = p.communicate()
+        try:
+            results.append(json.loads(out.strip().splitlines()[-1]))
+        except (IndexError, ValueError):
+            results.append([[], [f"worker exited with {p.returncode}"]])
+    wall = time.time() - start_at
+    env.settle()
+    lat = [x for r in results for x in r[0]]
+    errors = [e for r in results for e in r[1]]
+    done = len(lat)
+    logins = sessions * getattr(env, "login_db", 0)  # ログイン分は除く
+    rep(f"{'処理量':<28} {done / wall:8.2f} 件/秒  ({done} 件 / {wall:.1f}s, 失敗 {len(errors)})")
+    rep.row("1 件あたり", lat, [(env.db_calls() - db0 - logins) / max(1, done)],
+            [(env.llm_calls() - llm0) / max(1, done)])
+    for e in errors[:3]:
+        rep(f"  失敗: {e}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="streamlit_app.py のオフライン・ベンチマーク")
+    ap.add_argument("--worker", help=argparse.SUPPRESS)  # 同時セッション計測の子プロセス用
+    ap.add_argument("--cold", help=argparse.SUPPRESS)    # コールドスタート計測の子プロセス用
+    ap.add_argument("--iters", type=int, default=10, help="各計測の回数")
+    ap.add_argument("--sessions", type=int, default=8, help="同時セッション数")
+    ap.add_argument("--per-session", type=int, default=3, help="同時実行時の 1 セッションあたりの生成回数")
+    ap.add_argument("--ttft", type=float, default=0.3, help="フェイク OpenAI の最初のトークンまでの秒数")
+    ap.add_argument("--chunk-delay", type=float, default=0.005, help="フェイク OpenAI のチャンク間隔（秒）")
+    ap.add_argument("--db-latency", type=float, default=0.005, help="フェイク Supabase の 1 往復の遅延（秒）")
+    ap.add_argument("--concurrency", type=int, default=4, help="アプリの OPENAI_MAX_CONCURRENCY")
+    ap.add_argument("--out", default=os.path.join(ROOT, "bench_output.txt"), help="結果の書き出し先")
+    args = ap.parse_args(argv)
+    if args.worker:
+        w = json.loads(args.worker)
+        os.environ["OPENAI_BASE_URL"] = w["secrets"]["OPENAI_BASE_URL"]
+        print(json.dumps(_session_worker(w["secrets"], w["email"], w["n"], w["per_session"], w["start_at"])))
+        return
+    if args.cold:
+        w = json.loads(args.cold)
+        os.environ["OPENAI_BASE_URL"] = w["secrets"]["OPENAI_BASE_URL"]
+        print(json.dumps(_cold_worker(w["secrets"], w["email"])))
+        return
+
+    env = Env(args)
+    rep = Report()
+    rep(f"# bench_app  {time.strftime('%Y-%m-%d %H:%M:%S')}  ttft={args.ttft}s db_latency={args.db_latency}s"
+        f" concurrency={args.concurrency}")
+    bench_cold(env, rep, min(args.iters, 5))
+    bench_tabs(env, rep, args.iters)
+    bench_generate(env, rep, args.iters)
+    bench_errors(env, rep, args.iters)
+    if args.sessions > 1:
+        bench_sessions(env, rep, args.sessions, args.per_session)
+    with open(args.out, "w", encoding="utf-8") as f:
+        f.write("\n".join(rep.lines) + "\n")
+    env.sb.close()
+    env.oa.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# bench/bench_retrieval.py  —— albert_retrieval の索引作成・検索の計測
+"""
+使い方: python bench/bench_retrieval.py [件数=100000] [検索回数=200]
+合成した日本語の相談文を一時ディレクトリに索引し、次を測る（ネットワーク不要）。
+- 一括追加＋作り直しの所要時間と索引のサイズ
+- 再起動後（mmap で開き直した状態）の検索レイテンシ p50 / p95 / p99
+- 差分（未併合）がある状態の検索レイテンシと 1 件追加の所要時間
+"""
+import os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_retrieval import OrgIndex
+
+GRADES = ["小1-2", "小3-4", "小5-6", "中1-3", "高1-3"]
+SCENES = ["授業中", "休み時間", "HR・学活", "行事", "保護者対応", "部活動"]
+SUBJECTS = ["国語", "算数/数学", "理科", "社会", "英語", "体育", "未指定"]
+PHRASES = [
+    "授業中に立ち歩く", "注意すると教室を出てしまう", "宿題の未提出が続いている", "声かけの仕方に迷っている",
+    "休み時間に一人で過ごすことが多い", "グループに入りにくい様子", "テスト前になると欠席が増える",
+    "登校しぶりが見られる", "友だちとのトラブルが多い", "発言が少なく自信がなさそう", "提出物を出し忘れる",
+    "家庭では落ち着いているとのこと", "係の仕事を途中でやめてしまう", "板書を写すのに時間がかかる",
+    "忘れ物が多く準備に時間がかかる", "話を最後まで聞けない", "班活動で役割を引き受けない",
+]
+ATTEMPTS = ["席を前にした", "個別に声をかけた", "保護者と連絡をとった", "役割を与えた", "（未記入）"]
+
+def doc(rnd:random.Random)->str:
+    msg = "。".join(rnd.sample(PHRASES, rnd.randint(2, 5))) + f"。{rnd.randint(1, 40)}番の児童について。"
+    return " ".join([rnd.choice(GRADES), rnd.choice(SCENES), rnd.choice(SUBJECTS), msg, rnd.choice(ATTEMPTS)])
+
+def pct(xs:list[float], q:float)->float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+def timed_search(idx:OrgIndex, queries:list[str])->list[float]:
+    out = []
+    for q in queries:
+        t0 = time.perf_counter()
+        idx.search(q, k=3)
+        out.append((time.perf_counter() - t0) * 1000)
+    return out
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n_q = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rnd = random.Random(0)
+    queries = [doc(rnd) for _ in range(n_q)]
+    with tempfile.TemporaryDirectory() as root:
+        idx = OrgIndex(root, merge_every=n + 1)  # 計測中は自動併合しない
+        t0 = time.perf_counter()
+        for i in range(0, n, 5000):
+            idx.add([(f"a{j}", doc(rnd), f"回答{j}") for j in range(i, min(n, i + 5000))])
+        t_add = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        idx.rebuild()
+        t_build = time.perf_counter() - t0
+        size = sum(os.path.getsize(os.path.join(root, f)) for f in os.listdir(root))
+        print(f"docs={n}  add={t_add:.1f}s  rebuild={t_build:.1f}s  size={size / 1e6:.0f}MB")
+
+        idx = OrgIndex(root)  # 再起動相当：mmap で開き直す
+        timed_search(idx, queries[:10])  # ページキャッシュを温める
+        ms = timed_search(idx, queries)
+        print(f"search (mmap)   p50={pct(ms, .5):.2f}ms  p95={pct(ms, .95):.2f}ms  p99={pct(ms, .99):.2f}ms")
+
+        t0 = time.perf_counter()
+        for j in range(200):
+            idx.add([(f"b{j}", doc(rnd), f"回答b{j}")])
+        print(f"add (1 件)      {(time.perf_counter() - t0) / 200 * 1000:.2f}ms")
+        ms = timed_search(idx, queries)
+        print(f"search (+差分200) p50={pct(ms, .5):.2f}ms  p95={pct(ms, .95):.2f}ms  p99={pct(ms, .99):.2f}ms")
+        hit = idx.search(queries[0], k=1)[0]
+        print(f"例: score={hit['score']:.2f}\n  Q: {queries[0]}\n  A: {hit['query']}")
+
+if __name__ == "__main__":
+    main()
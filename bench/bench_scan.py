@@ -0,0 +1,87 @@
+# bench/bench_scan.py  —— albert_scan と従来の re.search ループの比較
+"""
+使い方: python bench/bench_scan.py [件数]
+合成した日本語の相談文/回答文コーパスに対して、
+従来の「パターンごとの re.search ループ」と Scanner の処理量（件/秒）を比べる。
+"""
+import os, random, re, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_scan import (SENSITIVE_KEYS, NG_PHRASES, TOPIC_RULES,
+                         MESSAGE_SCANNER, SENSITIVE_SCANNER, answer_scanner)
+
+AVOID = ["その場で謝らせる","両者を即対面","恥をかかせる","我慢させる"]
+BASE = [
+    "授業中に立ち歩く小2男子がいて、注意すると教室を出てしまいます。",
+    "保護者とも連絡をとっていますが、家庭では落ち着いているとのことです。",
+    "宿題の未提出が続いており、声かけの仕方に迷っています。",
+    "休み時間に一人で過ごすことが多く、グループに入りにくい様子です。",
+    "テストの前になると欠席が増え、登校しぶりも見られます。",
+    "役割を固定し、成功を言語化する。15分毎に全体でストレッチを入れる。",
+]
+SPICE = ["いじめ", "SNSで晒し", "殴られた", "被害者も同席させる", "我慢させる", "金を要求"]
+
+def corpus(n:int, seed:int=0)->list[str]:
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        text = "".join(rnd.choice(BASE) for _ in range(rnd.randint(2, 12)))
+        if rnd.random() < 0.15:
+            i = rnd.randrange(len(text))
+            text = text[:i] + rnd.choice(SPICE) + text[i:]
+        out.append(text)
+    return out
+
+# ---- 従来実装（置き換え前のコードと同じ書き方） ----
+def old_detect_sensitive(text):
+    return any(re.search(p, text) for p in SENSITIVE_KEYS)
+
+def old_violates(text):
+    return any(re.search(p, text) for p in NG_PHRASES) or any(w in text for w in AVOID)
+
+def old_message(text):
+    # 相談文の判定：センシティブ判定 + トピック分類
+    return old_detect_sensitive(text), [tag for pat, tag in TOPIC_RULES if re.search(pat, text)]
+
+def new_message(text):
+    cats = MESSAGE_SCANNER.categories(text)
+    return "sensitive" in cats, [c for c in cats if c != "sensitive"]
+
+def old_hits(text):
+    # 全ヒットの列挙（パターンごとの finditer）
+    pats = [("sensitive", p) for p in SENSITIVE_KEYS] + [(tag, p) for p, tag in TOPIC_RULES]
+    return sorted(((c, p, m.start(), m.end()) for c, p in pats for m in re.finditer(p, text)),
+                  key=lambda h: (h[2], h[3]))
+
+def bench(name:str, fn, texts:list[str])->float:
+    t0 = time.perf_counter()
+    for t in texts:
+        fn(t)
+    dt = time.perf_counter() - t0
+    mb = sum(len(t.encode()) for t in texts) / 1e6
+    print(f"{name:<28} {len(texts)/dt:>12,.0f} 件/秒  {mb/dt:>8.1f} MB/秒")
+    return dt
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    texts = corpus(n)
+    answer = answer_scanner(AVOID)
+    # 結果が一致することを先に確認する
+    for t in texts[:5000]:
+        assert old_detect_sensitive(t) == SENSITIVE_SCANNER.search(t)
+        assert old_violates(t) == answer.search(t)
+        assert old_message(t) == new_message(t)
+        assert sorted(old_hits(t)) == sorted(map(tuple, MESSAGE_SCANNER.scan(t)))
+    print(f"corpus: {n} texts")
+    for label, old, new in [
+        ("sensitive", old_detect_sensitive, SENSITIVE_SCANNER.search),
+        ("ng+avoid", old_violates, answer.search),
+        ("message", old_message, new_message),
+        ("all hits", old_hits, MESSAGE_SCANNER.scan),
+    ]:
+        a = bench(f"{label} / re.search loop", old, texts)
+        b = bench(f"{label} / Scanner", new, texts)
+        print(f"{'':<28} x{a/b:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+# bench/fake_services.py  —— ベンチ用のローカル Supabase（PostgREST/GoTrue）と OpenAI 互換サーバー
+"""
+本物のクライアント（supabase-py / openai）がそのまま話せる最小限の HTTP サーバー。
+どちらも別スレッドで起動し、受けたリクエストをパスごとに数える（DB 往復数の計測用）。
+
+FakeSupabase: /auth/v1/token・/auth/v1/user・/rest/v1/<table>・/rest/v1/rpc/<fn>
+  テーブルはメモリ上の dict のリスト。フィルタは eq. だけを解釈し、それ以外（or・order など）は無視する。
+FakeOpenAI: /v1/chat/completions（ストリーミング SSE / 通常）
+  最初のトークンまでの遅延・チャンク間隔・エラー率（500 / 429）を実行中に変えられる。
+"""
+import json, random, threading, time, uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import jwt
+
+JWT_SECRET = "bench-secret-bench-secret-bench-secret"
+ANSWER = """0) 先生へのひと言
+- ここまで丁寧に見てこられたこと自体が土台です。
+① 背景の見立て
+- 注目の獲得と感覚の欲求が混在します。【根拠: PBIS】
+② 明日ためせる行動レシピ
+- 役割（プリント配り）を固定し、成功を言語化する。【根拠: PBIS】
+- 15分ごとに全体でストレッチを入れる。【根拠: タイムオンタスク】
+- 授業前30秒で役割を予告する。【根拠: 前方支援】
+③ 保護者への伝え方
+- 学校での小さな成功を1つ共有し、家庭での様子を1つ教えてもらう。
+④ 子どもへの声かけ
+- 「次はどれからやってみる？」/「どっちで進めるのがやりやすい？」
+⑤ 成功の観察指標
+- 立ち歩きの回数 / 役割の完了回数
+⑥ 注意とフォロー
+- 罰としての席替えは逆効果。役割は定期的に更新する。
+"""
+
+def now_iso()->str:
+    return datetime.now(timezone.utc).isoformat()
+
+def sign(claims:dict, ttl:int=3600)->str:
+    return jwt.encode({"aud": "authenticated", "role": "authenticated",
+                       "exp": int(time.time()) + ttl, **claims}, JWT_SECRET, algorithm="HS256")
+
+class _Server:
+    """ThreadingHTTPServer を空きポートで起動し、base_url と呼び出し回数を持つ"""
+
+    def __init__(self, handler):
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+        owner = self
+        class H(handler):
+            server_owner = owner
+            def log_message(self, *a):
+                pass
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), H)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def count(self, key:str):
+        with self._lock:
+            self.calls[key] += 1
+
+    def total(self, prefix:str="")->int:
+        with self._lock:
+            return sum(n for k, n in self.calls.items() if k.startswith(prefix))
+
+    def close(self):
+        self.httpd.shutdown()
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_owner: _Server
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(n) or b"null") if n else None
+
+    def _send(self, status:int, obj=None, headers:dict|None=None):
+        data = b"" if obj is None else json.dumps(obj, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+# ================== Supabase ==================
+class FakeSupabase(_Server):
+    def __init__(self, latency:float=0.0):
+        self.latency = latency  # 1 往復ごとに足す遅延（秒）
+        self.tables: dict[str, list[dict]] = {t: [] for t in (
+            "users", "orgs", "memberships", "org_policies", "consultations", "answers", "feedbacks")}
+        self.accounts: list[dict] = []  # GoTrue のユーザー（id, email）
+        self.db_lock = threading.Lock()
+        self.anon_key = jwt.encode({"role": "anon", "iss": "supabase"}, JWT_SECRET, algorithm="HS256")
+        super().__init__(_SupabaseHandler)
+
+    def seed_org(self, policy:dict, n_users:int=1, org_name:str="ベンチ校")->tuple[str, list[dict]]:
+        """組織・ポリシー・ユーザー（メール user{n}@bench、パスワードは何でもよい）を作り、(org_id, users) を返す"""
+        org_id = str(uuid.uuid4())
+        with self.db_lock:
+            users = [{"id": str(uuid.uuid4()), "email": f"user{len(self.accounts) + i}@bench"} for i in range(n_users)]
+            self.accounts.extend(users)
+            self.tables["orgs"].append({"id": org_id, "name": org_name})
+            self.tables["org_policies"].append({"id": str(uuid.uuid4()), "org_id": org_id,
+                                                "updated_at": now_iso(), **policy})
+            for i, u in enumerate(users):
+                self.tables["memberships"].append({"org_id": org_id, "user_id": u["id"],
+                                                   "role": "admin" if i == 0 else "member",
+                                                   "orgs": {"name": org_name}})
+        return org_id, users
+
+    def user_by_email(self, email:str)->dict|None:
+        return next((u for u in self.accounts if u["email"] == email), None)
+
+class _SupabaseHandler(_Handler):
+    def _route(self, method:str):
+        srv: FakeSupabase = self.server_owner
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        key = "/".join(parts[:4]) if parts[:3] == ["rest", "v1", "rpc"] else "/".join(parts[:3])
+        srv.count(f"{method} {key}")
+        if srv.latency:
+            time.sleep(srv.latency)
+        q = parse_qsl(url.query, keep_blank_values=True)
+        body = self._body()  # GET でも本文（{}）が付くので必ず読み切る
+        if parts[:2] == ["auth", "v1"]:
+            return self._auth(srv, parts[2], dict(q), body)
+        if parts[:3] == ["rest", "v1", "rpc"]:
+            return self._rpc(srv, parts[3], body or {})
+        if parts[:2] == ["rest", "v1"]:
+            return self._rest(srv, method, parts[2], q, body)
+        self._send(404, {"message": "not found"})
+
+    do_GET = lambda self: self._route("GET")
+    do_POST = lambda self: self._route("POST")
+    do_PATCH = lambda self: self._route("PATCH")
+
+    # ---- GoTrue ----
+    def _session(self, user:dict)->dict:
+        u = {"id": user["id"], "aud": "authenticated", "email": user["email"], "app_metadata": {},
+             "user_metadata": {}, "created_at": now_iso(), "role": "authenticated"}
+        return {"access_token": sign({"sub": user["id"], "email": user["email"]}),
+                "refresh_token": f"rt-{user['id']}", "expires_in": 3600,
+                "expires_at": int(time.time()) + 3600, "token_type": "bearer", "user": u}
+
+    def _auth(self, srv:FakeSupabase, op:str, query:dict, body):
+        if op == "token" and query.get("grant_type") == "password":
+            user = srv.user_by_email((body or {}).get("email"))
+            return self._send(200, self._session(user)) if user else self._send(400, {"error": "invalid_grant"})
+        if op == "token" and query.get("grant_type") == "refresh_token":
+            uid = (body or {}).get("refresh_token", "")[3:]
+            user = next((u for u in srv.accounts if u["id"] == uid), None)
+            return self._send(200, self._session(user)) if user else self._send(400, {"error": "invalid_grant"})
+        if op == "user":
+            token = (self.headers.get("Authorization") or "")[7:]
+            try:
+                claims = jwt.decode(token, JWT_SECRET, algorithms=["HS256"], audience="authenticated")
+            except jwt.PyJWTError:
+                return self._send(401, {"message": "invalid token"})
+            return self._send(200, self._session({"id": claims["sub"], "email": claims.get("email")})["user"])
+        self._send(404, {"message": "unsupported"})
+
+    # ---- PostgREST ----
+    def _rest(self, srv:FakeSupabase, method:str, table:str, q:list, body):
+        rows = srv.tables.setdefault(table, [])
+        filters = [(k, v[3:]) for k, v in q if v.startswith("eq.")]
+        limit = next((int(v) for k, v in q if k == "limit"), None)
+        match = lambda r: all(str(_get(r, k)) == v for k, v in filters)
+        with srv.db_lock:
+            if method == "GET":
+                out = [r for r in rows if match(r)]
+                return self._send(200, out[:limit] if limit else out)
+            if method == "PATCH":
+                hit = [r for r in rows if match(r)]
+                for r in hit:
+                    r.update(body or {}, updated_at=now_iso())
+                return self._send(200, hit)
+            new = body if isinstance(body, list) else [body]
+            prefer = self.headers.get("Prefer") or ""
+            out = []
+            for r in new:
+                r = {"id": str(uuid.uuid4()), "created_at": now_iso(), **r}
+                old = next((x for x in rows if x.get("id") == r["id"]), None)
+                if old is not None and "ignore-duplicates" in prefer:
+                    continue
+                if old is not None:
+                    old.update(r)
+                else:
+                    rows.append(r)
+                out.append(r)
+        self._send(201, out)
+
+    def _rpc(self, srv:FakeSupabase, fn:str, body:dict):
+        with srv.db_lock:
+            if fn == "save_consultation":
+                c, a = body["p_consultation"], body["p_answer"]
+                for t, r in (("consultations", c), ("answers", a)):
+                    if not any(x["id"] == r["id"] for x in srv.tables[t]):
+                        srv.tables[t].append(r)
+                return self._send(200, {"consultation_id": c["id"], "answer_id": a["id"]})
+            if fn == "dashboard_kpis":
+                org = body.get("p_org_id")
+                n = sum(1 for c in srv.tables["consultations"] if c.get("org_id") == org)
+                return self._send(200, {"action_rate": 0, "helpful_rate": 0, "regen_rate": 0,
+                                        "time_fit_rate": 0, "sens_rate": 0, "policy_ok_rate": 100,
+                                        "topics": [{"topic": "授業", "n": n}] if n else []})
+            if fn == "route_stats":
+                org = body.get("p_org_id")
+                cons = {c["id"] for c in srv.tables["consultations"] if c.get("org_id") == org}
+                stats: dict = {}
+                for a in srv.tables["answers"]:
+                    if a.get("consultation_id") in cons:
+                        r = stats.setdefault((a.get("route"), a.get("model")), {"route": a.get("route"), "model": a.get("model"), "answers": 0})
+                        r["answers"] += 1
+                return self._send(200, list(stats.values()))
+        self._send(404, {"message": f"function {fn} not found"})
+
+def _get(row:dict, key:str):
+    # "consultations.org_id" のような埋め込みの列は親の値として扱う
+    return row.get(key.split(".")[-1])
+
+# ================== OpenAI ==================
+class FakeOpenAI(_Server):
+    def __init__(self, ttft:float=0.3, chunk_delay:float=0.005, chunk_chars:int=8,
+                 error_rate:float=0.0, rate_limit_rate:float=0.0, text:str=ANSWER, seed:int=0):
+        self.ttft = ttft                  # 最初のトークンまでの遅延（秒）
+        self.chunk_delay = chunk_delay    # チャンク間の遅延（秒）
+        self.chunk_chars = chunk_chars
+        self.error_rate = error_rate      # 500 を返す割合
+        self.rate_limit_rate = rate_limit_rate  # 429 を返す割合
+        self.text = text
+        self.rnd = random.Random(seed)
+        super().__init__(_OpenAIHandler)
+
+class _OpenAIHandler(_Handler):
+    def do_POST(self):
+        srv: FakeOpenAI = self.server_owner
+        body = self._body() or {}
+        srv.count(f"POST {urlsplit(self.path).path} {body.get('model')}")
+        r = srv.rnd.random()
+        if r < srv.error_rate:
+            return self._send(500, {"error": {"message": "injected", "type": "server_error"}})
+        if r < srv.error_rate + srv.rate_limit_rate:
+            return self._send(429, {"error": {"message": "injected", "type": "rate_limit"}}, {"retry-after": "0"})
+        time.sleep(srv.ttft)
+        text = srv.text
+        usage = {"prompt_tokens": sum(len(m.get("content") or "") for m in body.get("messages", [])) // 2,
+                 "completion_tokens": len(text) // 2}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body.get("model")}
+        headers = {"x-ratelimit-limit-requests": "10000", "x-ratelimit-remaining-requests": "9999",
+                   "x-ratelimit-limit-tokens": "10000000", "x-ratelimit-remaining-tokens": "9999999"}
+        if not body.get("stream"):
+            return self._send(200, {**base, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}]}, headers)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.close_connection = True
+        def event(obj):
+            self.wfile.write(b"data: " + json.dumps(obj, ensure_ascii=False).encode() + b"\n\n")
+            self.wfile.flush()
+        chunk = {**base, "object": "chat.completion.chunk"}
+        try:
+            event({**chunk, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+            for i in range(0, len(text), srv.chunk_chars):
+                event({**chunk, "choices": [{"index": 0, "delta": {"content": text[i:i + srv.chunk_chars]}, "finish_reason": None}]})
+                time.sleep(srv.chunk_delay)
+            event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                event({**chunk, "choices": [], "usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 途中で打ち切られた（安全チェック・ヘッジの負け側）
@@ -1,10 +1,21 @@
 # streamlit_app.py  —— 置き換え用フルコード（Strict Auth Gate 版）
 import streamlit as st
-import json, os, re
+import contextvars, functools, os, tempfile, threading, time, weakref
+from types import SimpleNamespace
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeout
 from datetime import datetime, timedelta, timezone
-from collections import Counter
-from supabase import create_client, Client
-from openai import OpenAI
+import jwt
+from albert_scan import SENSITIVE_SCANNER, answer_facts, classify_topics
+from albert_prompt import SECTIONS, PolicyCache, build_messages, build_section_messages, merge_sections
+from albert_route import Route, Router
+from albert_trace import MetricsStore, Tracer, instrument_httpx
+from albert_data import memberships
+from albert_export import FORMATS, export, open_sink
+from albert_store import WriteBehind, new_id, save_consultation, save_feedback, utcnow_iso
+from albert_assets import ROOT as ASSETS_ROOT, Assets, AssetStore
+# openai / supabase / albert_llm（openai）/ albert_retrieval（numpy）は使う関数の中で読み込む。
+# ログイン画面の表示ではどれも読み込まない
 
 # ================== 基本設定 ==================
 st.set_page_config(page_title="Albert β", page_icon="🧭", layout="centered")
@@ -15,82 +26,396 @@ SB_URL = st.secrets.get("SUPABASE_URL")
 SB_KEY = st.secrets.get("SUPABASE_ANON_KEY")
 OPENAI_KEY = st.secrets.get("OPENAI_API_KEY")
 OPENAI_MODEL = st.secrets.get("OPENAI_MODEL", "gpt-4o-mini")
+OPENAI_FALLBACK_MODEL = st.secrets.get("OPENAI_FALLBACK_MODEL")  # 任意：遅延・障害時の予備モデル
+OPENAI_FAST_MODEL = st.secrets.get("OPENAI_FAST_MODEL")  # 任意：ふだんの相談に使う速くて安いモデル（albert_route）
+OPENAI_ROUTES = st.secrets.get("OPENAI_ROUTES", {})      # 任意：生成ルートの上書き（albert_route の説明を参照）
+OPENAI_TIMEOUT = float(st.secrets.get("OPENAI_TIMEOUT", 60))   # 1 回の試行の上限（秒）
+OPENAI_RETRIES = int(st.secrets.get("OPENAI_RETRIES", 2))
+OPENAI_HEDGE = bool(st.secrets.get("OPENAI_HEDGE", True))      # 予備モデルへのヘッジ
+OPENAI_MAX_CONCURRENCY = int(st.secrets.get("OPENAI_MAX_CONCURRENCY", 4))  # プロセス内の同時生成数
+OPENAI_RPM = float(st.secrets.get("OPENAI_RPM", 500))      # レート制限の初期値（ヘッダで補正）
+OPENAI_TPM = float(st.secrets.get("OPENAI_TPM", 200_000))
+# 相乗りしたセッションが先頭の完了を待つ上限（秒）。過ぎたら自分で生成する
+FOLLOW_TIMEOUT = float(st.secrets.get("OPENAI_FOLLOW_TIMEOUT", 2 * OPENAI_TIMEOUT * (OPENAI_RETRIES + 1)))
+OPENAI_STREAM = bool(st.secrets.get("OPENAI_STREAM", True))  # 逐次表示＋途中の安全チェック
+OPENAI_SECTIONED = bool(st.secrets.get("OPENAI_SECTIONED", False))  # 任意：6 部構成を部分ごとに並行生成
+SB_JWT_SECRET = st.secrets.get("SUPABASE_JWT_SECRET")  # 任意：あればトークン署名をローカル検証
+# 計測：スパンはローカルの SQLite に保存。Prometheus テキスト / OTLP JSON 行ファイルへの書き出しは任意
+TELEMETRY_DB = st.secrets.get("TELEMETRY_DB", os.path.join(tempfile.gettempdir(), "albert_metrics.sqlite"))
+TELEMETRY_PROM_FILE = st.secrets.get("TELEMETRY_PROM_FILE")
+TELEMETRY_OTLP_FILE = st.secrets.get("TELEMETRY_OTLP_FILE")
+OPS_ADMIN_EMAILS = list(st.secrets.get("OPS_ADMIN_EMAILS", []))  # 全組織のトークン消費を見られる運用者
+# 参考例：good 評価だった似た相談の回答を上位 K 件プロンプトに入れる（0 で無効）。索引はローカルに保存
+RETRIEVAL_DIR = st.secrets.get("RETRIEVAL_DIR", os.path.join(tempfile.gettempdir(), "albert_retrieval"))
+RETRIEVAL_K = int(st.secrets.get("RETRIEVAL_K", 2))
+# 既定ポリシー・フォームの選択肢・プロンプトの置き場所（albert_assets）。変更は再起動なしで反映
+ASSETS_DIR = st.secrets.get("ASSETS_DIR", ASSETS_ROOT)
 
 if not all([SB_URL, SB_KEY, OPENAI_KEY]):
     st.error("⚠️ Secrets に SUPABASE_URL / SUPABASE_ANON_KEY / OPENAI_API_KEY が必要です。")
     st.stop()
 
-# OpenAI
-oa = OpenAI(api_key=OPENAI_KEY)
-
-# ================== 定数・共通データ ==================
-GROUPED = {
-  "子どもの力を信じる": ["子どもの主体性を育てたい","自信を育てたい","自分で選ばせたい"],
-  "成長を支える関わり方": ["少し頑張れる課題を出したい","失敗を受け止めたい","プロセスを褒めたい"],
-  "温かい人間関係": ["安心できる雰囲気をつくりたい","ありのままを受け入れたい","相手の話に耳を傾けたい"]
-}
-REASONS = ["抽象的すぎる","学年フィット不足","時間に合わない","準備物が不明","声かけが弱い","安全面が不十分","保護者対応が不足","根拠が薄い"]
-
-SENSITIVE_KEYS = [
-    "いじめ","いじ(め|り)","暴力","殴","蹴","排除","無視","仲間はずれ","脅",
-    "金(を|の)要求","晒し","SNS","ネットいじめ","自傷","自殺","死にたい",
-    "ハラスメント","性(的|被害)","体罰","恐喝","集団で","標的","陰口"
-]
-NG_PHRASES = [
-    "その場で(謝|和解)させる","仲直りさせる","両者をすぐ対面させる",
-    "被害者.*同席させる","全員で.*活動させる","我慢させる","許させる","被害者.*配慮なく"
-]
-
-DEFAULT_POLICY = {
-  "tone": {
-    "teacher": "最初にねぎらい→要点→次の一歩。断定/否定を避け選択肢で提案。",
-    "parent":  "不安を下げる語彙。1行要約→丁寧文。家庭でできる観察/声かけを具体に。",
-    "student_low":  "やさしい言葉、短い文、選べる言い方。",
-    "student_high": "尊重の語彙。理由→やり方→選択肢。命令形は避ける。"
-  },
-  "must_include": ["生徒の安全最優先", "個の尊重", "記録と共有の手順に従う"],
-  "avoid_phrases": ["その場で謝らせる","両者を即対面","恥をかかせる","我慢させる"],
-  "phrasebook": {
-    "teacher_open": "いつも本当におつかれさまです。状況を丁寧に見てこられたことが伝わってきました。",
-    "parent_open":  "いつもご協力ありがとうございます。学校として丁寧に様子を見てまいります。",
-    "ask_help":     "無理のない範囲で、次の点だけ一緒に見守っていただけますか。"
-  },
-  "value_mapping": {
-    "子どもの主体性を育てたい": ["自律","選択肢提示","自己決定理論"],
-    "自信を育てたい":           ["有能感","成功体験","形成的FB"],
-    "自分で選ばせたい":          ["選択肢","関与","自己決定理論"],
-    "少し頑張れる課題を出したい": ["最近接発達域","スモールステップ"],
-    "失敗を受け止めたい":        ["安心","学びのやり直し","成長志向"],
-    "プロセスを褒めたい":        ["形成的FB","努力の言語化"],
-    "安心できる雰囲気をつくりたい": ["心理的安全","関係性"],
-    "ありのままを受け入れたい":  ["受容","傾聴"],
-    "相手の話に耳を傾けたい":    ["アクティブリスニング","共感"]
-  }
-}
+# 部分再実行：操作したフラグメントだけを再実行する（1.37 以降は st.fragment）
+fragment = getattr(st, "fragment", None) or st.experimental_fragment
 
 # ================== 小ユーティリティ ==================
 def detect_sensitive(text:str)->bool:
-    if not text: return False
-    return any(re.search(p, text) for p in SENSITIVE_KEYS)
+    return SENSITIVE_SCANNER.search(text)
 
-def violates_ng(text:str)->bool:
-    if not text: return False
-    return any(re.search(p, text) for p in NG_PHRASES)
+AUTH_REFRESH_MARGIN = 60  # 有効期限の何秒前からリフレッシュするか
 
-def sb_client_with_token()->tuple[Client, object|None]:
-    """セッションのトークンを Supabase クライアントに反映し、現在ユーザーを返す"""
-    cli = create_client(SB_URL, SB_KEY)
+def _token_claims(token:str)->dict|None:
+    """アクセストークンをローカルで検証してクレームを返す（署名は秘密鍵がある場合のみ）"""
+    try:
+        if SB_JWT_SECRET:
+            return jwt.decode(token, SB_JWT_SECRET, algorithms=["HS256"], audience="authenticated",
+                              options={"verify_exp": False})
+        return jwt.decode(token, options={"verify_signature": False, "verify_exp": False})
+    except jwt.PyJWTError:
+        return None
+
+def _store_session(session):
+    st.session_state["sb_token"] = session.access_token
+    st.session_state["sb_refresh_token"] = session.refresh_token
+
+def _sb_auth_cache()->dict|None:
+    """セッション内のクライアント/ユーザーのキャッシュを用意する。
+    ネットワークに出るのは初回の get_user（秘密鍵なしの場合）と期限間近のリフレッシュのみ。"""
     token = st.session_state.get("sb_token")
-    if token:
+    if not token:
+        return None
+    cache = st.session_state.get("sb_auth")
+    if not cache:
+        cache = {"client": new_sb_client(), "token": None, "user": None}
+        st.session_state["sb_auth"] = cache
+    cli = cache["client"]
+
+    claims = _token_claims(token)
+    if claims and claims.get("exp", 0) - time.time() < AUTH_REFRESH_MARGIN:
+        # 期限間近 → リフレッシュトークンで更新
+        refresh = st.session_state.get("sb_refresh_token")
+        claims = None
+        if refresh:
+            try:
+                with tracer().span("supabase.auth.refresh"):
+                    res = cli.auth.refresh_session(refresh)
+                if res and res.session:
+                    _store_session(res.session)
+                    token = res.session.access_token
+                    claims = _token_claims(token)
+            except Exception:
+                pass
+    if not claims:
+        return None
+
+    if cache["token"] != token:
+        if SB_JWT_SECRET:
+            user = SimpleNamespace(id=claims["sub"], email=claims.get("email"))
+        else:
+            try:
+                with tracer().span("supabase.auth.get_user"):
+                    u = cli.auth.get_user(token)
+            except Exception:
+                u = None
+            user = u.user if (u and getattr(u, "user", None)) else None
+            if not user or user.id != claims.get("sub"):
+                return None
+        cli.postgrest.auth(token)
+        cache.update(token=token, user=user)
+    instrument_httpx(getattr(cli.postgrest, "session", None), tracer(), "supabase")  # リフレッシュで作り直されるので毎回確認
+    return cache
+
+def output_guard(scanner):
+    """生成中のバッファを増分でチェックする関数 check(buf, start) を返す。
+    NG 表現・避け語はどれも改行をまたがないので、新しいチャンクを含む現在行だけを見直す。"""
+    def check(buf:str, start:int=0)->bool:
+        return scanner.search(buf[buf.rfind("\n", 0, start) + 1:])
+    return check
+
+def add_usage(acc:dict, u)->None:
+    """API の usage（トークン数）を acc に加算する"""
+    if u:
+        acc["prompt_tokens"] = acc.get("prompt_tokens", 0) + (u.prompt_tokens or 0)
+        acc["completion_tokens"] = acc.get("completion_tokens", 0) + (u.completion_tokens or 0)
+
+def estimate_tokens(messages:list, max_tokens:int)->int:
+    """トークンバケットに積む見込み。入力は 1 字 1 トークンとみなし、出力は上限いっぱいで数える"""
+    return sum(len(m["content"]) for m in messages) + max_tokens
+
+def estimate_usage(acc:dict, messages:list, text:str)->None:
+    """打ち切ったストリームは最後の usage チャンクが届かないので、1 字 1 トークンで見積もって加算し印を付ける"""
+    acc["prompt_tokens"] = acc.get("prompt_tokens", 0) + sum(len(m["content"]) for m in messages)
+    acc["completion_tokens"] = acc.get("completion_tokens", 0) + len(text)
+    acc["usage_estimated"] = True
+
+def stream_completion(route:Route, messages:list, temperature:float, placeholder, check=None,
+                      usage:dict|None=None)->tuple[str, bool]:
+    """トークンを受け取り次第表示する。check が違反を検知したら打ち切り (途中テキスト, True) を返す"""
+    stream = llm(route.model, route.fallback_model).stream(messages, temperature=temperature, max_tokens=route.max_tokens)
+    if usage is not None:
+        usage["model"] = stream.model  # ヘッジ・切り替えで予備モデルが答えた場合もある
+    buf, counted = "", False
+    try:
+        for chunk in stream:
+            if usage is not None and chunk.usage:
+                add_usage(usage, chunk.usage)  # 最後のチャンクにだけ入る
+                counted = True
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if not delta:
+                continue
+            start = len(buf)
+            buf += delta
+            if check and check(buf, start):
+                return buf, True
+            placeholder.markdown(buf + "▌")
+    finally:
+        stream.close()  # 打ち切り時はここで接続を閉じ、残りの出力を受け取らない
+        if usage is not None and not counted:
+            estimate_usage(usage, messages, buf)
+    placeholder.markdown(buf)
+    return buf, False
+
+def generate_sections(cp, route:Route, consultation:dict, out, check, usage:dict, examples=())->tuple[str, bool]:
+    """6 部構成を部分ごと（② のレシピは 1 つずつ）に並行して生成し、完了したものから順番どおりに表示する。
+    避け語・NG 表現を含んだ部分だけを作り直す。同時に呼ぶのは OPENAI_MAX_CONCURRENCY 件まで。
+    途中で抜けるとき（失敗・再実行）は、生成中の部分のストリームも閉じて残りの出力を受け取らない"""
+    caller = llm(route.model, route.fallback_model)  # キャッシュ済みリソースはスクリプトのスレッドで取り出しておく
+    sched = scheduler()
+    stop = threading.Event()
+    streams, lock = set(), threading.Lock()
+
+    def read(messages:list, temperature:float, max_tokens:int, u:dict)->tuple[str, str]:
+        stream = caller.stream(messages, temperature=temperature, max_tokens=max_tokens)
+        with lock:
+            streams.add(stream)
+        buf, counted = [], False
         try:
-            cli.auth.set_auth(token)
-        except Exception:
-            pass
+            for chunk in stream:
+                if stop.is_set():
+                    raise CancelledError()
+                if chunk.usage:
+                    add_usage(u, chunk.usage)
+                    counted = True
+                if chunk.choices:
+                    buf.append(chunk.choices[0].delta.content or "")
+        finally:
+            with lock:
+                streams.discard(stream)
+            stream.close()
+            if not counted:
+                estimate_usage(u, messages, "".join(buf))
+        return stream.model, "".join(buf)
+
+    def one(sec):
+        u = {"prompt_tokens": 0, "completion_tokens": 0}
+        if stop.is_set():
+            raise CancelledError()
+        model, body = read(build_section_messages(cp, consultation, sec, examples=examples),
+                           route.temperature, sec.max_tokens, u)
+        bad = check(body)
+        if bad and not stop.is_set():
+            messages = build_section_messages(cp, consultation, sec, True, examples)
+            sched.charge(estimate_tokens(messages, sec.max_tokens))  # 作り直しは枠の見込みに入っていない
+            model, body = read(messages, route.repair_temperature, sec.max_tokens, u)
+        return body, bad, model, u
+
+    parts, repaired = {}, False
+    # 同時に出す呼び出しはスケジューラで確保した枠（min(部分の数, OPENAI_MAX_CONCURRENCY)）に収める
+    pool = ThreadPoolExecutor(max_workers=min(len(SECTIONS), OPENAI_MAX_CONCURRENCY), thread_name_prefix="albert-section")
+    try:
+        # 部分ごとのスパン（LLM 呼び出し）が generate の子になり org / user を引き継ぐよう、文脈を写して渡す
+        futs = {pool.submit(contextvars.copy_context().run, one, sec): sec for sec in SECTIONS}
+        out.info("部分ごとに並行して生成しています…")
+        for f in as_completed(futs):
+            body, bad, model, u = f.result()
+            parts[futs[f].key] = body
+            repaired = repaired or bad
+            usage["model"] = model
+            add_usage(usage, SimpleNamespace(**u))
+            if u.get("usage_estimated"):
+                usage["usage_estimated"] = True
+            left = len(SECTIONS) - len(parts)
+            out.markdown(merge_sections(parts) + (f"\n\n…残り {left} 部分を生成中" if left else ""))
+    finally:
+        stop.set()
+        with lock:
+            open_streams = list(streams)
+        for s in open_streams:  # 生成中の部分は接続を閉じる（読み手のスレッドは例外で抜ける）
+            s.close()
+        pool.shutdown(wait=False, cancel_futures=True)  # 未着手の部分は始めない
+    return merge_sections(parts), repaired
+
+def generate_answer(cp, route:Route, consultation:dict, out, check, usage:dict, examples=())->tuple[str, bool]:
+    """回答を route のモデル・上限で生成して out に表示し、(本文, 作り直したか) を返す"""
+    if OPENAI_SECTIONED:
+        return generate_sections(cp, route, consultation, out, check, usage, examples)
+    with tracer().span("prompt.build"):
+        messages = build_messages(cp, consultation, examples=examples, max_tokens=route.max_tokens)
+        repair = build_messages(cp, consultation, True, examples, route.max_tokens)
+    if route.stream:
+        text, repaired = stream_completion(route, messages, route.temperature, out, check, usage)
+        # セーフティ・チェック：違反を検知した時点で打ち切り、すぐに修正版を生成
+        if repaired:
+            out.info("安全面・学校ポリシーに配慮して提案を作り直しています…")
+            scheduler().charge(estimate_tokens(repair, route.max_tokens))
+            text, _ = stream_completion(route, repair, route.repair_temperature, out, usage=usage)
+        return text, repaired
+
+    caller = llm(route.model, route.fallback_model)
+    with st.spinner("生成中..."):
+        usage["model"], r = caller.complete(messages, temperature=route.temperature, max_tokens=route.max_tokens)
+        text = r.choices[0].message.content
+        add_usage(usage, r.usage)
+        # セーフティ・チェック
+        repaired = check(text)
+        if repaired:
+            scheduler().charge(estimate_tokens(repair, route.max_tokens))
+            usage["model"], r2 = caller.complete(repair, temperature=route.repair_temperature, max_tokens=route.max_tokens)
+            text = r2.choices[0].message.content
+            add_usage(usage, r2.usage)
+    out.markdown(text)
+    return text, repaired
+
+def scheduled_generate(org_id, key:str|None, cp, route:Route, consultation:dict, out, check, usage:dict,
+                       examples=())->tuple[str, bool, bool]:
+    """スケジューラの順番を待って生成する。同じ内容を生成中のセッションがあれば相乗りする。
+    (本文, 作り直したか, 相乗りしたか) を返す"""
+    sched = scheduler()
+    lead, fut = sched.join(key) if key else (True, None)
+    if not lead:
+        out.info("同じ内容の相談を生成中です。完了を待っています…")
+        try:
+            text, repaired = fut.result(timeout=FOLLOW_TIMEOUT)
+            out.markdown(text)
+            return text, repaired, True
+        except (FutureTimeout, CancelledError):
+            # 先頭のセッションが中断された・終わらない → 相乗りをやめて自分で生成する
+            key = None
+
+    if OPENAI_SECTIONED:  # 分割生成は部分ごとの入力と出力上限の合計
+        calls = len(SECTIONS)
+        est = sum(estimate_tokens(build_section_messages(cp, consultation, sec, examples=examples), sec.max_tokens)
+                  for sec in SECTIONS)
+    else:
+        calls = 1
+        est = estimate_tokens(build_messages(cp, consultation, examples=examples, max_tokens=route.max_tokens),
+                              route.max_tokens)
+    slot = sched.acquire(org_id, est, calls)
+    # 再実行・停止（BaseException）で抜けた場合も相乗り中のセッションを解放する
+    result, error = None, CancelledError("先頭のセッションの生成が中断されました")
     try:
-        u = cli.auth.get_user()
-    except Exception:
-        u = None
-    return cli, (u.user if (u and getattr(u, "user", None)) else None)
+        while not slot.wait(0.5):
+            out.info(f"混み合っています。順番待ち {slot.position() + 1} 番目（目安 約{slot.eta():.0f}秒）")
+        text, repaired = generate_answer(cp, route, consultation, out, check, usage, examples)
+        result, error = (text, repaired), None
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        slot.release()
+        if key:
+            sched.finish(key, result, error)
+    return text, repaired, False
+
+def new_sb_client()->"Client":
+    """トークンの更新は _sb_auth_cache だけが行う。gotrue の自動更新（期限 10 秒前のタイマー）は
+    セッションに保持したリフレッシュトークンを先に使ってしまい、再利用検知でセッションごと失効するので止める"""
+    from supabase import ClientOptions, create_client
+    return create_client(SB_URL, SB_KEY, options=ClientOptions(auto_refresh_token=False, persist_session=False))
+
+def sb_client_with_token()->tuple["Client", object|None]:
+    """セッションのトークンを Supabase クライアントに反映し、現在ユーザーを返す"""
+    cache = _sb_auth_cache()
+    if not cache:
+        return new_sb_client(), None
+    return cache["client"], cache["user"]
+
+@st.cache_resource
+def asset_store()->AssetStore:
+    """既定ポリシー・フォームの選択肢・プロンプト（プロセスで 1 回読み、ファイルが変われば読み直す）"""
+    return AssetStore(ASSETS_DIR, on_reload=lambda a: policy_cache().set_prompts(a.prompts))
+
+def assets()->Assets:
+    return asset_store().get()
+
+@st.cache_resource
+def policy_cache()->PolicyCache:
+    """org_policies のプロセス共有キャッシュ"""
+    return PolicyCache(prompts=assets().prompts)
+
+@st.cache_resource
+def response_cache()->"ResponseCache":
+    """同一内容の相談に対する回答のプロセス共有キャッシュ"""
+    from albert_llm import ResponseCache
+    return ResponseCache()
+
+@st.cache_resource
+def scheduler()->"GenerationScheduler":
+    """全セッションの生成呼び出しを束ねるスケジューラ"""
+    from albert_llm import GenerationScheduler
+    return GenerationScheduler(OPENAI_MAX_CONCURRENCY, OPENAI_RPM, OPENAI_TPM)
+
+@st.cache_resource
+def tracer()->Tracer:
+    """スパンの記録と書き出し（プロセス共有）"""
+    return Tracer(MetricsStore(TELEMETRY_DB), TELEMETRY_PROM_FILE, TELEMETRY_OTLP_FILE)
+
+def traced(op:str):
+    """関数の実行をスパンで囲む（フラグメント単体の再実行もここで計る）"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            prof = st.session_state.get("profile")
+            with tracer().span(op, **({"org": prof[1], "user": prof[0]} if prof else {})):
+                return fn(*args, **kwargs)
+        return run
+    return deco
+
+@st.cache_resource
+def openai_client()->"OpenAI":
+    """OpenAI クライアント（再試行は LLMCaller が受け持つので SDK 側では行わない）"""
+    from openai import OpenAI
+    return OpenAI(api_key=OPENAI_KEY, max_retries=0)
+
+@st.cache_resource
+def llm(model:str=OPENAI_MODEL, fallback_model:str|None=OPENAI_FALLBACK_MODEL)->"LLMCaller":
+    """期限・再試行・ヘッジ・サーキットブレーカー付きの生成呼び出し（モデルの組ごとにプロセス共有）"""
+    from albert_llm import LLMCaller
+    return LLMCaller(openai_client(), model, fallback_model, attempt_timeout=OPENAI_TIMEOUT,
+                     retries=OPENAI_RETRIES, hedge=OPENAI_HEDGE, on_headers=scheduler().observe,
+                     tracer=tracer())
+
+@st.cache_resource
+def retrieval()->"RetrievalIndex":
+    """good 評価の回答の類似検索（組織ごとの索引をプロセスで共有）"""
+    from albert_retrieval import RetrievalIndex
+    return RetrievalIndex(RETRIEVAL_DIR)
+
+@st.cache_resource
+def router()->Router:
+    """相談の内容から生成ルートを選ぶ（OPENAI_ROUTES の設定はプロセスで 1 回だけ読む）"""
+    return Router.from_config(OPENAI_ROUTES, OPENAI_MODEL, OPENAI_FAST_MODEL, OPENAI_FALLBACK_MODEL, OPENAI_STREAM)
+
+@st.cache_resource
+def writer()->WriteBehind:
+    """DB 書き込みのプロセス共有キュー（描画を待たせない）"""
+    return WriteBehind()
+
+def queue_write(label:str, fn, *args):
+    """書き込みをキューに積み、結果は次回以降の描画で report_writes() が確認する"""
+    # 同じセッションの書き込み（相談と回答 → そのフィードバック）は投入順に実行する
+    key = st.session_state.setdefault("write_key", new_id())
+    st.session_state.setdefault("pending_writes", []).append((label, writer().submit(label, fn, *args, key=key)))
+
+def report_writes():
+    """このセッションで積んだ書き込みのうち、最終的に失敗したものを知らせる"""
+    pending = st.session_state.get("pending_writes") or []
+    for label, fut in [w for w in pending if w[1].done()]:
+        if fut.exception():
+            st.sidebar.warning(f"保存に失敗しました（{label}）: {fut.exception()}")
+    st.session_state["pending_writes"] = [w for w in pending if not w[1].done()]
 
 # ================== 認証UI ==================
 def auth_view():
@@ -101,11 +426,12 @@ def auth_view():
         email = st.text_input("メールアドレス", key="login_email")
         pw = st.text_input("パスワード", type="password", key="login_pw")
         if st.button("ログイン", use_container_width=True):
-            cli = create_client(SB_URL, SB_KEY)
+            cli = new_sb_client()
             try:
-                res = cli.auth.sign_in_with_password({"email":email, "password":pw})
+                with tracer().span("supabase.auth.sign_in"):
+                    res = cli.auth.sign_in_with_password({"email":email, "password":pw})
                 if res and res.session and res.session.access_token:
-                    st.session_state["sb_token"] = res.session.access_token
+                    _store_session(res.session)
                     st.success("ログインしました。")
                     st.rerun()
                 else:
@@ -118,7 +444,7 @@ def auth_view():
         email2 = st.text_input("メールアドレス（新規）", key="reg_email")
         pw2 = st.text_input("パスワード（新規）", type="password", key="reg_pw")
         if st.button("新規登録", use_container_width=True):
-            cli = create_client(SB_URL, SB_KEY)
+            cli = new_sb_client()
             try:
                 res = cli.auth.sign_up({"email":email2, "password":pw2})
                 if res and res.user:
@@ -129,24 +455,33 @@ def auth_view():
                 st.error(f"登録に失敗: {e}")
 
 # ================== プロファイル/所属の用意 ==================
+def default_policy()->dict:
+    """新しい組織の org_policies に入れる列（albert_policy.json）"""
+    p = assets().policy
+    return {k: p[k] for k in ("tone", "must_include", "avoid_phrases", "phrasebook", "value_mapping")}
+
 def ensure_profile_and_org():
+    """(uid, org_id, meta) を返す。所属が確定したらセッションに保持し、以降の再実行では DB を読まない"""
     cli, user = sb_client_with_token()
     if not user:
         return None, None, None
     auth_uid = user.id
     email = user.email
+    prof = st.session_state.get("profile")
+    if prof and prof[0] == auth_uid:
+        return prof
 
     # users upsert
     cli.table("users").upsert({"id":auth_uid, "email":email}).execute()
 
     # 既存の所属
-    mem = cli.table("memberships").select("org_id, role, orgs(name)").eq("user_id", auth_uid).execute()
-    rows = mem.data or []
+    rows = memberships(cli, auth_uid)
     if rows:
         org_id = rows[0]["org_id"]
         role = rows[0]["role"]
         org_name = rows[0]["orgs"]["name"]
-        return auth_uid, org_id, {"role":role, "org_name":org_name}
+        st.session_state["profile"] = (auth_uid, org_id, {"role":role, "org_name":org_name, "email":email})
+        return st.session_state["profile"]
 
     # 所属がなければ作成ウィザード
     st.subheader("はじめての設定（組織の作成）")
@@ -158,12 +493,7 @@ def ensure_profile_and_org():
         org_id = org.data[0]["id"]
         cli.table("memberships").insert({"org_id":org_id, "user_id":auth_uid, "role":"admin"}).execute()
         cli.table("org_policies").insert({
-            "org_id":org_id, "tone":DEFAULT_POLICY["tone"],
-            "must_include":DEFAULT_POLICY["must_include"],
-            "avoid_phrases":DEFAULT_POLICY["avoid_phrases"],
-            "phrasebook":DEFAULT_POLICY["phrasebook"],
-            "value_mapping":DEFAULT_POLICY["value_mapping"],
-            "updated_by":auth_uid
+            "org_id":org_id, **default_policy(), "updated_by":auth_uid
         }).execute()
         st.success("組織を作成しました。")
         st.rerun()
@@ -171,22 +501,19 @@ def ensure_profile_and_org():
     st.stop()
 
 # ================== ポリシー編集（簡易） ==================
+@fragment
+@traced("fragment.policy_editor")
 def policy_editor(org_id):
     st.subheader("学校ポリシー（簡易）")
     cli, _ = sb_client_with_token()
-    pol = cli.table("org_policies").select("*").eq("org_id", org_id).execute().data
-    if not pol:
+    cp = policy_cache().get(cli, org_id)
+    if not cp:
         st.info("ポリシーが未設定です。初期値を作成します。")
-        cli.table("org_policies").insert({
-            "org_id":org_id, "tone":DEFAULT_POLICY["tone"],
-            "must_include":DEFAULT_POLICY["must_include"],
-            "avoid_phrases":DEFAULT_POLICY["avoid_phrases"],
-            "phrasebook":DEFAULT_POLICY["phrasebook"],
-            "value_mapping":DEFAULT_POLICY["value_mapping"]
-        }).execute()
-        pol = cli.table("org_policies").select("*").eq("org_id", org_id).execute().data
-    p = pol[0]
-    phrase = p["phrasebook"]
+        cli.table("org_policies").insert({"org_id":org_id, **default_policy()}).execute()
+        policy_cache().invalidate(org_id)
+        cp = policy_cache().get(cli, org_id)
+    p = cp.row
+    phrase = dict(p["phrasebook"])  # キャッシュ上の値を書き換えない
 
     with st.expander("口調・フレーズ（必要に応じて編集）", expanded=False):
         teacher_open = st.text_input("先生への冒頭", phrase.get("teacher_open",""))
@@ -194,35 +521,44 @@ def policy_editor(org_id):
         if st.button("フレーズを保存"):
             phrase["teacher_open"]=teacher_open; phrase["parent_open"]=parent_open
             cli.table("org_policies").update({"phrasebook":phrase}).eq("id", p["id"]).execute()
+            policy_cache().invalidate(org_id)
             st.success("保存しました。")
 
 # ================== 相談 → 生成 → 保存 ==================
 def consult_and_generate(uid, org_id):
     st.subheader("相談")
+    consult_form(uid, org_id)
+    answer_panel(uid, org_id)
+
+@fragment
+@traced("fragment.consult_form")
+def consult_form(uid, org_id):
+    """相談フォームと生成。生成した回答はセッションに置き、回答パネルが表示する"""
+    form = assets().form  # 選択肢は albert_form.json（プロセスで共有・不変）
     with st.form("albert_form"):
         c1, c2 = st.columns(2)
-        grade = c1.selectbox("学年 / 年齢", ["","幼児","小1-2","小3-4","小5-6","中1-3","高1-3","大学・成人","その他"])
-        scale = c2.selectbox("人数・規模", ["","個別","数人（2-5）","小グループ（6-10）","学級全体"])
+        grade = c1.selectbox("学年 / 年齢", form["grades"])
+        scale = c2.selectbox("人数・規模", form["scales"])
 
         c3, c4 = st.columns(2)
-        scene = c3.selectbox("場面", ["","授業中","授業準備・片付け","休み時間","HR・学活","行事","保護者対応","部活動","オンライン学習"])
-        frequency = c4.selectbox("頻度", ["","初回","時々","継続的（週1-2）","慢性的（ほぼ毎回）"])
+        scene = c3.selectbox("場面", form["scenes"])
+        frequency = c4.selectbox("頻度", form["frequencies"])
 
         c5, c6 = st.columns(2)
-        urgency = c5.selectbox("緊急度", ["","低","中","高"])
-        emotion = c6.selectbox("あなたの今の気持ち", ["","困惑","焦り","怒り","心配","無力感","期待","落ち着いている"])
+        urgency = c5.selectbox("緊急度", form["urgencies"])
+        emotion = c6.selectbox("あなたの今の気持ち", form["emotions"])
 
         c7, c8 = st.columns(2)
-        subject = c7.selectbox("教科", ["未指定","国語","算数/数学","理科","社会","英語","体育","音楽","美術/図工","技家","総合"])
-        timebox = c8.selectbox("時間制約（実施可能目安）", ["未指定","~5分","~10分","~15分","~30分"])
+        subject = c7.selectbox("教科", form["subjects"])
+        timebox = c8.selectbox("時間制約（実施可能目安）", form["timeboxes"])
 
-        specificity = st.selectbox("具体度レベル", ["標準","高め（超具体）"])
+        specificity = st.selectbox("具体度レベル", form["specificities"])
         message = st.text_area("相談内容（できるだけ具体に）", height=110)
         attempts = st.text_area("これまで試したこと（100字以内）", height=70, max_chars=100)
 
         st.markdown("**あなたが大切にしていること（最大4つ）**")
         values = []
-        for sec, opts in GROUPED.items():
+        for sec, opts in form["value_groups"].items():
             st.caption(sec)
             selected = st.multiselect("　", opts, key=f"vals_{sec}", label_visibility="collapsed")
             values.extend(selected)
@@ -249,206 +585,127 @@ def consult_and_generate(uid, org_id):
     if not submitted:
         return
 
-    # ポリシー取得
+    from albert_llm import CircuitOpenError, consultation_key
+    # ポリシー取得（プロセス内キャッシュ）
     cli, _ = sb_client_with_token()
-    pol = cli.table("org_policies").select("*").eq("org_id", org_id).execute().data[0]
-    tone = pol["tone"]; phrase = pol["phrasebook"]
-    must_include = "・".join(pol["must_include"])
-    avoid_words  = "・".join(pol["avoid_phrases"])
-    vmapping = pol["value_mapping"]
-
-    vtags = []
-    for v in values: vtags += vmapping.get(v, [])
-    vtags = "｜".join(sorted(set(vtags))) if vtags else "（無し）"
-    value_text = "\n".join([f"- {v}" for v in values]) if values else "（特に指定なし）"
-
-    safety_block = ""
+    with tracer().span("policy.get"):
+        cp = policy_cache().get(cli, org_id)
     needs_safety = show_safety
-    if needs_safety:
-        safety_block = f"""
-【安全ガード】
-- 被害側の曝露を避け、分離/見守り/記録/報告を優先。AIは独断で判断しない。
-- “仲直り/その場での謝罪/即対面/被害者の同席強制/一斉の活動強制”は行わない。
-- 具体行動は「誰が・どこで・何を・何分で・想定リスク・代替案」を明記。
-- 安全確認: Q1={s_q1} / Q2={s_q2} / Q3={s_q3}
-"""
-
-    fewshot = """
-【例】
-相談: 授業中に立ち歩く小2男子がいる
-価値観: 子どもの主体性 / 安心
-回答:
-0) 先生へのひと言
-- ここまで丁寧に見てこられたこと自体が土台です。短い一歩から一緒に整えましょう。
-① 背景（理論タグ）
-- 自席維持が難しい場合「注目の獲得」「体幹/感覚の欲求」が混在します。【根拠: PBIS】
-② 明日ためせる行動レシピ
-- 役割(プリント配り)を固定→成功を言語化【根拠: PBIS】
-- 15分毎ストレッチを全体で導入【根拠: タイムオンタスク】
-- 授業前30秒で役割予告【根拠: 前方支援】
-③ 保護者への伝え方
-- 1行要約＋丁寧文（家庭の観察ポイントを1つ）
-④ 子どもへの声かけ（低/高）
-- 「次はどれからやってみる？」/「どっちで進めるのがやりやすい？」
-⑤ 成功の観察指標
-- 立ち歩きの回数/役割の完了回数
-⑥ 注意とフォロー
-- 罰の席替えは逆効果。役割は更新。
-"""
-    theory_catalog = """
-【理論候補】
-- 自己決定理論（Deci & Ryan）/ 形成的フィードバック（Black & Wiliam）
-- 最近接発達域・協同（Vygotsky）/ 認知負荷（Sweller）/ ワーキングメモリ（Baddeley）
-- スモールステップ・強化（Skinner）/ タイムオンタスク / PBIS
-"""
-
-    prompt = f"""
-あなたは教育支援AI「Albert」。先生を支え、子どもの成長と保護者の安心を後押しし、学校の価値観に合う提案だけを返します。
-出力は「ねぎらい→具体策→言い換え（保護者/生徒）→観察→注意」。
-
-【学校ポリシー（要反映）】
-- 必須: {must_include}
-- 避ける言い回し: {avoid_words}
-- フレーズ集: 先生冒頭「{phrase.get('teacher_open','')}」/ 保護者冒頭「{phrase.get('parent_open','')}」
-
-{safety_block}
-
-【与件】
-- 価値観：
-{value_text}
-（価値観タグ）{vtags}
-- 対象：{grade} / 教科：{subject} / 規模・場面：{scene} / 頻度：{frequency} / 緊急度：{urgency}
-- 教師の感情：{emotion}
-- 既試行策：{attempts if attempts else "（未記入）"}
-- 相談内容：「{message}」
-- 時間制約目安：{timebox}
-
-【理論候補】{theory_catalog}
-
-【出力形式（順番厳守 / 900〜1,200字）】
-0) 先生へのひと言（30〜60字）
-① 背景の見立て（理論タグ1つ）【根拠: 理論名/研究者】
-② 明日ためせる行動レシピ ×3
-  必須: 目的 / 適用条件（学年・場面・所要・準備物）/ 手順（3〜5）/ 声かけ例 / 代替案 / 失敗時の一手 / 観察指標 / 【根拠】 / 価値観タグ
-③ 保護者への伝え方（1行要約＋丁寧文＋家庭での観察1つ）
-④ 子どもへの声かけ（低学年/中高生の2パターン）
-⑤ 成功の観察指標（2つ）
-⑥ 注意とフォロー（安全最優先）
-
-【厳守ルール】
-- {timebox} の範囲で実施可能。抽象で終わらず、数値・固有名詞・具体動作を入れる。
-- 学校ポリシーに反する提案はしない（避け語は出力に含めない）。
-- 思考過程は出さない。最終出力のみ。
-"""
-    if specificity == "高め（超具体）":
-        prompt += "\n【追加制約】各レシピは60〜120字で具体化。固有名詞・数値・具体動作を必ず含める。\n"
-
-    # 生成
-    with st.spinner("生成中..."):
-        r = oa.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[{"role":"system","content": fewshot + "\n" + prompt}],
-            temperature=0.45, max_tokens=1200
-        )
-        text = r.choices[0].message.content
-        # セーフティ・チェック
-        if detect_sensitive(message) and violates_ng(text):
-            fix = "【修正指示】安全最優先・分離と見守り・記録と報告を前提に、被害側の曝露を避け、個別/環境調整中心で再提案。"
-            r2 = oa.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=[{"role":"system","content": fewshot + "\n" + prompt + "\n" + fix}],
-                temperature=0.4, max_tokens=1200
-            )
-            text = r2.choices[0].message.content
-
-    # 保存
-    topics = []
-    rules = [
-        (r"いじめ|暴力|脅|自傷|自殺|安全|被害", "安全/人間関係"),
-        (r"保護者|家庭|連絡|面談", "保護者対応"),
-        (r"提出|宿題|課題|忘れ|未提出", "課題・提出"),
-        (r"遅刻|欠席|不登校|登校しぶり", "出欠"),
-        (r"集中|立ち歩き|私語|規律|荒れ", "授業規律"),
-        (r"評価|テスト|成績|アセスメント", "評価"),
-        (r"友だち|仲間|グループ|孤立", "関係性"),
-    ]
-    for pat, tag in rules:
-        if re.search(pat, message): topics.append(tag)
-    if not topics: topics = ["未分類"]
-
-    cli, _ = sb_client_with_token()
-    cli.table("consultations").insert({
+    consultation = {
         "org_id": org_id, "user_id": uid, "grade": grade, "scale": scale, "scene": scene,
         "frequency": frequency, "urgency": urgency, "emotion": emotion, "subject": subject,
         "timebox": timebox, "specificity": specificity, "message": message, "attempts": attempts,
         "values": values, "sensitive_flag": needs_safety,
         "safety_answers": {"q1": s_q1, "q2":s_q2, "q3":s_q3} if needs_safety else None,
-        "topics": topics
-    }).execute()
+    }
 
-    # 直近を取得して answers 連携
-    cons = cli.table("consultations").select("id").eq("user_id", uid).order("created_at", desc=True).limit(1).execute().data[0]
-    cid = cons["id"]
-    cli.table("answers").insert({
-        "consultation_id": cid, "model": OPENAI_MODEL, "safety_mode": needs_safety, "text": text
-    }).execute()
+    route = router().choose(consultation)  # 緊急度・具体度・センシティブ・時間制約でモデルと上限を決める
 
-    # 表示
-    st.caption("この入力で生成： " + " / ".join([x for x in [grade, scene, timebox, urgency, emotion] if x]))
-    st.markdown(text)
+    # 参考例：この組織で good 評価だった似た相談（センシティブな相談には使わない）
+    examples = []
+    if RETRIEVAL_K and not needs_safety:
+        with tracer().span("retrieval.search") as rs:
+            examples = retrieval().search(org_id, consultation, RETRIEVAL_K, cli)
+            rs.set(hits=len(examples))
 
-    # フィードバック
+    # 生成
+    caption = "この入力で生成： " + " / ".join([x for x in [grade, scene, timebox, urgency, emotion] if x])
+    st.caption(caption)
+    out = st.empty()
+    check = output_guard(cp.output_scanner(auto_sensitive))
+    usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    with tracer().span("generate", route=route.name) as gen:
+        t0 = time.perf_counter()
+        # 応答キャッシュ：同じ入力・同じポリシー版・同じ素材（プロンプト）版なら LLM を呼ばない（センシティブな相談は対象外）
+        rc = response_cache()
+        cache_key = None if needs_safety else consultation_key(consultation, org_id, cp.version,
+                                                              f"{route.name}:{route.model}", specificity,
+                                                              assets().version)
+        hit = rc.get(cache_key) if cache_key else None
+        shared = bool(hit)
+        if hit:
+            text, repaired = hit["text"], False
+            out.markdown(text)
+        else:
+            if not cache_key:
+                rc.skip()
+            try:
+                text, repaired, shared = scheduled_generate(org_id, cache_key, cp, route, consultation, out, check,
+                                                            usage, examples)
+            except CircuitOpenError:
+                gen.error = "CircuitOpenError"
+                out.error("AI サービスが一時的に応答していません。少し時間をおいて、もう一度「提案を生成」を押してください。")
+                return
+            except Exception as e:
+                gen.error = type(e).__name__
+                out.error(f"生成に失敗しました。入力内容はそのままです。もう一度お試しください。（{type(e).__name__}）")
+                return
+            if cache_key and not shared:
+                rc.put(cache_key, {"text": text})
+        latency_ms = int((time.perf_counter() - t0) * 1000)
+        gen.set(model=usage.get("model", route.model), cache_hit=shared, repaired=repaired,
+                prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"],
+                usage_estimated=usage.get("usage_estimated", False))
+
+    # 保存（相談＋回答を 1 回の RPC で。ID は先に採番し、書き込み自体はバックグラウンドで行う）
+    consultation.update(id=new_id(), created_at=utcnow_iso(), topics=classify_topics(message))
+    answer = {
+        "id": new_id(), "consultation_id": consultation["id"], "created_at": utcnow_iso(),
+        "model": usage.get("model", route.model), "route": route.name, "safety_mode": needs_safety, "text": text,
+        # 派生値（ダッシュボードは本文を読まずにこれらの列だけを集計する）
+        "repaired": repaired, "latency_ms": latency_ms, "cache_hit": shared,
+        "prompt_tokens": usage["prompt_tokens"], "completion_tokens": usage["completion_tokens"],
+        **answer_facts(text, cp.avoid_phrases)
+    }
+    queue_write("相談と回答", save_consultation, cli, consultation, answer)
+    st.session_state["answer_panel"] = {"caption": caption, "text": text, "answer_id": answer["id"],
+                                        "consultation": consultation}
+    st.rerun()  # 回答パネルを新しい回答で描き直す
+
+@fragment
+@traced("fragment.answer_panel")
+def answer_panel(uid, org_id):
+    """直近の回答とフィードバック。フィードバックの操作はこのパネルだけを再実行する"""
+    panel = st.session_state.get("answer_panel")
+    if not panel:
+        return
+    st.caption(panel["caption"])
+    st.markdown(panel["text"])
+
+    # フィードバック（フォームにして、送信するまで再実行しない）
     with st.expander("しっくりきませんか？ フィードバック"):
-        c1, c2 = st.columns([1,2])
-        rating = c1.radio("役立ち度", ["good","ok","bad"], horizontal=True, index=1)
-        reasons = c2.multiselect("不足していた点（複数可）", REASONS)
-        note = st.text_input("メモ（任意）")
-        if st.button("フィードバックを保存"):
-            ans = cli.table("answers").select("id").eq("consultation_id", cid).order("created_at", desc=True).limit(1).execute().data[0]
-            cli.table("feedbacks").insert({
-                "answer_id": ans["id"], "org_id": org_id, "user_id": uid,
-                "rating": rating, "reasons": reasons, "note": note
-            }).execute()
-            st.success("保存しました。次回以降の最適化に使われます。")
+        with st.form("feedback_form"):
+            c1, c2 = st.columns([1,2])
+            rating = c1.radio("役立ち度", ["good","ok","bad"], horizontal=True, index=1)
+            reasons = c2.multiselect("不足していた点（複数可）", assets().form["reasons"])
+            note = st.text_input("メモ（任意）")
+            if st.form_submit_button("フィードバックを保存"):
+                cli, _ = sb_client_with_token()
+                queue_write("フィードバック", save_feedback, cli, {
+                    "id": new_id(), "answer_id": panel["answer_id"], "org_id": org_id, "user_id": uid,
+                    "rating": rating, "reasons": reasons, "note": note
+                })
+                if rating == "good":  # 次の似た相談から参考例に使う（他プロセス分は sync で取り込む）
+                    queue_write("参考例", retrieval().add, org_id,
+                                [(panel["answer_id"], panel["consultation"], panel["text"])])
+                st.success("保存しました。次回以降の最適化に使われます。")
 
 # ================== ダッシュボード（最小） ==================
+@fragment
+@traced("fragment.dashboard")
 def dashboard(org_id):
     st.subheader("ダッシュボード（β・最小）")
     cli, _ = sb_client_with_token()
     days = st.selectbox("期間", [7,28,90], index=1)
-    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
-
-    cons = cli.table("consultations").select("*").eq("org_id", org_id).gte("created_at", since).execute().data or []
-    answers = cli.table("answers").select("id, consultation_id, created_at, text").execute().data or []
-    fbs = cli.table("feedbacks").select("*").eq("org_id", org_id).gte("created_at", since).execute().data or []
 
-    # 1) 行動実行率
-    teacher_count = len(set([c["user_id"] for c in cons])) or 1
-    weeks = max(days/7.0, 1.0)
-    action_rate = round(len(cons)/teacher_count/weeks, 2)
-
-    # 2) Helpful率
-    helpful = [fb for fb in fbs if fb["rating"]=="good"]
-    helpful_rate = round(100*len(helpful)/max(len(fbs),1), 1)
-
-    # 3) 再生成率（仮：メモに「再」が含まれる割合）
-    regen_rate = round(100*len([fb for fb in fbs if "再" in (fb.get("note") or "")])/max(len(answers),1), 1)
-
-    # 4) 時間適合率
-    bad_time = sum([1 for fb in fbs if "時間に合わない" in (fb.get("reasons") or [])])
-    time_fit_rate = round(100*(1 - bad_time/max(len(fbs),1)), 1)
-
-    # 5) センシティブ比率
-    sens = sum([1 for c in cons if c["sensitive_flag"]])
-    sens_rate = round(100*sens/max(len(cons),1), 1)
-
-    # 6) ポリシー整合率（簡易：避け語が本文に出ていない割合）
-    pol = cli.table("org_policies").select("avoid_phrases").eq("org_id", org_id).execute().data[0]
-    avoid = pol["avoid_phrases"] or []
-    def violates(text):
-        return any(w in (text or "") for w in avoid)
-    bad_policy = sum(1 for a in answers if violates(a["text"]))
-    policy_ok_rate = round(100*(1 - bad_policy/max(len(answers),1)), 1)
+    # KPI は DB 側で日次ロールアップから集計（supabase/migrations の dashboard_kpis）
+    k = cli.rpc("dashboard_kpis", {"p_org_id": org_id, "p_days": days}).execute().data or {}
+    action_rate = k.get("action_rate", 0)      # 1) 行動実行率
+    helpful_rate = k.get("helpful_rate", 0)    # 2) Helpful率
+    regen_rate = k.get("regen_rate", 0)        # 3) 再生成率（安全/ポリシー違反で作り直した割合）
+    time_fit_rate = k.get("time_fit_rate", 0)  # 4) 時間適合率
+    sens_rate = k.get("sens_rate", 0)          # 5) センシティブ比率
+    policy_ok_rate = k.get("policy_ok_rate", 0)  # 6) ポリシー整合率（簡易：避け語が本文に出ていない割合）
 
     c1,c2,c3 = st.columns(3)
     c1.metric("行動実行率 / 週（主KPI）", action_rate)
@@ -460,51 +717,156 @@ def dashboard(org_id):
     c6.metric("ポリシー整合率（%）", policy_ok_rate)
 
     # 簡易：トピック分布
-    topics = Counter()
-    for c in cons:
-        for t in (c.get("topics") or []):
-            topics[t]+=1
+    topics = k.get("topics") or []
     if topics:
         st.write("**トピック件数（上位）**")
-        for k,v in topics.most_common(10):
-            st.write(f"- {k}: {v}")
+        for t in topics:
+            st.write(f"- {t['topic']}: {t['n']}")
+
+# ================== 運用（計測の集計） ==================
+@fragment
+@traced("fragment.ops_view")
+def ops_view(org_id, email):
+    st.subheader("運用（所要時間・トークン消費）")
+    hours = st.selectbox("期間", [1, 24, 168], index=1, format_func=lambda h: f"直近 {h} 時間")
+    since = time.time() - hours * 3600
+    tracer().flush(1.0)  # 書き出し待ちのスパンも含める
+    store = tracer().store
+
+    # 他の組織の所要時間・消費は運用者（OPS_ADMIN_EMAILS）にだけ見せる
+    ops_admin = email in OPS_ADMIN_EMAILS
+    st.write("**操作ごとの所要時間（ミリ秒）**")
+    st.dataframe(store.latency(since, None if ops_admin else str(org_id)), use_container_width=True, hide_index=True)
+
+    spend = store.token_spend(since)
+    if not ops_admin:
+        spend = [r for r in spend if r["org"] == str(org_id)]
+    st.write("**組織ごとのトークン消費**")
+    st.dataframe(spend, use_container_width=True, hide_index=True)
+
+    # ルートごとの所要時間と評価（answers.route と feedbacks を DB 側で集計。OPENAI_ROUTES の調整用）
+    cli, _ = sb_client_with_token()
+    since_iso = datetime.fromtimestamp(since, timezone.utc).isoformat()
+    st.write("**生成ルートごとの所要時間・評価**")
+    st.dataframe(cli.rpc("route_stats", {"p_org_id": org_id, "p_since": since_iso}).execute().data or [],
+                 use_container_width=True, hide_index=True)
+
+# ================== エクスポート（管理者） ==================
+JST = timezone(timedelta(hours=9))
+EXPORT_LABELS = {"csv": "CSV（Excel 向け）", "parquet": "Parquet", "arrow": "Arrow IPC"}
+# st.download_button はファイル全体をメモリ上のメディア置き場に読み込み、フラグメントの再実行のたびに
+# 読み直す。画面からは圧縮される形式だけを EXPORT_MAX_MB まで出し、CSV や大きな出力は albert_export.py の CLI で
+APP_EXPORT_FORMATS = ("parquet", "arrow")
+EXPORT_MAX_MB = float(st.secrets.get("EXPORT_MAX_MB", 50))
+EXPORT_PREFIX = "albert_export_"
+EXPORT_KEEP_S = 24 * 3600  # セッションの破棄で消えなかった一時ファイル（異常終了など）はこれを過ぎたら消す
+
+def _remove_quietly(path:str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
-# ================== メイン ==================
-def main():
-    # 🔐 厳格ログインガード（セッションに頼らず毎回 Supabase に確認）
-    cli = create_client(SB_URL, SB_KEY)
-    token = st.session_state.get("sb_token")
-    if token:
+class TempExport:
+    """エクスポートの一時ファイル。セッションが終わって session_state ごと破棄されたら消える"""
+
+    def __init__(self, path:str, fmt:str, rows:int, name:str):
+        self.path, self.fmt, self.rows, self.name = path, fmt, rows, name
+        self._finalizer = weakref.finalize(self, _remove_quietly, path)
+
+    def remove(self):
+        self._finalizer()
+
+def _sweep_exports():
+    tmp = tempfile.gettempdir()
+    for f in os.listdir(tmp):
+        p = os.path.join(tmp, f)
         try:
-            cli.auth.set_auth(token)
-        except Exception:
+            if f.startswith(EXPORT_PREFIX) and time.time() - os.path.getmtime(p) > EXPORT_KEEP_S:
+                os.remove(p)
+        except OSError:
             pass
-    try:
-        res = cli.auth.get_user()
-        current_user = res.user if res and getattr(res, "user", None) else None
-    except Exception:
-        current_user = None
+
+@fragment
+@traced("fragment.export_view")
+def export_view(org_id):
+    """期間を指定して相談・回答・フィードバックを書き出す。行はページごとに一時ファイルへ書き足す"""
+    st.subheader("エクスポート（相談・回答・フィードバック）")
+    st.caption(f"画面からは圧縮形式（Parquet / Arrow IPC）で {EXPORT_MAX_MB:g}MB まで。"
+               "CSV や大きな期間は albert_export.py（コマンドライン）で書き出してください。")
+    today = datetime.now(JST).date()
+    c1, c2 = st.columns(2)
+    start = c1.date_input("開始日", today - timedelta(days=30))
+    end = c2.date_input("終了日", today)
+    fmt = st.selectbox("形式", APP_EXPORT_FORMATS, format_func=EXPORT_LABELS.get)
+    redact = st.checkbox("センシティブな相談の自由記述（相談内容・既試行策・回答・メモ）を伏せる", value=True)
+
+    if st.button("エクスポートを作成"):
+        old = st.session_state.pop("export", None)
+        if old:
+            old.remove()
+        _sweep_exports()
+        cli, _ = sb_client_with_token()
+        since = datetime(start.year, start.month, start.day, tzinfo=JST)
+        until = datetime(end.year, end.month, end.day, tzinfo=JST) + timedelta(days=1)
+        path = os.path.join(tempfile.gettempdir(), f"{EXPORT_PREFIX}{new_id()}.{fmt}")
+        exp = TempExport(path, fmt, 0, f"albert_{start:%Y%m%d}-{end:%Y%m%d}.{fmt}")  # 失敗しても破棄で消える
+        progress = st.empty()
+        with tracer().span("export", format=fmt, redact=redact) as sp:
+            exp.rows = export(cli, org_id, [open_sink(path, fmt)], since.isoformat(), until.isoformat(), redact=redact,
+                              detect=detect_sensitive, progress=lambda n: progress.caption(f"{n} 件を書き出し中…"))
+            sp.set(rows=exp.rows, bytes=os.path.getsize(path))
+        progress.empty()
+        mb = os.path.getsize(path) / 1e6
+        if mb > EXPORT_MAX_MB:
+            exp.remove()
+            st.error(f"{mb:.1f}MB になり、画面からの上限（{EXPORT_MAX_MB:g}MB）を超えました。"
+                     "期間を短くするか、albert_export.py で書き出してください。")
+        else:
+            st.session_state["export"] = exp
+
+    exp = st.session_state.get("export")
+    if exp and os.path.exists(exp.path):
+        with open(exp.path, "rb") as f:
+            st.download_button(f"ダウンロード（{exp.rows} 件・{EXPORT_LABELS[exp.fmt]}）", f,
+                               file_name=exp.name, mime=FORMATS[exp.fmt][0])
+
+# ================== メイン ==================
+def main():
+    # 🔐 厳格ログインガード（トークンを毎回ローカル検証し、期限間近なら Supabase で更新）
+    # トークンがなければクライアントを作らない（supabase の読み込みもログイン操作まで遅らせる）
+    auth = _sb_auth_cache()
+    current_user = auth["user"] if auth else None
 
     if not current_user:
         # 念のため古いトークンを破棄
-        st.session_state.pop("sb_token", None)
+        for k in ("sb_token", "sb_refresh_token", "sb_auth", "profile", "answer_panel"):
+            st.session_state.pop(k, None)
         auth_view()
         st.stop()  # ← ここが重要（以降を描画しない）
 
     # 認証済み：プロフィールと所属を確保
     uid, org_id, meta = ensure_profile_and_org()
+    tracer().current().set(org=org_id, user=uid)
     st.sidebar.success(f"{meta['org_name']}（{meta['role']}）としてログイン中")
+    report_writes()
     if st.sidebar.button("ログアウト"):
         st.session_state.clear(); st.rerun()
 
-    tab = st.sidebar.radio("メニュー", ["相談","ダッシュボード","設定"])
+    tabs = ["相談","ダッシュボード","設定"] + (["運用","エクスポート"] if meta["role"] == "admin" else [])
+    tab = st.sidebar.radio("メニュー", tabs)
     if tab == "相談":
         consult_and_generate(uid, org_id)
     elif tab == "ダッシュボード":
         dashboard(org_id)
+    elif tab == "運用":
+        ops_view(org_id, meta.get("email"))
+    elif tab == "エクスポート":
+        export_view(org_id)
     else:
         policy_editor(org_id)
         st.info("※ 詳細な管理画面は今後拡充します。")
 
-# 起動
-main()
+# 起動（1 回の再実行をまとめて計測する）
+with tracer().span("rerun"):
+    main()
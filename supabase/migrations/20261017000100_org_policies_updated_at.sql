@@ -0,0 +1,19 @@
+-- org_policies の版（updated_at）を更新のたびに進める。
+-- アプリのポリシーキャッシュ（albert_prompt.PolicyCache）はこの列で変更を検知する。
+alter table public.org_policies
+  add column if not exists updated_at timestamptz not null default now();
+
+create or replace function public.touch_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+  new.updated_at := now();
+  return new;
+end;
+$$;
+
+drop trigger if exists org_policies_touch_updated_at on public.org_policies;
+create trigger org_policies_touch_updated_at
+  before update on public.org_policies
+  for each row execute function public.touch_updated_at();
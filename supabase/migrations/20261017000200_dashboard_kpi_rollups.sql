@@ -0,0 +1,262 @@
+-- ダッシュボード KPI のサーバー側集計。
+-- consultations / answers / feedbacks への INSERT ごとに日次ロールアップを加算し、
+-- dashboard_kpis() は「期間内の完全な日 = ロールアップ」「期間の開始日 = 生データ」を合算して返す。
+-- 定義は streamlit_app.dashboard の従来の Python 計算と同じ（answers は組織・期間で絞る）。
+-- 前提: topics / avoid_phrases / reasons は text[]。
+
+create table if not exists public.kpi_daily (
+  org_id            uuid not null,
+  day               date not null,
+  consultations     int  not null default 0,
+  sensitive         int  not null default 0,
+  answers           int  not null default 0,
+  policy_violations int  not null default 0,
+  feedbacks         int  not null default 0,
+  helpful           int  not null default 0,
+  regen_notes       int  not null default 0,
+  time_misfit       int  not null default 0,
+  primary key (org_id, day)
+);
+
+create table if not exists public.kpi_daily_teachers (
+  org_id        uuid not null,
+  day           date not null,
+  user_id       uuid not null,
+  consultations int  not null default 0,
+  primary key (org_id, day, user_id)
+);
+
+create table if not exists public.kpi_daily_topics (
+  org_id uuid not null,
+  day    date not null,
+  topic  text not null,
+  n      int  not null default 0,
+  primary key (org_id, day, topic)
+);
+
+-- 直接の読み書きは不可（RPC とトリガーからのみ）
+alter table public.kpi_daily enable row level security;
+alter table public.kpi_daily_teachers enable row level security;
+alter table public.kpi_daily_topics enable row level security;
+
+create index if not exists consultations_org_created_idx on public.consultations (org_id, created_at);
+create index if not exists feedbacks_org_created_idx on public.feedbacks (org_id, created_at);
+create index if not exists answers_consultation_idx on public.answers (consultation_id);
+
+-- 避け語が本文に含まれるか（ダッシュボードの「ポリシー整合率」と同じ判定）
+create or replace function public.violates_avoid(p_text text, p_avoid text[])
+returns boolean
+language sql
+immutable
+as $$
+  select exists (
+    select 1 from unnest(coalesce(p_avoid, '{}'::text[])) w
+    where w <> '' and strpos(coalesce(p_text, ''), w) > 0
+  );
+$$;
+
+-- ================== 加算トリガー ==================
+create or replace function public.kpi_on_consultation()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  d date := (new.created_at at time zone 'utc')::date;
+begin
+  insert into kpi_daily (org_id, day, consultations, sensitive)
+  values (new.org_id, d, 1, case when new.sensitive_flag then 1 else 0 end)
+  on conflict (org_id, day) do update
+    set consultations = kpi_daily.consultations + 1,
+        sensitive     = kpi_daily.sensitive + excluded.sensitive;
+
+  insert into kpi_daily_teachers (org_id, day, user_id, consultations)
+  values (new.org_id, d, new.user_id, 1)
+  on conflict (org_id, day, user_id) do update
+    set consultations = kpi_daily_teachers.consultations + 1;
+
+  insert into kpi_daily_topics (org_id, day, topic, n)
+  select distinct new.org_id, d, t, 1 from unnest(coalesce(new.topics, '{}'::text[])) t
+  on conflict (org_id, day, topic) do update
+    set n = kpi_daily_topics.n + 1;
+  return new;
+end;
+$$;
+
+create or replace function public.kpi_on_answer()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  o uuid;
+  bad int;
+begin
+  select c.org_id into o from consultations c where c.id = new.consultation_id;
+  if o is null then
+    return new;
+  end if;
+  select case when violates_avoid(new.text, p.avoid_phrases) then 1 else 0 end into bad
+    from org_policies p where p.org_id = o limit 1;
+
+  insert into kpi_daily (org_id, day, answers, policy_violations)
+  values (o, (new.created_at at time zone 'utc')::date, 1, coalesce(bad, 0))
+  on conflict (org_id, day) do update
+    set answers           = kpi_daily.answers + 1,
+        policy_violations = kpi_daily.policy_violations + excluded.policy_violations;
+  return new;
+end;
+$$;
+
+create or replace function public.kpi_on_feedback()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  insert into kpi_daily (org_id, day, feedbacks, helpful, regen_notes, time_misfit)
+  values (
+    new.org_id, (new.created_at at time zone 'utc')::date, 1,
+    case when new.rating = 'good' then 1 else 0 end,
+    case when strpos(coalesce(new.note, ''), '再') > 0 then 1 else 0 end,
+    case when '時間に合わない' = any(coalesce(new.reasons, '{}'::text[])) then 1 else 0 end
+  )
+  on conflict (org_id, day) do update
+    set feedbacks   = kpi_daily.feedbacks + 1,
+        helpful     = kpi_daily.helpful + excluded.helpful,
+        regen_notes = kpi_daily.regen_notes + excluded.regen_notes,
+        time_misfit = kpi_daily.time_misfit + excluded.time_misfit;
+  return new;
+end;
+$$;
+
+-- ================== 既存データの初期集計 ==================
+insert into public.kpi_daily (org_id, day, consultations, sensitive)
+select org_id, (created_at at time zone 'utc')::date, count(*), count(*) filter (where sensitive_flag)
+  from public.consultations group by 1, 2
+on conflict (org_id, day) do nothing;
+
+insert into public.kpi_daily_teachers (org_id, day, user_id, consultations)
+select org_id, (created_at at time zone 'utc')::date, user_id, count(*)
+  from public.consultations group by 1, 2, 3
+on conflict (org_id, day, user_id) do nothing;
+
+insert into public.kpi_daily_topics (org_id, day, topic, n)
+select c.org_id, (c.created_at at time zone 'utc')::date, t, count(*)
+  from public.consultations c, unnest(coalesce(c.topics, '{}'::text[])) t group by 1, 2, 3
+on conflict (org_id, day, topic) do nothing;
+
+insert into public.kpi_daily (org_id, day, answers, policy_violations)
+select c.org_id, (a.created_at at time zone 'utc')::date, count(*),
+       count(*) filter (where public.violates_avoid(a.text, p.avoid_phrases))
+  from public.answers a
+  join public.consultations c on c.id = a.consultation_id
+  left join public.org_policies p on p.org_id = c.org_id
+ group by 1, 2
+on conflict (org_id, day) do update
+  set answers = excluded.answers, policy_violations = excluded.policy_violations;
+
+insert into public.kpi_daily (org_id, day, feedbacks, helpful, regen_notes, time_misfit)
+select org_id, (created_at at time zone 'utc')::date, count(*),
+       count(*) filter (where rating = 'good'),
+       count(*) filter (where strpos(coalesce(note, ''), '再') > 0),
+       count(*) filter (where '時間に合わない' = any(coalesce(reasons, '{}'::text[])))
+  from public.feedbacks group by 1, 2
+on conflict (org_id, day) do update
+  set feedbacks = excluded.feedbacks, helpful = excluded.helpful,
+      regen_notes = excluded.regen_notes, time_misfit = excluded.time_misfit;
+
+drop trigger if exists kpi_consultations on public.consultations;
+create trigger kpi_consultations after insert on public.consultations
+  for each row execute function public.kpi_on_consultation();
+drop trigger if exists kpi_answers on public.answers;
+create trigger kpi_answers after insert on public.answers
+  for each row execute function public.kpi_on_answer();
+drop trigger if exists kpi_feedbacks on public.feedbacks;
+create trigger kpi_feedbacks after insert on public.feedbacks
+  for each row execute function public.kpi_on_feedback();
+
+-- ================== 集計 RPC ==================
+create or replace function public.dashboard_kpis(p_org_id uuid, p_days int)
+returns jsonb
+language plpgsql
+stable
+security definer
+set search_path = public
+as $$
+declare
+  since timestamptz := now() - make_interval(days => p_days);
+  d0    date        := (since at time zone 'utc')::date;           -- 開始日（生データで数える）
+  d1    timestamptz := (d0 + 1)::timestamp at time zone 'utc';     -- 翌日 0 時以降はロールアップ
+  avoid text[];
+  result jsonb;
+begin
+  if not exists (select 1 from memberships m where m.org_id = p_org_id and m.user_id = auth.uid()) then
+    raise exception 'not a member of org %', p_org_id using errcode = '42501';
+  end if;
+  select p.avoid_phrases into avoid from org_policies p where p.org_id = p_org_id limit 1;
+
+  with
+  b_cons as (
+    select user_id, sensitive_flag, topics from consultations
+     where org_id = p_org_id and created_at >= since and created_at < d1
+  ),
+  b_ans as (
+    select a.text from answers a join consultations c on c.id = a.consultation_id
+     where c.org_id = p_org_id and a.created_at >= since and a.created_at < d1
+  ),
+  b_fb as (
+    select rating, reasons, note from feedbacks
+     where org_id = p_org_id and created_at >= since and created_at < d1
+  ),
+  r as (
+    select coalesce(sum(consultations), 0)     as cons,
+           coalesce(sum(sensitive), 0)         as sensitive,
+           coalesce(sum(answers), 0)           as answers,
+           coalesce(sum(policy_violations), 0) as violations,
+           coalesce(sum(feedbacks), 0)         as fbs,
+           coalesce(sum(helpful), 0)           as helpful,
+           coalesce(sum(regen_notes), 0)       as regen,
+           coalesce(sum(time_misfit), 0)       as misfit
+      from kpi_daily where org_id = p_org_id and day > d0
+  ),
+  t as (
+    select r.cons       + (select count(*) from b_cons)                                      as cons,
+           r.sensitive  + (select count(*) from b_cons where sensitive_flag)                 as sensitive,
+           r.answers    + (select count(*) from b_ans)                                       as answers,
+           r.violations + (select count(*) from b_ans where violates_avoid(b_ans.text, avoid)) as violations,
+           r.fbs        + (select count(*) from b_fb)                                        as fbs,
+           r.helpful    + (select count(*) from b_fb where rating = 'good')                  as helpful,
+           r.regen      + (select count(*) from b_fb where strpos(coalesce(note, ''), '再') > 0) as regen,
+           r.misfit     + (select count(*) from b_fb
+                            where '時間に合わない' = any(coalesce(reasons, '{}'::text[])))   as misfit,
+           (select count(distinct user_id) from (
+              select user_id from kpi_daily_teachers where org_id = p_org_id and day > d0
+              union select user_id from b_cons) u)                                           as teachers
+      from r
+  ),
+  topics as (
+    select topic, sum(n)::int as n from (
+      select topic, n from kpi_daily_topics where org_id = p_org_id and day > d0
+      union all
+      select x, 1 from b_cons, unnest(coalesce(b_cons.topics, '{}'::text[])) x
+    ) s group by topic order by sum(n) desc, topic limit 10
+  )
+  select jsonb_build_object(
+    'action_rate',    round(t.cons::numeric / greatest(t.teachers, 1) / greatest(p_days / 7.0, 1.0), 2),
+    'helpful_rate',   round(100.0 * t.helpful / greatest(t.fbs, 1), 1),
+    'regen_rate',     round(100.0 * t.regen / greatest(t.answers, 1), 1),
+    'time_fit_rate',  round(100.0 * (1 - t.misfit::numeric / greatest(t.fbs, 1)), 1),
+    'sens_rate',      round(100.0 * t.sensitive / greatest(t.cons, 1), 1),
+    'policy_ok_rate', round(100.0 * (1 - t.violations::numeric / greatest(t.answers, 1)), 1),
+    'topics', coalesce((select jsonb_agg(jsonb_build_object('topic', topic, 'n', n) order by n desc, topic) from topics), '[]'::jsonb)
+  ) into result
+  from t;
+  return result;
+end;
+$$;
+
+grant execute on function public.dashboard_kpis(uuid, int) to authenticated;
@@ -0,0 +1,173 @@
+-- 生成時に求めた派生値を answers に保存し、集計で本文を読み直さないようにする。
+-- avoid_hits / ng_hits / facts_version は albert_backfill.py でルール変更時に再計算できる。
+alter table public.answers
+  add column if not exists avoid_hits        text[]  not null default '{}',
+  add column if not exists ng_hits           text[],            -- null = 未計算
+  add column if not exists repaired          boolean not null default false,
+  add column if not exists latency_ms        int,
+  add column if not exists prompt_tokens     int,
+  add column if not exists completion_tokens int,
+  add column if not exists output_chars      int,
+  add column if not exists facts_version     text;
+
+alter table public.kpi_daily
+  add column if not exists repaired int not null default 0;
+
+-- 既存行の避け語ヒットは SQL で初期化（NG 表現はバックフィルで埋める）
+update public.answers a
+   set avoid_hits = coalesce((select array_agg(w) from unnest(p.avoid_phrases) w
+                               where w <> '' and strpos(coalesce(a.text, ''), w) > 0), '{}'),
+       output_chars = char_length(coalesce(a.text, ''))
+  from public.consultations c
+  join public.org_policies p on p.org_id = c.org_id
+ where c.id = a.consultation_id;
+
+-- ================== 加算トリガー（派生値を使う版） ==================
+create or replace function public.kpi_on_answer()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  o uuid;
+begin
+  select c.org_id into o from consultations c where c.id = new.consultation_id;
+  if o is null then
+    return new;
+  end if;
+  insert into kpi_daily (org_id, day, answers, policy_violations, repaired)
+  values (o, (new.created_at at time zone 'utc')::date, 1,
+          case when cardinality(new.avoid_hits) > 0 then 1 else 0 end,
+          case when new.repaired then 1 else 0 end)
+  on conflict (org_id, day) do update
+    set answers           = kpi_daily.answers + 1,
+        policy_violations = kpi_daily.policy_violations + excluded.policy_violations,
+        repaired          = kpi_daily.repaired + excluded.repaired;
+  return new;
+end;
+$$;
+
+-- バックフィルで派生値が変わったらロールアップも差分だけ直す
+create or replace function public.kpi_on_answer_update()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  o uuid;
+  dv int := (case when cardinality(new.avoid_hits) > 0 then 1 else 0 end)
+          - (case when cardinality(old.avoid_hits) > 0 then 1 else 0 end);
+  dr int := (case when new.repaired then 1 else 0 end) - (case when old.repaired then 1 else 0 end);
+begin
+  if dv = 0 and dr = 0 then
+    return new;
+  end if;
+  select c.org_id into o from consultations c where c.id = new.consultation_id;
+  update kpi_daily
+     set policy_violations = policy_violations + dv, repaired = repaired + dr
+   where org_id = o and day = (new.created_at at time zone 'utc')::date;
+  return new;
+end;
+$$;
+
+drop trigger if exists kpi_answers_update on public.answers;
+create trigger kpi_answers_update after update of avoid_hits, repaired on public.answers
+  for each row execute function public.kpi_on_answer_update();
+
+-- ================== バックフィル用の一括更新 ==================
+create or replace function public.update_answer_facts(p_rows jsonb)
+returns int
+language sql
+as $$
+  with u as (
+    update public.answers a
+       set avoid_hits = r.avoid_hits, ng_hits = r.ng_hits,
+           output_chars = r.output_chars, facts_version = r.facts_version
+      from jsonb_to_recordset(p_rows)
+           as r(id uuid, avoid_hits text[], ng_hits text[], output_chars int, facts_version text)
+     where a.id = r.id
+    returning 1
+  )
+  select count(*)::int from u;
+$$;
+
+-- ================== 集計 RPC（再生成率は repaired の実測に） ==================
+create or replace function public.dashboard_kpis(p_org_id uuid, p_days int)
+returns jsonb
+language plpgsql
+stable
+security definer
+set search_path = public
+as $$
+declare
+  since timestamptz := now() - make_interval(days => p_days);
+  d0    date        := (since at time zone 'utc')::date;           -- 開始日（生データで数える）
+  d1    timestamptz := (d0 + 1)::timestamp at time zone 'utc';     -- 翌日 0 時以降はロールアップ
+  result jsonb;
+begin
+  if not exists (select 1 from memberships m where m.org_id = p_org_id and m.user_id = auth.uid()) then
+    raise exception 'not a member of org %', p_org_id using errcode = '42501';
+  end if;
+
+  with
+  b_cons as (
+    select user_id, sensitive_flag, topics from consultations
+     where org_id = p_org_id and created_at >= since and created_at < d1
+  ),
+  b_ans as (
+    select a.avoid_hits, a.repaired from answers a join consultations c on c.id = a.consultation_id
+     where c.org_id = p_org_id and a.created_at >= since and a.created_at < d1
+  ),
+  b_fb as (
+    select rating, reasons from feedbacks
+     where org_id = p_org_id and created_at >= since and created_at < d1
+  ),
+  r as (
+    select coalesce(sum(consultations), 0)     as cons,
+           coalesce(sum(sensitive), 0)         as sensitive,
+           coalesce(sum(answers), 0)           as answers,
+           coalesce(sum(policy_violations), 0) as violations,
+           coalesce(sum(repaired), 0)          as repaired,
+           coalesce(sum(feedbacks), 0)         as fbs,
+           coalesce(sum(helpful), 0)           as helpful,
+           coalesce(sum(time_misfit), 0)       as misfit
+      from kpi_daily where org_id = p_org_id and day > d0
+  ),
+  t as (
+    select r.cons       + (select count(*) from b_cons)                                    as cons,
+           r.sensitive  + (select count(*) from b_cons where sensitive_flag)               as sensitive,
+           r.answers    + (select count(*) from b_ans)                                     as answers,
+           r.violations + (select count(*) from b_ans where cardinality(avoid_hits) > 0)   as violations,
+           r.repaired   + (select count(*) from b_ans where repaired)                      as repaired,
+           r.fbs        + (select count(*) from b_fb)                                      as fbs,
+           r.helpful    + (select count(*) from b_fb where rating = 'good')                as helpful,
+           r.misfit     + (select count(*) from b_fb
+                            where '時間に合わない' = any(coalesce(reasons, '{}'::text[]))) as misfit,
+           (select count(distinct user_id) from (
+              select user_id from kpi_daily_teachers where org_id = p_org_id and day > d0
+              union select user_id from b_cons) u)                                         as teachers
+      from r
+  ),
+  topics as (
+    select topic, sum(n)::int as n from (
+      select topic, n from kpi_daily_topics where org_id = p_org_id and day > d0
+      union all
+      select x, 1 from b_cons, unnest(coalesce(b_cons.topics, '{}'::text[])) x
+    ) s group by topic
+  )
+  select jsonb_build_object(
+    'action_rate',    round(t.cons::numeric / greatest(t.teachers, 1) / greatest(p_days / 7.0, 1.0), 2),
+    'helpful_rate',   round(100.0 * t.helpful / greatest(t.fbs, 1), 1),
+    'regen_rate',     round(100.0 * t.repaired / greatest(t.answers, 1), 1),
+    'time_fit_rate',  round(100.0 * (1 - t.misfit::numeric / greatest(t.fbs, 1)), 1),
+    'sens_rate',      round(100.0 * t.sensitive / greatest(t.cons, 1), 1),
+    'policy_ok_rate', round(100.0 * (1 - t.violations::numeric / greatest(t.answers, 1)), 1),
+    'topics', coalesce((select jsonb_agg(jsonb_build_object('topic', topic, 'n', n) order by n desc, topic)
+                          from (select * from topics order by n desc, topic limit 10) x), '[]'::jsonb)
+  ) into result
+  from t;
+  return result;
+end;
+$$;
@@ -0,0 +1,40 @@
+-- 相談と回答を 1 回の往復・1 トランザクションで保存する。
+-- ID はクライアントが採番して渡す（省略時はここで採番）。同じ ID の再送は無視されるので再試行しても安全。
+-- security invoker なので RLS はそのまま効く。
+create or replace function public.save_consultation(p_consultation jsonb, p_answer jsonb)
+returns jsonb
+language plpgsql
+security invoker
+set search_path = public
+as $$
+declare
+  c   consultations := jsonb_populate_record(null::consultations, p_consultation);
+  a   answers       := jsonb_populate_record(null::answers, p_answer);
+  cid uuid          := coalesce(c.id, gen_random_uuid());
+  aid uuid          := coalesce(a.id, gen_random_uuid());
+begin
+  insert into consultations (
+    id, org_id, user_id, grade, scale, scene, frequency, urgency, emotion, subject, timebox,
+    specificity, message, attempts, "values", sensitive_flag, safety_answers, topics, created_at
+  ) values (
+    cid, c.org_id, c.user_id, c.grade, c.scale, c.scene, c.frequency, c.urgency, c.emotion, c.subject, c.timebox,
+    c.specificity, c.message, c.attempts, c."values", c.sensitive_flag, c.safety_answers, c.topics,
+    coalesce(c.created_at, now())
+  )
+  on conflict (id) do nothing;
+
+  insert into answers (
+    id, consultation_id, model, safety_mode, text, repaired, latency_ms, prompt_tokens,
+    completion_tokens, avoid_hits, ng_hits, output_chars, facts_version, created_at
+  ) values (
+    aid, cid, a.model, a.safety_mode, a.text, coalesce(a.repaired, false), a.latency_ms, a.prompt_tokens,
+    a.completion_tokens, coalesce(a.avoid_hits, '{}'), a.ng_hits, a.output_chars, a.facts_version,
+    coalesce(a.created_at, now())
+  )
+  on conflict (id) do nothing;
+
+  return jsonb_build_object('consultation_id', cid, 'answer_id', aid);
+end;
+$$;
+
+grant execute on function public.save_consultation(jsonb, jsonb) to authenticated;
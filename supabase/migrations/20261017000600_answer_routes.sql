@@ -0,0 +1,83 @@
+-- 生成ルート（albert_route）を answers に残し、ルートごとの所要時間・トークン・評価を集計する。
+alter table public.answers
+  add column if not exists route text;
+
+create or replace function public.save_consultation(p_consultation jsonb, p_answer jsonb)
+returns jsonb
+language plpgsql
+security invoker
+set search_path = public
+as $$
+declare
+  c   consultations := jsonb_populate_record(null::consultations, p_consultation);
+  a   answers       := jsonb_populate_record(null::answers, p_answer);
+  cid uuid          := coalesce(c.id, gen_random_uuid());
+  aid uuid          := coalesce(a.id, gen_random_uuid());
+begin
+  insert into consultations (
+    id, org_id, user_id, grade, scale, scene, frequency, urgency, emotion, subject, timebox,
+    specificity, message, attempts, "values", sensitive_flag, safety_answers, topics, created_at
+  ) values (
+    cid, c.org_id, c.user_id, c.grade, c.scale, c.scene, c.frequency, c.urgency, c.emotion, c.subject, c.timebox,
+    c.specificity, c.message, c.attempts, c."values", c.sensitive_flag, c.safety_answers, c.topics,
+    coalesce(c.created_at, now())
+  )
+  on conflict (id) do nothing;
+
+  insert into answers (
+    id, consultation_id, model, safety_mode, text, repaired, latency_ms, prompt_tokens,
+    completion_tokens, avoid_hits, ng_hits, output_chars, facts_version, cache_hit, route, created_at
+  ) values (
+    aid, cid, a.model, a.safety_mode, a.text, coalesce(a.repaired, false), a.latency_ms, a.prompt_tokens,
+    a.completion_tokens, coalesce(a.avoid_hits, '{}'), a.ng_hits, a.output_chars, a.facts_version,
+    coalesce(a.cache_hit, false), a.route, coalesce(a.created_at, now())
+  )
+  on conflict (id) do nothing;
+
+  return jsonb_build_object('consultation_id', cid, 'answer_id', aid);
+end;
+$$;
+
+grant execute on function public.save_consultation(jsonb, jsonb) to authenticated;
+
+-- ルート・モデルごとの件数、所要時間の p50/p95、平均トークン、フィードバックの評価。
+-- 所要時間は応答キャッシュから返した回答を除いて数える。
+create or replace function public.route_stats(p_org_id uuid, p_since timestamptz)
+returns table (
+  route text, model text, answers bigint, p50_ms int, p95_ms int, avg_completion_tokens int,
+  repaired_rate numeric, feedbacks bigint, good bigint, bad bigint, good_rate numeric
+)
+language sql
+stable
+security invoker
+set search_path = public
+as $$
+  with a as (
+    select a.id, coalesce(a.route, '（未記録）') as route, a.model, a.latency_ms, a.completion_tokens,
+           a.repaired, a.cache_hit
+    from answers a
+    join consultations c on c.id = a.consultation_id
+    where c.org_id = p_org_id and a.created_at >= p_since
+  ), f as (
+    select f.answer_id,
+           count(*)                                as n,
+           count(*) filter (where f.rating = 'good') as good,
+           count(*) filter (where f.rating = 'bad')  as bad
+    from feedbacks f
+    where f.answer_id in (select id from a)
+    group by f.answer_id
+  )
+  select a.route, a.model, count(*),
+         (percentile_cont(0.5)  within group (order by a.latency_ms) filter (where not a.cache_hit))::int,
+         (percentile_cont(0.95) within group (order by a.latency_ms) filter (where not a.cache_hit))::int,
+         (avg(a.completion_tokens) filter (where not a.cache_hit))::int,
+         round(100.0 * count(*) filter (where a.repaired) / count(*), 1),
+         coalesce(sum(f.n), 0)::bigint, coalesce(sum(f.good), 0)::bigint, coalesce(sum(f.bad), 0)::bigint,
+         round(100.0 * sum(f.good) / nullif(sum(f.n), 0), 1)
+  from a
+  left join f on f.answer_id = a.id
+  group by a.route, a.model
+  order by count(*) desc;
+$$;
+
+grant execute on function public.route_stats(uuid, timestamptz) to authenticated;
@@ -0,0 +1,62 @@
+# tests/fakedb.py  —— テスト用の PostgREST（supabase-py の table() の一部）をメモリ上で真似る
+"""select / eq / in_ / gte / lt / キーセットの or_ / order / limit だけに対応する。
+実行したクエリは FakeDB.queries に (テーブル, select の列) で残る"""
+import re
+from types import SimpleNamespace
+
+_KEYSET = re.compile(r'created_at\.gt\."([^"]+)",and\(created_at\.eq\."([^"]+)",id\.gt\.([^)]+)\)')
+
+class _Query:
+    def __init__(self, db:"FakeDB", table:str):
+        self.db, self.table = db, table
+        self.sel, self.conds, self.orders, self.lim = "", [], [], None
+
+    def select(self, sel:str):
+        self.sel = sel
+        return self
+
+    def eq(self, col, v):
+        self.conds.append(lambda r: r.get(col) == v)
+        return self
+
+    def in_(self, col, vs):
+        self.conds.append(lambda r: r.get(col) in vs)
+        return self
+
+    def gte(self, col, v):
+        self.conds.append(lambda r: r.get(col) >= v)
+        return self
+
+    def lt(self, col, v):
+        self.conds.append(lambda r: r.get(col) < v)
+        return self
+
+    def or_(self, expr:str):
+        ts, ts2, last_id = _KEYSET.fullmatch(expr).groups()
+        self.conds.append(lambda r: r["created_at"] > ts or (r["created_at"] == ts2 and r["id"] > last_id))
+        return self
+
+    def order(self, col):
+        self.orders.append(col)
+        return self
+
+    def limit(self, n:int):
+        self.lim = n
+        return self
+
+    def execute(self):
+        self.db.queries.append((self.table, self.sel))
+        rows = [r for r in self.db.tables.get(self.table, []) if all(c(r) for c in self.conds)]
+        if self.orders:
+            rows.sort(key=lambda r: tuple(r[c] for c in self.orders))
+        cols = [c.strip() for c in self.sel.split(",")]
+        rows = [{c: r.get(c) for c in cols} for r in rows[:self.lim]]
+        return SimpleNamespace(data=rows)
+
+class FakeDB:
+    def __init__(self, **tables):
+        self.tables = tables
+        self.queries: list = []
+
+    def table(self, name:str)->_Query:
+        return _Query(self, name)
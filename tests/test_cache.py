@@ -0,0 +1,38 @@
+# tests/test_cache.py  —— ResponseCache（TTL・LRU・合計文字数の上限）と consultation_key
+"""使い方: python -m pytest -q tests"""
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_llm import ResponseCache, consultation_key
+
+def test_ttl_expires_entries():
+    rc = ResponseCache(ttl=0.05)
+    rc.put("k", {"text": "a"})
+    assert rc.get("k") == {"text": "a"}
+    time.sleep(0.06)
+    assert rc.get("k") is None and len(rc) == 0
+    assert rc.stats["hits"] == 1 and rc.stats["misses"] == 1
+
+def test_lru_evicts_least_recently_used():
+    rc = ResponseCache(max_entries=2)
+    rc.put("a", {"text": "1"}); rc.put("b", {"text": "2"})
+    rc.get("a")  # a を最近使ったことにする
+    rc.put("c", {"text": "3"})
+    assert rc.get("b") is None and rc.get("a") and rc.get("c")
+    assert rc.stats["evictions"] == 1
+
+def test_total_chars_bound():
+    rc = ResponseCache(max_chars=10)
+    rc.put("big", {"text": "x" * 11})  # 1 件で上限を超えるものは入れない
+    assert len(rc) == 0
+    rc.put("a", {"text": "x" * 6}); rc.put("b", {"text": "y" * 6})
+    assert rc.get("a") is None and rc.get("b") and rc._chars == 6
+    rc.put("b", {"text": "z" * 2})  # 上書きは古い分を差し引く
+    assert rc._chars == 2
+
+def test_key_absorbs_notation_and_tracks_versions():
+    c1 = {"message": "授業中に　立ち歩く", "grade": "小１-２", "values": ["安心", "主体性"]}
+    c2 = {"message": "授業中に 立ち歩く", "grade": "小1-2", "values": ["主体性", "安心"]}
+    k = lambda c, av="v1": consultation_key(c, "org", "p1", "standard:m", "標準", av)
+    assert k(c1) == k(c2)
+    assert k(c1) != k(c1, "v2")  # 素材（プロンプト）を読み直したら当たらない
@@ -0,0 +1,33 @@
+# tests/test_data.py  —— iter_pages（(created_at, id) のキーセットページング）
+"""使い方: python -m pytest -q tests"""
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_data import iter_pages, iter_rows
+from fakedb import FakeDB
+
+def _cons(n:int, org=1)->list[dict]:
+    # created_at が同じ行をまたいでページが切れるよう、3 行ずつ同じ時刻にする
+    return [{"id": f"c{i:03d}", "org_id": org, "created_at": f"2026-10-01T00:00:{i // 3:02d}", "message": f"m{i}"}
+            for i in range(n)]
+
+def test_keyset_pages_cover_every_row_once_in_order():
+    db = FakeDB(consultations=list(reversed(_cons(11))) + _cons(4, org=2))
+    pages = list(iter_pages(db, "consultations", ("message",), org_id=1, page=4))
+    assert [len(p) for p in pages] == [4, 4, 3]
+    assert [r["id"] for p in pages for r in p] == [f"c{i:03d}" for i in range(11)]
+    assert set(pages[0][0]) == {"id", "created_at", "message"}  # キーの列は指定しなくても読む
+    assert len(db.queries) == 3
+
+def test_exact_multiple_ends_with_an_empty_query_and_filters_apply():
+    db = FakeDB(consultations=_cons(8))
+    assert [len(p) for p in iter_pages(db, "consultations", (), page=4)] == [4, 4]
+    assert len(db.queries) == 3  # 最後の空ページで終わりを知る
+    rows = list(iter_rows(db, "consultations", ("message",), since="2026-10-01T00:00:01", until="2026-10-01T00:00:02", page=2))
+    assert [r["id"] for r in rows] == ["c003", "c004", "c005"]
+
+def test_unknown_column_is_rejected():
+    with pytest.raises(ValueError):
+        next(iter_pages(FakeDB(), "consultations", ("password",)))
@@ -0,0 +1,40 @@
+# tests/test_export.py  —— export_pages（1 回答 1 行・フィードバックの集約・伏せ字）
+"""使い方: python -m pytest -q tests"""
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_export import COLUMNS, REDACTED, export_pages
+from fakedb import FakeDB
+
+def _db()->FakeDB:
+    cons = [
+        {"id": "c1", "org_id": 1, "created_at": "2026-10-01T00:00:00", "message": "授業中に立ち歩く",
+         "values": ["安心", "主体性"], "topics": ["授業規律"], "sensitive_flag": False},
+        {"id": "c2", "org_id": 1, "created_at": "2026-10-01T00:00:01", "message": "SNS で晒されている",
+         "values": [], "topics": [], "sensitive_flag": False},
+        {"id": "c3", "org_id": 2, "created_at": "2026-10-01T00:00:02", "message": "他校", "sensitive_flag": False},
+    ]
+    answers = [
+        {"id": "a2", "consultation_id": "c1", "created_at": "2026-10-02T00:00:00", "text": "再生成", "model": "m"},
+        {"id": "a1", "consultation_id": "c1", "created_at": "2026-10-01T00:00:05", "text": "最初", "model": "m"},
+    ]
+    feedbacks = [
+        {"answer_id": "a1", "rating": "good", "reasons": [], "note": "助かった"},
+        {"answer_id": "a1", "rating": "bad", "reasons": ["根拠が薄い"], "note": ""},
+    ]
+    return FakeDB(consultations=cons, answers=answers, feedbacks=feedbacks)
+
+def test_one_row_per_answer_in_order_with_feedback_rollup():
+    rows = [r for page in export_pages(_db(), 1, page=10) for r in page]
+    assert [(r["consultation_id"], r["answer_id"]) for r in rows] == [("c1", "a1"), ("c1", "a2"), ("c2", None)]
+    first = rows[0]
+    assert set(first) == {c for c, _ in COLUMNS}
+    assert (first["feedbacks"], first["good"], first["bad"], first["ok"]) == (2, 1, 1, 0)
+    assert first["reasons"] == "根拠が薄い" and first["notes"] == "助かった" and first["values"] == "安心 | 主体性"
+    assert rows[1]["feedbacks"] == 0 and rows[2]["answer"] is None
+
+def test_redact_hides_free_text_of_sensitive_consultations():
+    rows = [r for page in export_pages(_db(), 1, redact=True, page=1) for r in page]
+    hidden = [r for r in rows if r["redacted"]]
+    assert [r["consultation_id"] for r in hidden] == ["c2"]  # 印が無くても検知ルールに当たれば伏せる
+    assert hidden[0]["message"] == REDACTED and rows[0]["message"] == "授業中に立ち歩く"
@@ -0,0 +1,67 @@
+# tests/test_llm.py  —— LLMCaller のサーキットブレーカー（half-open の試行枠の決着）
+"""使い方: python -m pytest -q tests"""
+import os, sys, time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_llm import CircuitOpenError, LLMCaller
+
+def _error(cls, status:int):
+    req = httpx.Request("POST", "http://test/v1/chat/completions")
+    return cls(f"{status}", response=httpx.Response(status, request=req), body=None)
+
+class FakeClient:
+    """create() のたびに outcomes の先頭を返す（例外なら送出する）"""
+
+    def __init__(self, outcomes:list):
+        self.outcomes = outcomes
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=self._create)))
+
+    def _create(self, **kw):
+        self.calls += 1
+        out = self.outcomes.pop(0)
+        if isinstance(out, BaseException):
+            raise out
+        return SimpleNamespace(headers={}, parse=lambda: out)
+
+def _caller(outcomes:list)->LLMCaller:
+    caller = LLMCaller(FakeClient(outcomes), "m", retries=0, base_delay=0, hedge=False)
+    caller.breakers["m"].cooldown = 0.05
+    return caller
+
+def _open(caller:LLMCaller):
+    for _ in range(caller.breakers["m"].threshold):
+        with pytest.raises(openai.InternalServerError):
+            caller.complete([])
+    assert caller.breakers["m"].state == "open"
+    with pytest.raises(CircuitOpenError):
+        caller.complete([])
+    time.sleep(caller.breakers["m"].cooldown)
+
+def test_non_retryable_trial_returns_the_slot():
+    caller = _caller([_error(openai.InternalServerError, 500)] * 5 + [_error(openai.BadRequestError, 400), "ok"])
+    _open(caller)
+    with pytest.raises(openai.BadRequestError):
+        caller.complete([])
+    assert caller.breakers["m"].state == "half-open"
+    assert caller.complete([]) == ("m", "ok")  # 次の呼び出しが新しい試行枠を得て閉じる
+    assert caller.breakers["m"].state == "closed"
+
+def test_retryable_trial_reopens():
+    caller = _caller([_error(openai.InternalServerError, 500)] * 6)
+    _open(caller)
+    with pytest.raises(openai.InternalServerError):
+        caller.complete([])
+    assert caller.breakers["m"].state == "open"
+
+def test_complete_calls_do_not_skew_stream_hedge():
+    caller = _caller(["ok"] * 25)
+    for _ in range(25):
+        caller.complete([])
+    assert len(caller.complete_s) == 25 and len(caller.ttft) == 0
+    assert caller.hedge_after() == caller.hedge_default  # ストリームの実績はまだ無い
@@ -0,0 +1,25 @@
+# tests/test_prompt.py  —— プロンプト組み立て（分割生成の部分ごとの分量）
+import json, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_prompt import SECTIONS, build_messages, build_section_messages, compile_policy, length_range
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+C = {"grade": "小1-2", "scene": "授業中", "message": "授業中に立ち歩く", "values": ["自信を育てたい"]}
+
+def _cp():
+    with open(os.path.join(ROOT, "albert_policy.json"), encoding="utf-8") as f:
+        return compile_policy(json.load(f))
+
+def test_full_answer_gets_route_length():
+    lo, hi = length_range(900)
+    assert f"全体で {lo:,}〜{hi:,}字" in build_messages(_cp(), C, max_tokens=900)[1]["content"]
+
+def test_sections_get_only_their_own_length():
+    cp = _cp()
+    msgs = [build_section_messages(cp, C, sec) for sec in SECTIONS]
+    for sec, m in zip(SECTIONS, msgs):
+        assert "全体で" not in m[1]["content"]
+        assert f"分量：{sec.chars[0]}〜{sec.chars[1]}字" in m[2]["content"]
+        assert sec.chars[1] <= sec.max_tokens * 0.85
+    assert len({m[1]["content"] for m in msgs}) == 1  # 与件までは全部分で同じ（プレフィックスキャッシュ）
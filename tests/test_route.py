@@ -0,0 +1,32 @@
+# tests/test_route.py  —— Router（ルールの照合と OPENAI_ROUTES の検証）
+"""使い方: python -m pytest -q tests"""
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_route import Router
+
+def test_default_rules_pick_first_match():
+    r = Router.from_config(None, "main", "fast")
+    assert r.choose({"sensitive_flag": True, "urgency": "高"}).name == "sensitive"
+    assert r.choose({"urgency": "高", "timebox": "~5分"}).name == "urgent"
+    assert r.choose({"timebox": "~10分"}).model == "fast"
+    assert r.choose({}).name == "standard"
+
+def test_overrides_and_custom_rules():
+    r = Router.from_config({"routes": {"standard": {"max_tokens": 800}, "night": {"model": "cheap"}},
+                            "rules": [{"route": "night", "urgency": ["低"]}]}, "main", "fast")
+    assert r.choose({"urgency": "低"}).model == "cheap"
+    assert r.choose({"sensitive_flag": True}).max_tokens == 800  # rules を書くと既定のルールは置き換わる
+
+@pytest.mark.parametrize("cfg, msg", [
+    ({"routes": {"standard": {"max_token": 800}}}, "使えない項目"),
+    ({"routes": {"standard": {"name": "x"}}}, "使えない項目"),
+    ({"rules": [{"route": "nope"}]}, "未定義のルート"),
+    ({"default": "nope"}, "未定義のルート"),
+    ({"rules": [{"route": "quick", "grade": "小1-2"}]}, "使えない列"),
+])
+def test_invalid_config_is_rejected(cfg, msg):
+    with pytest.raises(ValueError, match=msg):
+        Router.from_config(cfg, "main")
@@ -0,0 +1,21 @@
+# tests/test_scan.py  —— Scanner.scan（1 回の走査）がパターンごとの finditer と同じヒットを返すか
+"""使い方: python -m pytest -q tests"""
+import os, re, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_scan import Scanner, answer_scanner
+
+def _finditer_hits(sc:Scanner, text:str)->list:
+    return sorted((c, p, m.start(), m.end()) for c, p in sc.patterns for m in re.finditer(p, text))
+
+def test_overlapping_hits_across_patterns():
+    sc = Scanner([("a", "いじめ"), ("b", "いじ(め|り)"), ("c", "じめ|暴力"), ("d", "(?:殴|蹴)る"), ("e", "被害者.*同席")])
+    text = "いじめといじりと暴力。殴る、蹴る。被害者を同席、被害者も同席"
+    assert sorted(map(tuple, sc.scan(text))) == _finditer_hits(sc, text)
+
+def test_escaped_avoid_phrases_and_quantified_heads():
+    sc = answer_scanner(["恥を(かかせる)", "a.b"])
+    sc2 = Scanner(list(sc.patterns) + [("x", "ab?c"), ("y", "x*yz")])
+    text = "恥を(かかせる)とa.bとaxbとacとabcとyzとxxyz"
+    assert sorted(map(tuple, sc2.scan(text))) == _finditer_hits(sc2, text)
+    assert sc2.scan("何もない") == []
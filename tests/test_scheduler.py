@@ -0,0 +1,49 @@
+# tests/test_scheduler.py  —— GenerationScheduler（枠・バケット・相乗り）
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_llm import GenerationScheduler
+
+def test_charge_takes_from_buckets_after_grant():
+    sched = GenerationScheduler(2, rpm=10, tpm=1000)
+    slot = sched.acquire("org", 600, calls=2)
+    assert slot.wait(0)
+    sched.charge(500)  # 作り直しの分
+    assert sched.tokens.level < 0 and not sched.tokens.can_take(100)
+    slot.release()
+    assert not sched.acquire("org", 100).wait(0)  # 積んだ分が戻るまで次は待つ
+
+def test_orgs_take_turns():
+    sched = GenerationScheduler(1)
+    busy = sched.acquire("x", 10)
+    a1, a2, a3, b1 = (sched.acquire(org, 10) for org in "aaab")
+    assert busy.wait(0) and [s.position() for s in (a1, b1, a2, a3)] == [0, 1, 2, 3]
+    busy.release()
+    assert a1.wait(0)
+    a1.release()
+    assert b1.wait(0) and not a2.wait(0)  # a が続けて並べても b が先に回る
+    b1.release()
+    assert a2.wait(0)
+
+def test_wide_slot_is_not_overtaken():
+    sched = GenerationScheduler(3)
+    one = sched.acquire("a", 10)
+    wide = sched.acquire("b", 10, calls=6)  # 枠は max_concurrency の 3 つ
+    narrow = sched.acquire("c", 10)
+    assert one.wait(0) and wide.width == 3 and not wide.wait(0) and not narrow.wait(0)
+    one.release()
+    assert wide.wait(0) and sched.snapshot()["active"] == 3
+    wide.release()
+    assert narrow.wait(0)
+
+def test_single_flight_shares_result_and_error():
+    sched = GenerationScheduler()
+    lead, fut = sched.join("k")
+    follow, same = sched.join("k")
+    assert lead and not follow and same is fut and sched.stats["coalesced"] == 1
+    sched.finish("k", result="ok")
+    assert same.result(0) == "ok"
+    lead, fut = sched.join("k")  # 終わった key は新しい先頭になる
+    assert lead
+    sched.finish("k", error=RuntimeError("boom"))
+    assert isinstance(fut.exception(0), RuntimeError) and sched._inflight == {}
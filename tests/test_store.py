@@ -0,0 +1,26 @@
+# tests/test_store.py  —— WriteBehind（key ごとの順序と、詰まった key が他を待たせないこと）
+"""使い方: python -m pytest -q tests"""
+import os, sys, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_store import WriteBehind
+
+def test_same_key_runs_in_order_and_others_are_not_blocked():
+    wb = WriteBehind(workers=2, retries=0)
+    gate, order = threading.Event(), []
+    wb.submit("詰まる", gate.wait, key="a")
+    wb.submit("後ろ", order.append, "a2", key="a")
+    assert wb.submit("別セッション", order.append, "b", key="b").result(timeout=2) is None
+    assert order == ["b"]  # a の先頭が終わるまで a2 は走らない
+    gate.set()
+    assert wb.flush(timeout=2) and order == ["b", "a2"]
+    assert wb.pending() == 0 and wb.stats["done"] == 3
+
+def test_failure_is_reported_and_lane_moves_on():
+    wb = WriteBehind(workers=1, retries=1, base_delay=0)
+    def boom():
+        raise RuntimeError("x")
+    f = wb.submit("失敗", boom, key="a")
+    g = wb.submit("次", lambda: "ok", key="a")
+    assert g.result(timeout=2) == "ok" and isinstance(f.exception(), RuntimeError)
+    assert wb.stats == {"done": 1, "retried": 1, "failed": 1}
@@ -0,0 +1,25 @@
+# tests/test_trace.py  —— MetricsStore（保存期間での削除と組織ごとの分位点）
+"""使い方: python -m pytest -q tests"""
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from albert_trace import MetricsStore, Span
+
+def _span(op:str, org, start:float, ms:float)->Span:
+    s = Span(op, None, {"org": org})
+    s.start, s.duration_ms = start, ms
+    return s
+
+def test_prune_drops_spans_older_than_keep_days(tmp_path):
+    store = MetricsStore(str(tmp_path / "m.sqlite"), keep_days=1)
+    now = time.time()
+    store.insert([_span("rerun", "1", now - 2 * 86400, 5), _span("rerun", "1", now, 7)])
+    assert store.prune() == 1
+    assert [r["count"] for r in store.latency(0)] == [1]
+
+def test_latency_can_be_limited_to_one_org(tmp_path):
+    store = MetricsStore(str(tmp_path / "m.sqlite"))
+    now = time.time()
+    store.insert([_span("generate", "1", now, 10), _span("generate", "2", now, 900), _span("rerun", None, now, 3)])
+    assert [(r["op"], r["p99"]) for r in store.latency(0, "1")] == [("generate", 10)]
+    assert len(store.latency(0)) == 2